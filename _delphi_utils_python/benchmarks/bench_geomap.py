@@ -0,0 +1,164 @@
+"""Benchmark suite for the GeoMapper conversions.
+
+Times every conversion supported by add_geocode and replace_geocode (with both engines),
+plus fips_to_megacounty and add_population_column, on synthetic daily data at realistic
+scales: every county or zip in the crosswalks, over --n_days days. Each case runs in a
+fresh subprocess, so the peak memory of one case is not hidden by an earlier one and
+every case starts from cold crosswalk caches (which are then warmed before timing).
+
+Results are written as JSON, to compare runs across commits:
+    {"commit": ..., "n_days": ..., "results": [
+        {"case": "replace_geocode:merge:fips->state_id", "rows": 982200,
+         "wall_time_s": 0.61, "peak_rss_mb": 412.3, "op_rss_mb": 96.1}, ...]}
+where peak_rss_mb is the peak RSS of the subprocess and op_rss_mb how much the case
+itself raised it, above the peak reached while generating the input.
+
+Usage (from _delphi_utils_python):
+    python benchmarks/bench_geomap.py --n_days 300 --output geomap_bench.json
+    python benchmarks/bench_geomap.py --n_days 30 --cases fips->state
+"""
+
+from argparse import ArgumentParser
+import json
+import resource
+import subprocess
+import sys
+from time import perf_counter
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from delphi_utils import GeoMapper
+
+STATE_CODES = ["state_code", "state_id", "state_name"]
+CONVERSIONS = (
+    [("fips", code) for code in STATE_CODES + ["zip", "msa", "hrr", "nation"]]
+    + [("zip", code) for code in STATE_CODES + ["fips", "msa", "hrr", "nation"]]
+    + [("jhu_uid", "fips")]
+    + [(a, b) for a in STATE_CODES for b in STATE_CODES if a != b]
+    + [("state_code", "hhs_region_number")]
+)
+
+
+def list_cases():
+    """Names of all the benchmark cases."""
+    cases = [f"add_geocode:{a}->{b}" for a, b in CONVERSIONS]
+    cases += [
+        f"replace_geocode:{engine}:{a}->{b}"
+        for engine in ["merge", "sparse"]
+        for a, b in CONVERSIONS
+    ]
+    cases += ["fips_to_megacounty:fips->megafips"]
+    cases += [f"add_population_column:{code}->pop" for code in ["fips", "zip"]]
+    return cases
+
+
+def synthetic_data(gmpr, geocode, n_days, seed=0):
+    """Daily count and total columns for every id of the geocode type in the crosswalks."""
+    if geocode in STATE_CODES:
+        geos = gmpr._load_crosswalk(from_code="state", to_code="state")[geocode].values
+    elif geocode == "jhu_uid":
+        geos = gmpr._load_crosswalk(from_code="jhu_uid", to_code="fips")["jhu_uid"].unique()
+    else:
+        geos = gmpr.geocode_categories(geocode).values
+    dates = pd.date_range("2020-03-01", periods=n_days)
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            geocode: np.repeat(geos, n_days),
+            "date": np.tile(dates, len(geos)),
+            "count": rng.poisson(10, len(geos) * n_days).astype(float),
+            "total": rng.poisson(100, len(geos) * n_days).astype(float),
+        }
+    )
+
+
+def case_function(gmpr, case):
+    """The conversion to time for a case, as (input geocode, function of a dataframe)."""
+    func, *options, conversion = case.split(":")
+    from_code, new_code = conversion.split("->")
+    if func == "add_geocode":
+        return from_code, lambda df: gmpr.add_geocode(df, from_code, new_code)
+    if func == "replace_geocode":
+        return from_code, lambda df: gmpr.replace_geocode(
+            df, from_code, new_code, engine=options[0]
+        )
+    if func == "fips_to_megacounty":
+        return from_code, lambda df: gmpr.fips_to_megacounty(df, 100, 7, thr_col="total")
+    if func == "add_population_column":
+        return from_code, lambda df: gmpr.add_population_column(df, from_code)
+    raise ValueError(f"Unknown benchmark case '{case}'")
+
+
+def run_case(case, n_days):
+    """Runs a single case in this process and returns its result."""
+    warnings.simplefilter("ignore")
+    gmpr = GeoMapper()
+    from_code, func = case_function(gmpr, case)
+    df = synthetic_data(gmpr, from_code, n_days)
+    # Warm the crosswalk caches, so only the conversion itself is timed
+    func(df.head(10))
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = perf_counter()
+    func(df)
+    wall_time = perf_counter() - start
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux
+    return {
+        "case": case,
+        "rows": len(df),
+        "wall_time_s": round(wall_time, 4),
+        "peak_rss_mb": round(rss_after / 1024, 1),
+        "op_rss_mb": round((rss_after - rss_before) / 1024, 1),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(n_days, cases, output):
+    results = []
+    for case in cases:
+        out = subprocess.run(
+            [sys.executable, __file__, "--n_days", str(n_days), "--run_case", case],
+            capture_output=True,
+            text=True,
+        )
+        if out.returncode != 0:
+            result = {"case": case, "error": out.stderr.strip().splitlines()[-1]}
+        else:
+            result = json.loads(out.stdout)
+        print(json.dumps(result), file=sys.stderr)
+        results.append(result)
+
+    report = {"commit": git_commit(), "n_days": n_days, "results": results}
+    if output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--n_days", type=int, default=300,
+                        help="Number of days of synthetic data per geocode.")
+    parser.add_argument("--cases", type=str, default="",
+                        help="Only run the cases whose name contains this string.")
+    parser.add_argument("--output", type=str, default=None,
+                        help="File to write the JSON report to, instead of stdout.")
+    parser.add_argument("--run_case", type=str, default=None,
+                        help="Run a single case in this process and print its result.")
+    args = parser.parse_args()
+    if args.run_case is not None:
+        print(json.dumps(run_case(args.run_case, args.n_days)))
+    else:
+        main(args.n_days, [c for c in list_cases() if args.cases in c], args.output)
@@ -0,0 +1,71 @@
+"""Compare the 'merge' and 'sparse' engines of GeoMapper.replace_geocode.
+
+Builds synthetic daily data for every county (or zip) in the crosswalks and times both
+engines on each conversion, checking that they agree. Also times GeoMapper.replace_geocodes,
+which aggregates to all the conversions in one pass.
+
+Usage (from _delphi_utils_python):
+    python benchmarks/bench_replace_geocode.py --n_days 300
+"""
+
+from argparse import ArgumentParser
+from time import perf_counter
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from delphi_utils import GeoMapper
+
+CONVERSIONS = {
+    "fips": ["state_id", "msa", "hrr", "zip"],
+    "zip": ["fips", "state_id", "msa", "hrr"],
+}
+
+
+def synthetic_data(gmpr, geocode, n_days, seed=0):
+    """Daily count and total columns for every geocode of type geocode."""
+    geos = gmpr._load_crosswalk(from_code=geocode, to_code="pop")[geocode].values
+    dates = pd.date_range("2020-03-01", periods=n_days)
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            geocode: np.repeat(geos, n_days),
+            "date": np.tile(dates, len(geos)),
+            "count": rng.poisson(10, len(geos) * n_days).astype(float),
+            "total": rng.poisson(100, len(geos) * n_days).astype(float),
+        }
+    )
+
+
+def time_call(func, *args, **kwargs):
+    start = perf_counter()
+    out = func(*args, **kwargs)
+    return out, perf_counter() - start
+
+
+def main(n_days):
+    warnings.simplefilter("ignore")
+    gmpr = GeoMapper()
+    print(f"{'conversion':<16}{'rows':>10}{'merge (s)':>12}{'sparse (s)':>12}{'speedup':>10}")
+    for from_code, new_codes in CONVERSIONS.items():
+        df = synthetic_data(gmpr, from_code, n_days)
+        for new_code in new_codes:
+            merged, merge_time = time_call(gmpr.replace_geocode, df, from_code, new_code)
+            mapped, sparse_time = time_call(
+                gmpr.replace_geocode, df, from_code, new_code, engine="sparse"
+            )
+            assert np.allclose(merged[["count", "total"]], mapped[["count", "total"]])
+            print(
+                f"{from_code + '->' + new_code:<16}{len(df):>10}"
+                f"{merge_time:>12.3f}{sparse_time:>12.3f}{merge_time / sparse_time:>10.1f}"
+            )
+        _, fan_out_time = time_call(gmpr.replace_geocodes, df, from_code, new_codes)
+        print(f"{from_code + '->all':<16}{len(df):>10}{'':>12}{fan_out_time:>12.3f}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--n_days", type=int, default=300,
+                        help="Number of days of synthetic data per geocode.")
+    main(parser.parse_args().n_days)
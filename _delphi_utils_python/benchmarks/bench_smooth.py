@@ -0,0 +1,104 @@
+"""Benchmark of the linear-time left Gaussian local-linear smoother.
+
+Times delphi_utils.smooth.left_gauss_linear against the original implementation, which
+refits a weighted regression on the whole history at every index, on synthetic daily
+counts of --n_days days for each bandwidth. Also reports the largest difference between
+the two, relative to the magnitude of the reference values.
+
+Results are written as JSON, to compare runs across commits:
+    {"commit": ..., "results": [
+        {"n_days": 300, "bandwidth": 100, "reference_s": 0.017, "linear_s": 0.0004,
+         "speedup": 42.5, "max_rel_diff": 3.1e-14}, ...]}
+
+Usage (from _delphi_utils_python):
+    python benchmarks/bench_smooth.py --n_days 300 600 1000 --output smooth_bench.json
+"""
+
+from argparse import ArgumentParser
+import json
+import subprocess
+from time import perf_counter
+
+import numpy as np
+
+from delphi_utils.smooth import left_gauss_linear
+
+
+def left_gauss_linear_reference(arr, bandwidth):
+    """The original O(n^2) smoother, as copied in the changehc, claims_hosp and emr_hosp
+    indicators before they used delphi_utils.smooth."""
+    n = len(arr)
+    out = np.zeros_like(arr)
+    X = np.vstack([np.ones(n), np.arange(n)]).T
+    for idx in range(n):
+        wts = np.exp(-((np.arange(idx + 1) - idx) ** 2) / bandwidth)
+        XwX = np.dot(X[: (idx + 1), :].T * wts, X[: (idx + 1), :])
+        Xwy = np.dot(X[: (idx + 1), :].T * wts, arr[: (idx + 1)].reshape(-1, 1))
+        try:
+            beta = np.linalg.solve(XwX, Xwy)
+            out[idx] = np.dot(X[: (idx + 1), :], beta)[-1, 0]
+        except np.linalg.LinAlgError:
+            out[idx] = np.nan
+    return out
+
+
+def best_time(func, repeat):
+    """Best wall time of repeat calls of func."""
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+    return min(times)
+
+
+def run_case(n_days, bandwidth, repeat, seed=0):
+    """Times both smoothers on one synthetic series and returns the result."""
+    rng = np.random.default_rng(seed)
+    arr = rng.poisson(rng.uniform(10, 1000), n_days).astype(float)
+
+    reference = left_gauss_linear_reference(arr, bandwidth)
+    linear = left_gauss_linear(arr, bandwidth)
+    max_rel_diff = np.nanmax(np.abs(linear - reference) / np.maximum(np.abs(reference), 1))
+
+    reference_s = best_time(lambda: left_gauss_linear_reference(arr, bandwidth), repeat)
+    linear_s = best_time(lambda: left_gauss_linear(arr, bandwidth), repeat)
+    return {
+        "n_days": n_days,
+        "bandwidth": bandwidth,
+        "reference_s": round(reference_s, 6),
+        "linear_s": round(linear_s, 6),
+        "speedup": round(reference_s / linear_s, 1),
+        "max_rel_diff": float(max_rel_diff),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--n_days", type=int, nargs="+", default=[300, 600, 1000],
+                        help="Lengths of the synthetic series.")
+    parser.add_argument("--bandwidths", type=float, nargs="+", default=[10, 100],
+                        help="Bandwidths of the kernel, in terms of variance.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of timed calls per case, of which the best is kept.")
+    parser.add_argument("--output", type=str, default=None,
+                        help="File to write the JSON report to, instead of stdout.")
+    args = parser.parse_args()
+
+    results = [run_case(n_days, bandwidth, args.repeat)
+               for n_days in args.n_days for bandwidth in args.bandwidths]
+    report = {"commit": git_commit(), "results": results}
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,123 @@
+"""Benchmark of the interior point fit of weekday effects.
+
+Times delphi_utils.weekday.fit_weekday_params against the cvxpy fit it replaces in the
+indicators' Weekday.get_params, on synthetic daily counts of --n_days days. Also reports
+the largest difference of the weekday effects, and the objective values of both fits.
+cvxpy must be installed, as it is for the indicators.
+
+Results are written as JSON, to compare runs across commits:
+    {"commit": ..., "results": [
+        {"n_days": 300, "cvxpy_s": 0.05, "interior_point_s": 0.015, "speedup": 3.3,
+         "max_weekday_diff": 1.6e-4, "cvxpy_objective": ..., "interior_point_objective": ...},
+         ...]}
+
+Usage (from _delphi_utils_python):
+    python benchmarks/bench_weekday.py --n_days 300 600 1000 --output weekday_bench.json
+"""
+
+from argparse import ArgumentParser
+import json
+import subprocess
+from time import perf_counter
+
+import cvxpy as cp
+import numpy as np
+import pandas as pd
+
+from delphi_utils.weekday import fit_weekday_params
+
+
+def design_matrix(dayofweek):
+    """Weekday indicators followed by day indicators, as in Weekday.get_params."""
+    n_days = len(dayofweek)
+    X = np.zeros((n_days, 6 + n_days))
+    not_sunday = np.where(dayofweek != 6)[0]
+    X[not_sunday, dayofweek[not_sunday]] = 1
+    X[np.where(dayofweek == 6)[0], :6] = -1
+    X[:, 6:] = np.eye(n_days)
+    return X
+
+
+def fit_weekday_params_cvxpy(nums, denoms, dayofweek):
+    """The cvxpy fit of Weekday.get_params, which returns the parameters and objective."""
+    X = design_matrix(dayofweek)
+    b = cp.Variable((X.shape[1]))
+    lmbda = 10
+    ll = (cp.matmul(nums, cp.matmul(X, b) + np.log(denoms))
+          - cp.sum(cp.exp(cp.matmul(X, b) + np.log(denoms)))
+          ) / X.shape[0]
+    penalty = lmbda * cp.norm(cp.diff(b[6:], 3), 1) / (X.shape[0] - 2)
+    prob = cp.Problem(cp.Minimize(-ll + lmbda * penalty))
+    prob.solve()
+    return b.value
+
+
+def objective(params, nums, denoms, dayofweek):
+    """Penalized negative mean Poisson log likelihood, without its constant terms."""
+    n_days = len(nums)
+    eta = design_matrix(dayofweek) @ params
+    return float((denoms @ np.exp(eta) - nums @ eta) / n_days
+                 + 100 / (n_days - 2) * np.abs(np.diff(params[6:], 3)).sum())
+
+
+def best_time(func, repeat):
+    """Best wall time of repeat calls of func."""
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+    return min(times)
+
+
+def run_case(n_days, repeat, seed=0):
+    """Times both fits on synthetic counts summed over geographies."""
+    rng = np.random.default_rng(seed)
+    dayofweek = np.asarray(pd.date_range("2020-02-01", periods=n_days).dayofweek)
+    effects = np.array([0.1, 0.05, 0, 0, -0.05, -0.2, 0.1])[dayofweek]
+    trend = np.log(0.05 + 0.03 * np.sin(np.arange(n_days) / 30))
+    denoms = rng.poisson(1e5, n_days).astype(float) + 1
+    nums = rng.poisson(denoms * np.exp(trend + effects)).astype(float)
+
+    reference = fit_weekday_params_cvxpy(nums, denoms, dayofweek)
+    params, _ = fit_weekday_params(nums, denoms, dayofweek)
+
+    cvxpy_s = best_time(lambda: fit_weekday_params_cvxpy(nums, denoms, dayofweek), repeat)
+    interior_point_s = best_time(lambda: fit_weekday_params(nums, denoms, dayofweek), repeat)
+    return {
+        "n_days": n_days,
+        "cvxpy_s": round(cvxpy_s, 6),
+        "interior_point_s": round(interior_point_s, 6),
+        "speedup": round(cvxpy_s / interior_point_s, 1),
+        "max_weekday_diff": float(np.abs(params[:6] - reference[:6]).max()),
+        "cvxpy_objective": objective(reference, nums, denoms, dayofweek),
+        "interior_point_objective": objective(params, nums, denoms, dayofweek),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--n_days", type=int, nargs="+", default=[300, 600, 1000],
+                        help="Numbers of days of the synthetic counts.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of timed calls per case, of which the best is kept.")
+    parser.add_argument("--output", type=str, default=None,
+                        help="File to write the JSON report to, instead of stdout.")
+    args = parser.parse_args()
+
+    results = [run_case(n_days, args.repeat) for n_days in args.n_days]
+    report = {"commit": git_commit(), "results": results}
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
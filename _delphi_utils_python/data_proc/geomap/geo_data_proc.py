@@ -2,13 +2,20 @@
 Authors: Dmitry Shemetov @dshemetov, James Sharpnack @jsharpna
 """
 
+from argparse import ArgumentParser
+from hashlib import sha256
 from io import BytesIO
-from os.path import join, isfile
+import json
+from os import makedirs
+from os.path import basename, join, isfile
 from zipfile import ZipFile
 
 import requests
 import pandas as pd
 
+from delphi_utils.crosswalk_store import write_crosswalk_store
+from delphi_utils.geomap import CROSSWALK_DTYPES, CROSSWALK_FILEPATHS
+
 
 # Source files
 INPUT_DIR = "./old_source_files"
@@ -29,6 +36,23 @@ FIPS_PUERTO_RICO_POPULATION_URL = (
 )
 STATE_HHS_FILE = "hhs.txt"
 
+# Local copies of the source files, used instead of the URLs when a source directory
+# is given: name -> (URL, filename in the source directory). A URL of None marks a
+# file that is kept next to this script.
+SOURCE_FILES = {
+    "fips_by_zip_pop": (FIPS_BY_ZIP_POP_URL, "zcta_county_rel_10.txt"),
+    "zip_hsa_hrr": (ZIP_HSA_HRR_URL, "ZipHsaHrr18.csv.zip"),
+    "fips_msa": (FIPS_MSA_URL, "list1_Sep_2018.xls"),
+    "jhu_fips": (JHU_FIPS_URL, "UID_ISO_FIPS_LookUp_Table.csv"),
+    "state_codes": (STATE_CODES_URL, "state.txt"),
+    "fips_population": (FIPS_POPULATION_URL, "co-est2019-alldata.csv"),
+    "fips_puerto_rico_population": (
+        FIPS_PUERTO_RICO_POPULATION_URL,
+        "zcta_county_rel_10.txt",
+    ),
+    "state_hhs": (None, STATE_HHS_FILE),
+}
+
 # Out files
 FIPS_STATE_OUT_FILENAME = "fips_state_table.csv"
 FIPS_MSA_OUT_FILENAME = "fips_msa_table.csv"
@@ -45,14 +69,33 @@ ZIP_STATE_CODE_OUT_FILENAME = "zip_state_code_table.csv"
 STATE_OUT_FILENAME = "state_codes_table.csv"
 STATE_HHS_OUT_FILENAME = "state_code_hhs_region_number_table.csv"
 JHU_FIPS_OUT_FILENAME = "jhu_uid_fips_table.csv"
+STORE_OUT_DIR = join(OUTPUT_DIR, "crosswalk_store")
+FINGERPRINTS_OUT_FILENAME = "build_fingerprints.json"
+
+
+def source_file(name, source_dir=None):
+    """Location of a source file: its URL, or its local copy if source_dir is given."""
+    url, filename = SOURCE_FILES[name]
+    if url is None:
+        return filename
+    return url if source_dir is None else join(source_dir, filename)
 
 
-def create_fips_zip_crosswalk():
+def download_source_files(source_dir):
+    """Download local copies of all the source files into source_dir."""
+    makedirs(source_dir, exist_ok=True)
+    for url, filename in SOURCE_FILES.values():
+        if url is not None:
+            with open(join(source_dir, filename), "wb") as f:
+                f.write(requests.get(url).content)
+
+
+def create_fips_zip_crosswalk(source_dir=None):
     """
     Creates the (weighted) crosswalk tables between FIPS to ZIP and ZIP to FIPS
     from source.
     """
-    pop_df = pd.read_csv(FIPS_BY_ZIP_POP_URL)
+    pop_df = pd.read_csv(source_file("fips_by_zip_pop", source_dir))
 
     # Create the FIPS column by combining the state and county codes
     state_codes = pop_df["STATE"].astype(str).str.zfill(2)
@@ -65,32 +108,28 @@ def create_fips_zip_crosswalk():
     # Pare down the dataframe to just the relevant columns: zip, fips, and population
     pop_df = pop_df[["zip", "fips", "POPPT"]].rename(columns={"POPPT": "pop"})
 
-    # Find the population fractions (the heaviest computation, takes about a minute)
+    # Find the population fractions
     # Note that the denominator in the fractions is the source population
-    pop_df.set_index(["fips", "zip"], inplace=True)
-    fips_zip = pop_df.groupby("fips", as_index=False).apply(
-        lambda g: g["pop"] / g["pop"].sum()
+    fips_zip = pop_df[["fips", "zip"]].assign(
+        weight=pop_df["pop"] / pop_df.groupby("fips")["pop"].transform("sum")
     )
-    zip_fips = pop_df.groupby("zip", as_index=False).apply(
-        lambda g: g["pop"] / g["pop"].sum()
+    zip_fips = pop_df[["fips", "zip"]].assign(
+        weight=pop_df["pop"] / pop_df.groupby("zip")["pop"].transform("sum")
     )
 
-    # Rename and write to file
-    fips_zip = fips_zip.reset_index(level=["fips", "zip"]).rename(
-        columns={"pop": "weight"}
-    )
-    fips_zip = fips_zip[fips_zip["weight"] > 0.0]
+    # Sort by the source code and write to file
+    fips_zip = fips_zip[fips_zip["weight"] > 0.0].sort_values("fips", kind="stable")
     fips_zip.to_csv(join(OUTPUT_DIR, FIPS_ZIP_OUT_FILENAME), index=False)
-    zip_fips = zip_fips.reset_index(level=["fips", "zip"]).rename(
-        columns={"pop": "weight"}
-    )
-    zip_fips = zip_fips[zip_fips["weight"] > 0.0]
+    zip_fips = zip_fips[zip_fips["weight"] > 0.0].sort_values("zip", kind="stable")
     zip_fips.to_csv(join(OUTPUT_DIR, ZIP_FIPS_OUT_FILENAME), index=False)
 
 
-def create_zip_hsa_hrr_crosswalk():
+def create_zip_hsa_hrr_crosswalk(source_dir=None):
     """Creates the crosswalk table from ZIP to HSA and from ZIP to HRR from source."""
-    zipped_csv = ZipFile(BytesIO(requests.get(ZIP_HSA_HRR_URL).content))
+    if source_dir is None:
+        zipped_csv = ZipFile(BytesIO(requests.get(ZIP_HSA_HRR_URL).content))
+    else:
+        zipped_csv = ZipFile(source_file("zip_hsa_hrr", source_dir))
     zip_df = pd.read_csv(zipped_csv.open(ZIP_HSA_HRR_FILENAME))
 
     # Build the HSA table
@@ -113,7 +152,7 @@ def create_zip_hsa_hrr_crosswalk():
     hrr_df.to_csv(join(OUTPUT_DIR, ZIP_HRR_OUT_FILENAME), index=False)
 
 
-def create_fips_msa_crosswalk():
+def create_fips_msa_crosswalk(source_dir=None):
     """Creates the crosswalk table from FIPS to MSA from source."""
     msa_cols = {
         "CBSA Code": int,
@@ -123,7 +162,7 @@ def create_fips_msa_crosswalk():
     }
     # The following line requires the xlrd package.
     msa_df = pd.read_excel(
-        FIPS_MSA_URL,
+        source_file("fips_msa", source_dir),
         skiprows=2,
         skipfooter=4,
         usecols=msa_cols.keys(),
@@ -144,7 +183,7 @@ def create_fips_msa_crosswalk():
     )
 
 
-def create_jhu_uid_fips_crosswalk():
+def create_jhu_uid_fips_crosswalk(source_dir=None):
     """Creates the crosswalk table from JHU UID to FIPS from source."""
     # These are hand modifications that need to be made to the translation
     # between JHU UID and FIPS. See below for the special cases information
@@ -219,7 +258,7 @@ def create_jhu_uid_fips_crosswalk():
     )
 
     jhu_df = (
-        pd.read_csv(JHU_FIPS_URL, dtype={"UID": str, "FIPS": str})
+        pd.read_csv(source_file("jhu_fips", source_dir), dtype={"UID": str, "FIPS": str})
         .query("Country_Region == 'US'")[["UID", "FIPS"]]
         .rename(columns={"UID": "jhu_uid", "FIPS": "fips"})
         .dropna(subset=["fips"])
@@ -255,10 +294,10 @@ def create_jhu_uid_fips_crosswalk():
     jhu_df.to_csv(join(OUTPUT_DIR, JHU_FIPS_OUT_FILENAME), index=False)
 
 
-def create_state_codes_crosswalk():
+def create_state_codes_crosswalk(source_dir=None):
     """Create the State ID -> State Name -> State code crosswalk file."""
     df = (
-        pd.read_csv(STATE_CODES_URL, delimiter="|")
+        pd.read_csv(source_file("state_codes", source_dir), delimiter="|")
         .drop(columns="STATENS")
         .rename(
             columns={
@@ -336,16 +375,18 @@ def create_state_hhs_crosswalk():
     )
 
 
-def create_fips_population_table():
+def create_fips_population_table(source_dir=None):
     """
     Build a table of populations by FIPS county codes. Uses US Census Bureau population
     data from 2019, supplemented with 2010 population data for Puerto Rico, and a few
     small counties.
     """
-    census_pop = pd.read_csv(FIPS_POPULATION_URL, encoding="ISO-8859-1")
-    census_pop["fips"] = census_pop.apply(
-        lambda x: f"{x['STATE']:02d}{x['COUNTY']:03d}", axis=1
+    census_pop = pd.read_csv(
+        source_file("fips_population", source_dir), encoding="ISO-8859-1"
     )
+    census_pop["fips"] = census_pop["STATE"].astype(str).str.zfill(2) + census_pop[
+        "COUNTY"
+    ].astype(str).str.zfill(3)
     census_pop["pop"] = census_pop["POPESTIMATE2019"]
     census_pop = census_pop[["fips", "pop"]]
     census_pop = pd.concat(
@@ -375,7 +416,7 @@ def create_fips_population_table():
     census_pop.loc[census_pop["fips"] == "70003", "pop"] = 491918  # via Google
 
     # Get the file with Puerto Rico populations
-    df_pr = pd.read_csv(FIPS_PUERTO_RICO_POPULATION_URL)
+    df_pr = pd.read_csv(source_file("fips_puerto_rico_population", source_dir))
     df_pr["fips"] = df_pr["STATE"].astype(str).str.zfill(2) + df_pr["COUNTY"].astype(
         str
     ).str.zfill(3)
@@ -524,17 +565,166 @@ def derive_zip_to_state_code():
     )
 
 
+# Build steps in dependency order: (function, source files, input tables, output tables)
+BUILD_STEPS = [
+    (
+        create_fips_zip_crosswalk,
+        ["fips_by_zip_pop"],
+        [],
+        [FIPS_ZIP_OUT_FILENAME, ZIP_FIPS_OUT_FILENAME],
+    ),
+    (
+        create_zip_hsa_hrr_crosswalk,
+        ["zip_hsa_hrr"],
+        [],
+        [ZIP_HSA_OUT_FILENAME, ZIP_HRR_OUT_FILENAME],
+    ),
+    (create_fips_msa_crosswalk, ["fips_msa"], [], [FIPS_MSA_OUT_FILENAME]),
+    (create_jhu_uid_fips_crosswalk, ["jhu_fips"], [], [JHU_FIPS_OUT_FILENAME]),
+    (create_state_codes_crosswalk, ["state_codes"], [], [STATE_OUT_FILENAME]),
+    (
+        create_state_hhs_crosswalk,
+        ["state_hhs"],
+        [STATE_OUT_FILENAME],
+        [STATE_HHS_OUT_FILENAME],
+    ),
+    (
+        create_fips_population_table,
+        ["fips_population", "fips_puerto_rico_population"],
+        [],
+        [FIPS_POPULATION_OUT_FILENAME],
+    ),
+    (
+        derive_fips_hrr_crosswalk,
+        [],
+        [FIPS_ZIP_OUT_FILENAME, ZIP_HRR_OUT_FILENAME],
+        [FIPS_HRR_OUT_FILENAME],
+    ),
+    (
+        derive_zip_msa_crosswalk,
+        [],
+        [ZIP_FIPS_OUT_FILENAME, FIPS_MSA_OUT_FILENAME],
+        [ZIP_MSA_OUT_FILENAME],
+    ),
+    (
+        derive_zip_to_state_code,
+        [],
+        [STATE_OUT_FILENAME, ZIP_FIPS_OUT_FILENAME],
+        [ZIP_STATE_CODE_OUT_FILENAME],
+    ),
+    (
+        derive_fips_state_crosswalk,
+        [],
+        [FIPS_POPULATION_OUT_FILENAME, STATE_OUT_FILENAME],
+        [FIPS_STATE_OUT_FILENAME],
+    ),
+    (
+        derive_zip_population_table,
+        [],
+        [FIPS_POPULATION_OUT_FILENAME, FIPS_ZIP_OUT_FILENAME],
+        [ZIP_POPULATION_OUT_FILENAME],
+    ),
+]
+
+
+def fingerprint(path):
+    """SHA-256 hex digest of a file's contents."""
+    digest = sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_store():
+    """Compile the crosswalk tables in OUTPUT_DIR into the binary format of
+    delphi_utils.crosswalk_store, in STORE_OUT_DIR."""
+    tables = {}
+    for (from_code, to_code), dtypes in CROSSWALK_DTYPES.items():
+        filename = basename(CROSSWALK_FILEPATHS[from_code][to_code])
+        tables[(from_code, to_code)] = pd.read_csv(
+            join(OUTPUT_DIR, filename), dtype=dtypes
+        )
+    write_crosswalk_store(tables, STORE_OUT_DIR)
+
+
+def build_crosswalks(source_dir=None, incremental=False):
+    """
+    Builds all the crosswalk tables, then the binary store from them.
+
+    Parameters
+    ---------
+    source_dir: str, default None
+        Directory with local copies of the source files (see SOURCE_FILES and
+        download_source_files). If None, the source files are requested from their URLs.
+    incremental: bool, default False
+        Only rerun the build steps whose source files or input tables have changed since
+        the last incremental build, as recorded by their fingerprints in OUTPUT_DIR.
+        Requires source_dir.
+    """
+    if incremental and source_dir is None:
+        raise ValueError("An incremental build needs local source files in source_dir.")
+
+    fingerprints_file = join(OUTPUT_DIR, FINGERPRINTS_OUT_FILENAME)
+    fingerprints = {}
+    if incremental and isfile(fingerprints_file):
+        with open(fingerprints_file) as f:
+            fingerprints = json.load(f)
+
+    rebuilt = False
+    for step, sources, inputs, outputs in BUILD_STEPS:
+        # A step's fingerprint covers its source files and the tables it reads, which
+        # were themselves rebuilt earlier in this loop if their own inputs changed
+        step_fingerprint = None
+        if incremental:
+            step_fingerprint = sha256(
+                json.dumps(
+                    [fingerprint(source_file(name, source_dir)) for name in sources]
+                    + [fingerprint(join(OUTPUT_DIR, name)) for name in inputs]
+                ).encode()
+            ).hexdigest()
+            up_to_date = fingerprints.get(step.__name__) == step_fingerprint and all(
+                isfile(join(OUTPUT_DIR, name)) for name in outputs
+            )
+            if up_to_date:
+                continue
+
+        if sources:
+            step(source_dir=source_dir)
+        else:
+            step()
+        rebuilt = True
+
+        if incremental:
+            fingerprints[step.__name__] = step_fingerprint
+            with open(fingerprints_file, "w") as f:
+                json.dump(fingerprints, f, indent=2)
+
+    if rebuilt or not isfile(join(STORE_OUT_DIR, "index.json")):
+        write_store()
+
+
 if __name__ == "__main__":
-    create_fips_zip_crosswalk()
-    create_zip_hsa_hrr_crosswalk()
-    create_fips_msa_crosswalk()
-    create_jhu_uid_fips_crosswalk()
-    create_state_codes_crosswalk()
-    create_state_hhs_crosswalk()
-    create_fips_population_table()
-
-    derive_fips_hrr_crosswalk()
-    derive_zip_msa_crosswalk()
-    derive_zip_to_state_code()
-    derive_fips_state_crosswalk()
-    derive_zip_population_table()
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--source_dir",
+        type=str,
+        default=None,
+        help="Read the source files from this directory instead of their URLs.",
+    )
+    parser.add_argument(
+        "--download",
+        action="store_true",
+        help="First download the source files into --source_dir, which is then required.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only rebuild the tables whose source files or inputs have changed.",
+    )
+    args = parser.parse_args()
+    if args.download and args.source_dir is None:
+        parser.error("--download requires --source_dir")
+    if args.download:
+        download_source_files(args.source_dir)
+    build_crosswalks(args.source_dir, args.incremental)
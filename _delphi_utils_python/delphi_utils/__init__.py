@@ -4,9 +4,9 @@
 
 from __future__ import absolute_import
 
-from .archive import ArchiveDiffer, GitArchiveDiffer, S3ArchiveDiffer
-from .export import create_export_csv
-from .utils import read_params
+from .archive import ArchiveDiffer, GitArchiveDiffer, LocalArchiveDiffer, ParquetArchiveDiffer, S3ArchiveDiffer
+from .export import create_export_csv, create_export_csv_diffs, write_sensor_csvs
+from .utils import link_or_copy, read_params
 from .geomap import GeoMapper
 
 __version__ = "0.1.0"
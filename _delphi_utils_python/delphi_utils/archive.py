@@ -26,24 +26,86 @@ Created: 2020-08-06
 """
 
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from contextlib import contextmanager
+import csv
+from datetime import date
 import filecmp
 from glob import glob
-from os import remove, replace
-from os.path import join, basename, abspath
+from hashlib import md5, sha1
+import json
+import re
+from os import makedirs, remove, replace, stat
+from os.path import join, basename, abspath, getsize, isdir, isfile, realpath, relpath
 import shutil
-from typing import Tuple, List, Dict, Optional
+from tempfile import TemporaryDirectory, TemporaryFile
+from typing import Tuple, List, Dict, Iterable, Iterator, Optional, Set
+from uuid import uuid4
 
 from boto3 import Session
 from boto3.exceptions import S3UploadFailedError
-from git import Repo
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from git import IndexFile, Repo
+from git.index.typ import BaseIndexEntry
+from git.objects import Blob, Commit
 from git.refs.head import Head
+from gitdb.base import IStream
 import pandas as pd
 
-from .utils import read_params
+from .utils import link_or_copy, read_params
 
 Files = List[str]
 FileDiffMap = Dict[str, Optional[str]]
+FileSummary = Dict[str, object]
+Manifest = Dict[str, FileSummary]
+
+# Hidden, so that it is ignored by the globs for *.csv files in cache_dir
+MANIFEST_FILENAME = ".archive_manifest.json"
+# Prefixed with "_", so that it is ignored by pyarrow datasets
+TIME_VALUES_FILENAME = "_time_values.json"
+
+EXPORT_CSV_DTYPES = {"geo_id": str, "val": float,
+                     "se": float, "sample_size": float}
+# Strings read as NA by pd.read_csv
+CSV_NA_VALUES = {
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND",
+    "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "n/a", "nan", "null"}
+# Values that pd.read_csv parses as integers
+INT_PATTERN = re.compile(r"[+-]?\d+")
+
+
+def summarize_file(filename: str) -> FileSummary:
+    """
+    Summarize a CSV file in one pass, for the cache manifest.
+
+    Parameters
+    ----------
+    filename: str
+        The CSV file to summarize
+
+    Returns
+    -------
+        Dict with the "md5" hex digest of the file contents (the same as the S3 ETag of a
+        single part upload of the file), its "size" in bytes, its number of "rows", not
+        counting the header, and its modification time "mtime" in nanoseconds.
+    """
+    mtime = stat(filename).st_mtime_ns
+    digest = md5()
+    size = 0
+    lines = 0
+    last_byte = b"\n"
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+            size += len(block)
+            lines += block.count(b"\n")
+            last_byte = block[-1:]
+    # Count an unterminated last line
+    if last_byte != b"\n":
+        lines += 1
+    return {"md5": digest.hexdigest(), "size": size, "rows": max(lines - 1, 0),
+            "mtime": mtime}
 
 
 def diff_export_csv(
@@ -69,15 +131,34 @@ def diff_export_csv(
         added_df is the pd.DataFrame of added rows from after_csv.
     """
 
-    export_csv_dtypes = {"geo_id": str, "val": float,
-                         "se": float, "sample_size": float}
-
-    before_df = pd.read_csv(before_csv, dtype=export_csv_dtypes)
+    before_df = pd.read_csv(before_csv, dtype=EXPORT_CSV_DTYPES)
     before_df.set_index("geo_id", inplace=True)
 
-    after_df = pd.read_csv(after_csv, dtype=export_csv_dtypes)
+    after_df = pd.read_csv(after_csv, dtype=EXPORT_CSV_DTYPES)
     after_df.set_index("geo_id", inplace=True)
 
+    return diff_export_frames(before_df, after_df)
+
+
+def diff_export_frames(
+    before_df: pd.DataFrame,
+    after_df: pd.DataFrame
+) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """
+    Find differences in covidcast exports held in memory, indexed by geo_id.
+    Treats NA == NA as True.
+
+    Parameters
+    ----------
+    before_df: pd.DataFrame
+        The export to diff from
+    after_df: pd.DataFrame
+        The export to diff to, with the same columns as before_df
+
+    Returns
+    -------
+        (deleted_df, changed_df, added_df), as in diff_export_csv.
+    """
     deleted_idx = before_df.index.difference(after_df.index)
     common_idx = before_df.index.intersection(after_df.index)
     added_idx = after_df.index.difference(before_df.index)
@@ -95,6 +176,264 @@ def diff_export_csv(
         after_df.loc[added_idx, :])
 
 
+def _parse_float(value: str) -> Optional[float]:
+    """Parse a float as pd.read_csv does, or return None if it is not one."""
+    if "_" in value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _column_types(csv_file: str, cols: List[int]) -> Dict[int, type]:
+    """
+    The type that pd.read_csv infers for each of the columns cols of csv_file: int if
+    all their values are integers, float if they are all numbers or NA, and str
+    otherwise.
+    """
+    types = dict.fromkeys(cols, int)
+    with open(csv_file, "r", newline="") as f:
+        reader = csv.reader(f)
+        next(reader)
+        for row in reader:
+            for i in cols:
+                value = row[i]
+                if types[i] is str:
+                    continue
+                if value in CSV_NA_VALUES:
+                    types[i] = float
+                elif types[i] is int and INT_PATTERN.fullmatch(value) is None:
+                    types[i] = float if _parse_float(value) is not None else str
+                elif types[i] is float and _parse_float(value) is None:
+                    types[i] = str
+    return types
+
+
+def _sorted_rows(reader: Iterator[List[str]], geo_col: int, csv_file: str
+                 ) -> Iterator[Tuple[str, List[str]]]:
+    """Yield (geo_id, row) for the rows of a CSV reader, checking geo_id is increasing."""
+    prev_geo = None
+    for row in reader:
+        geo = row[geo_col]
+        if prev_geo is not None and geo <= prev_geo:
+            raise ValueError(f"'{csv_file}' is not sorted by unique geo_id")
+        prev_geo = geo
+        yield geo, row
+
+
+def diff_export_csv_sorted(
+    before_csv: str,
+    after_csv: str,
+    diff_csv: str
+) -> Tuple[int, int, int]:
+    """
+    Streaming version of diff_export_csv, for CSVs sorted by geo_id.
+    Walks both files in lockstep, holding only one row of each in memory, and writes the
+    changed rows then the added rows of after_csv to diff_csv, in the same format as
+    diff_export_csv followed by DataFrame.to_csv(diff_csv, na_rep="NA").
+    Rows that are identical as text are not parsed. Otherwise the rows are compared as
+    parsed by diff_export_csv, treating NA == NA as True: the columns of
+    EXPORT_CSV_DTYPES as floats, and the others as the type that pd.read_csv infers for
+    them in each file, which takes one more pass over both files if there are any.
+
+    Parameters
+    ----------
+    before_csv: str
+        The CSV file to diff from
+    after_csv: str
+        The CSV file to diff to
+    diff_csv: str
+        The CSV file to write the changed and added rows to
+
+    Returns
+    -------
+        (n_deleted, n_changed, n_added), the number of rows of each kind.
+
+    Raises
+    ------
+    ValueError
+        If either file is not sorted by unique geo_id in string order, or their columns
+        differ. diff_csv may then be partially written.
+    """
+    with open(before_csv, "r", newline="") as before_f, \
+         open(after_csv, "r", newline="") as after_f, \
+         open(diff_csv, "w", newline="") as diff_f, \
+         TemporaryFile("w+", newline="") as added_f:
+        before_reader = csv.reader(before_f)
+        after_reader = csv.reader(after_f)
+        header = next(after_reader)
+        if next(before_reader) != header:
+            raise ValueError(f"'{before_csv}' and '{after_csv}' have different columns")
+
+        geo_col = header.index("geo_id")
+        other_cols = [i for i, col in enumerate(header) if col not in EXPORT_CSV_DTYPES]
+        before_types = _column_types(before_csv, other_cols) if other_cols else {}
+        after_types = _column_types(after_csv, other_cols) if other_cols else {}
+        types = {i: float for i, col in enumerate(header)
+                 if EXPORT_CSV_DTYPES.get(col) is float}
+        before_types.update(types)
+        after_types.update(types)
+        # Identical text parses to different values when a column is only str in one file
+        text_equal = all((before_types[i] is str) == (after_types[i] is str)
+                         for i in other_cols)
+        # As in diff_export_csv, geo_id is written first, like an index
+        out_cols = [geo_col] + [i for i in range(len(header)) if i != geo_col]
+
+        def parse(row, col_types):
+            values = list(row)
+            for i, col_type in col_types.items():
+                values[i] = None if values[i] in CSV_NA_VALUES else col_type(values[i])
+            return values
+
+        def format_row(values):
+            return [
+                "NA" if values[i] is None
+                else repr(values[i]) if isinstance(values[i], float)
+                else str(values[i])
+                for i in out_cols]
+
+        diff_writer = csv.writer(diff_f, lineterminator="\n")
+        added_writer = csv.writer(added_f, lineterminator="\n")
+        diff_writer.writerow([header[i] for i in out_cols])
+
+        n_deleted = n_changed = n_added = 0
+        before_rows = _sorted_rows(before_reader, geo_col, before_csv)
+        after_rows = _sorted_rows(after_reader, geo_col, after_csv)
+        before_geo, before_row = next(before_rows, (None, None))
+        after_geo, after_row = next(after_rows, (None, None))
+        while before_geo is not None or after_geo is not None:
+            if after_geo is None or (before_geo is not None and before_geo < after_geo):
+                n_deleted += 1
+                before_geo, before_row = next(before_rows, (None, None))
+            elif before_geo is None or after_geo < before_geo:
+                n_added += 1
+                added_writer.writerow(format_row(parse(after_row, after_types)))
+                after_geo, after_row = next(after_rows, (None, None))
+            else:
+                if before_row != after_row or not text_equal:
+                    after_values = parse(after_row, after_types)
+                    if parse(before_row, before_types) != after_values:
+                        n_changed += 1
+                        diff_writer.writerow(format_row(after_values))
+                before_geo, before_row = next(before_rows, (None, None))
+                after_geo, after_row = next(after_rows, (None, None))
+
+        added_f.seek(0)
+        shutil.copyfileobj(added_f, diff_f)
+
+    return n_deleted, n_changed, n_added
+
+
+def diff_export_file(
+    before_file: str,
+    after_file: str,
+    diff_file: str,
+    before_summary: Optional[FileSummary] = None
+) -> Optional[str]:
+    """
+    Diff an exported CSV against its cached version, writing the ADDED and CHANGED rows
+    to diff_file if there are any.
+
+    Parameters
+    ----------
+    before_file: str
+        The cached CSV file to diff from
+    after_file: str
+        The exported CSV file to diff to
+    diff_file: str
+        The file to write the diff to
+    before_summary: Optional[FileSummary]
+        The manifest entry of before_file, if known. Identical files are then found by
+        hashing after_file, without reading before_file.
+
+    Returns
+    -------
+        diff_file if it was written, or None if after_file has no added or changed rows.
+    """
+    # Check for simple file similarity before doing CSV diffs
+    if before_summary is None:
+        if filecmp.cmp(before_file, after_file, shallow=False):
+            return None
+    elif summarize_file(after_file)["md5"] == before_summary["md5"]:
+        return None
+
+    try:
+        n_deleted, n_changed, n_added = diff_export_csv_sorted(
+            before_file, after_file, diff_file)
+    except ValueError:
+        # Unsorted files need the whole files in memory to diff
+        deleted_df, changed_df, added_df = diff_export_csv(before_file, after_file)
+        new_issues_df = pd.concat([changed_df, added_df], axis=0)
+        n_deleted, n_changed, n_added = len(deleted_df), len(changed_df), len(added_df)
+        if len(new_issues_df) > 0:
+            new_issues_df.to_csv(diff_file, na_rep="NA")
+
+    if n_deleted > 0:
+        print(
+            f"Warning, diff has deleted indices in {after_file} that will be ignored")
+
+    # Keep the diffs in diff_file, if applicable
+    if n_changed + n_added > 0:
+        return diff_file
+
+    if isfile(diff_file):
+        remove(diff_file)
+    return None
+
+
+def diff_export_files(
+    before_files: Files,
+    after_files: Files,
+    diff_files: Files,
+    before_summaries: List[Optional[FileSummary]],
+    n_workers: int = 1,
+    use_processes: bool = False
+) -> List[Optional[str]]:
+    """
+    Run diff_export_file on each set of arguments, possibly concurrently.
+
+    Parameters
+    ----------
+    before_files, after_files, diff_files, before_summaries:
+        Lists of arguments to diff_export_file, one item per file to diff.
+    n_workers: int
+        Number of files to diff concurrently. Diffs files one at a time if 1.
+    use_processes: bool
+        Whether to diff files in a pool of n_workers processes instead of threads.
+
+    Returns
+    -------
+        The results of diff_export_file, in the order of the files.
+    """
+    if n_workers > 1:
+        executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        with executor_class(max_workers=n_workers) as executor:
+            # map returns the diffs in the order of the files
+            return list(executor.map(
+                diff_export_file, before_files, after_files, diff_files,
+                before_summaries,
+                chunksize=max(1, len(before_files) // (4 * n_workers))))
+    return list(map(
+        diff_export_file, before_files, after_files, diff_files, before_summaries))
+
+
+def git_blob_sha(filename: str) -> str:
+    """
+    Hex SHA-1 of a file as a git blob, to compare it to blobs without reading them.
+
+    Parameters
+    ----------
+    filename: str
+        The file to hash
+    """
+    digest = sha1(b"blob %d\0" % getsize(filename))
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
 def run_module(archive_type: str,
                cache_dir: str,
                export_dir: str,
@@ -104,13 +443,14 @@ def run_module(archive_type: str,
     Parameters
     ----------
     archive_type: str
-        Type of ArchiveDiffer to run.  Must be one of ["git", "s3"] which correspond to `GitArchiveDiffer` and `S3ArchiveDiffer`, respectively.
+        Type of ArchiveDiffer to run.  Must be one of ["git", "s3", "local", "parquet"] which correspond to `GitArchiveDiffer`, `S3ArchiveDiffer`, `LocalArchiveDiffer` and `ParquetArchiveDiffer`, respectively.
     cache_dir: str
         The directory for storing most recent archived/uploaded CSVs to start diffing from.
     export_dir: str
         The directory with most recent exported CSVs to diff to.
     **kwargs:
-        Keyword arguments corresponding to constructor arguments for the respective ArchiveDiffers.
+        Keyword arguments corresponding to constructor arguments for the respective ArchiveDiffers,
+        and optionally the n_workers and use_processes arguments of ArchiveDiffer.run().
     """
     if archive_type == "git":
         arch_diff = GitArchiveDiffer(cache_dir,
@@ -118,16 +458,24 @@ def run_module(archive_type: str,
                                      kwargs["branch_name"],
                                      kwargs["override_dirty"],
                                      kwargs["commit_partial_success"],
-                                     kwargs["commit_message"])
+                                     kwargs["commit_message"],
+                                     kwargs.get("checkout_branch", True))
     elif archive_type == "s3":
         arch_diff = S3ArchiveDiffer(cache_dir,
                                     export_dir,
                                     kwargs["bucket_name"],
                                     kwargs["indicator_prefix"],
-                                    kwargs["aws_credentials"])
+                                    kwargs["aws_credentials"],
+                                    kwargs.get("max_transfers", 8))
+    elif archive_type == "local":
+        arch_diff = LocalArchiveDiffer(cache_dir,
+                                       export_dir,
+                                       kwargs.get("hardlink", False))
+    elif archive_type == "parquet":
+        arch_diff = ParquetArchiveDiffer(cache_dir, export_dir)
     else:
         raise ValueError(f"No archive type named '{archive_type}'")
-    arch_diff.run()
+    arch_diff.run(kwargs.get("n_workers", 1), kwargs.get("use_processes", False))
 
 
 class ArchiveDiffer:
@@ -135,6 +483,9 @@ class ArchiveDiffer:
     Base class for performing diffing and archiving of exported covidcast CSVs
     """
 
+    # Whether the backend keeps a manifest of cache_dir, see load_manifest()
+    KEEPS_MANIFEST = False
+
     def __init__(self, cache_dir: str, export_dir: str):
         """
         Initialize an ArchiveDiffer
@@ -154,6 +505,134 @@ class ArchiveDiffer:
         self._cache_updated = False
         self._exports_archived = False
 
+    def load_manifest(self) -> Manifest:
+        """
+        Load the manifest of cache_dir, mapping cached filenames to their summaries from
+        summarize_file(). Backends that keep a manifest update it as they update the cache.
+
+        Returns
+        -------
+        manifest: Manifest
+            Empty if cache_dir has no manifest.
+        """
+        manifest_file = join(self.cache_dir, MANIFEST_FILENAME)
+        if not isfile(manifest_file):
+            return {}
+        with open(manifest_file, "r") as f:
+            return json.load(f)
+
+    def save_manifest(self, manifest: Manifest):
+        """
+        Atomically replace the manifest of cache_dir.
+
+        Parameters
+        ----------
+        manifest: Manifest
+            Mapping of cached filenames to their summaries from summarize_file().
+        """
+        manifest_file = join(self.cache_dir, MANIFEST_FILENAME)
+        with open(manifest_file + ".tmp", "w") as f:
+            json.dump(manifest, f)
+        replace(manifest_file + ".tmp", manifest_file)
+
+    @staticmethod
+    def cached_summary(manifest: Manifest, filename: str, cached_file: str
+                       ) -> Optional[FileSummary]:
+        """
+        Summary of a cached file from its manifest entry, which is only trusted while the
+        size and modification time of the file still match it. The file is summarized
+        again otherwise.
+
+        Parameters
+        ----------
+        manifest: Manifest
+            The manifest of cache_dir
+        filename: str
+            The name of the cached file in the manifest
+        cached_file: str
+            The path of the cached file
+
+        Returns
+        -------
+            The summary of cached_file, or None if it does not exist or has no manifest entry.
+        """
+        summary = manifest.get(filename)
+        if summary is None or not isfile(cached_file):
+            return None
+        file_stat = stat(cached_file)
+        if summary["size"] != file_stat.st_size or summary.get("mtime") != file_stat.st_mtime_ns:
+            summary = summarize_file(cached_file)
+        return summary
+
+    def export_diffs(self, exports: Iterable[Tuple[str, pd.DataFrame]]) -> Tuple[Files, Files]:
+        """
+        Export CSV files from memory directly as diffs against their cached versions.
+        For each export, the cached version, if any, is only read then. The ADDED and
+        CHANGED rows are written to export_dir, and the full export replaces the cached
+        version in cache_dir in the same step. This avoids writing full exports to
+        export_dir, reading them back in diff_exports() and rewriting them as diffs.
+        Should be called after update_cache() succeeds.
+
+        The updated cache files still need to be archived to the backend, e.g. for S3 with
+        archive_exports(cached_files, update_cache=False). Backends whose cache_dir does not
+        hold the exports as CSV files, like git and Parquet, do not support this.
+
+        Both files are written as create_export_csv() writes exports, so the cached files
+        are the same bytes as the exports they replace.
+
+        Parameters
+        ----------
+        exports: Iterable[Tuple[str, pd.DataFrame]]
+            Pairs of CSV filename, e.g. "20200801_state_signal.csv", and export, with
+            columns geo_id, val, se, sample_size. Can be a generator, so that only one
+            export needs to be in memory at a time.
+
+        Returns
+        -------
+        (export_files, cached_files): Tuple[Files, Files]
+            export_files: List of files written to export_dir, with ADDED and CHANGED rows.
+            cached_files: List of the files updated in cache_dir, one per export file.
+        """
+        assert self._cache_updated
+
+        export_files = []
+        cached_files = []
+        manifest = self.load_manifest() if self.KEEPS_MANIFEST else None
+        for filename, df in exports:
+            cached_file = join(self.cache_dir, filename)
+            export_file = join(self.export_dir, filename)
+            export_df = df[list(EXPORT_CSV_DTYPES.keys())]
+            after_df = export_df.astype(EXPORT_CSV_DTYPES).set_index("geo_id")
+
+            if isfile(cached_file):
+                # Values were written with repr, so round trip parsing reads them exactly
+                before_df = pd.read_csv(
+                    cached_file, dtype=EXPORT_CSV_DTYPES, float_precision="round_trip"
+                ).set_index("geo_id")
+                deleted_df, changed_df, added_df = diff_export_frames(before_df, after_df)
+                if len(deleted_df) > 0:
+                    print(
+                        f"Warning, diff has deleted indices in {export_file} that will be ignored")
+                new_issues = pd.concat([changed_df, added_df], axis=0).index
+                new_issues_df = export_df[after_df.index.isin(new_issues)]
+            else:
+                new_issues_df = export_df
+
+            if len(new_issues_df) == 0:
+                continue
+
+            new_issues_df.to_csv(export_file, index=False, na_rep="NA")
+            export_df.to_csv(cached_file + ".tmp", index=False, na_rep="NA")
+            replace(cached_file + ".tmp", cached_file)
+            if manifest is not None:
+                manifest[filename] = summarize_file(cached_file)
+            export_files.append(export_file)
+            cached_files.append(cached_file)
+
+        if manifest is not None:
+            self.save_manifest(manifest)
+        return export_files, cached_files
+
     def update_cache(self):
         """
         For making sure cache_dir is updated correctly from a backend.
@@ -162,12 +641,25 @@ class ArchiveDiffer:
         """
         raise NotImplementedError
 
-    def diff_exports(self) -> Tuple[Files, FileDiffMap, Files]:
+    def diff_exports(
+        self,
+        n_workers: int = 1,
+        use_processes: bool = False
+    ) -> Tuple[Files, FileDiffMap, Files]:
         """
         Finds diffs across and within CSV files, from cache_dir to export_dir.
         Should be called after update_cache() succeeds. Only works on *.csv files,
         ignores every other file.
 
+        Parameters
+        ----------
+        n_workers: int
+            Number of files to diff concurrently. Diffs files one at a time if 1.
+        use_processes: bool
+            Whether to diff files in a pool of n_workers processes instead of threads.
+            Processes avoid contention on the GIL during CSV parsing and comparisons,
+            at the cost of starting them.
+
         Returns
         -------
         (deleted_files, common_diffs, new_files): Tuple[Files, FileDiffMap, Files]
@@ -177,6 +669,7 @@ class ArchiveDiffer:
                           - None, if the export_dir version only has DELETED rows
                           - a filename with .csv.diff suffix, containing ADDED and CHANGED rows ONLY
             added_files: List of files that are missing in cache_dir but present in export_dir.
+            All are in sorted order of filenames, regardless of n_workers.
         """
         assert self._cache_updated
 
@@ -192,31 +685,20 @@ class ArchiveDiffer:
         new_files = sorted(join(self.export_dir, f)
                            for f in exported_files - previous_files)
 
-        common_diffs: Dict[str, Optional[str]] = {}
-        for filename in common_filenames:
-            before_file = join(self.cache_dir, filename)
-            after_file = join(self.export_dir, filename)
-
-            common_diffs[after_file] = None
+        before_files = [join(self.cache_dir, f) for f in common_filenames]
+        after_files = [join(self.export_dir, f) for f in common_filenames]
+        diff_files = [join(self.export_dir, f + ".diff") for f in common_filenames]
 
-            # Check for simple file similarity before doing CSV diffs
-            if filecmp.cmp(before_file, after_file, shallow=False):
-                continue
+        # Only trust manifest entries whose size and mtime still match the cached file
+        manifest = self.load_manifest()
+        before_summaries = [
+            self.cached_summary(manifest, f, before_file)
+            for f, before_file in zip(common_filenames, before_files)]
 
-            deleted_df, changed_df, added_df = diff_export_csv(
-                before_file, after_file)
-            new_issues_df = pd.concat([changed_df, added_df], axis=0)
-
-            if len(deleted_df) > 0:
-                print(
-                    f"Warning, diff has deleted indices in {after_file} that will be ignored")
-
-            # Write the diffs to diff_file, if applicable
-            if len(new_issues_df) > 0:
-                diff_file = join(self.export_dir, filename + ".diff")
-
-                new_issues_df.to_csv(diff_file, na_rep="NA")
-                common_diffs[after_file] = diff_file
+        diffs = diff_export_files(
+            before_files, after_files, diff_files, before_summaries,
+            n_workers, use_processes)
+        common_diffs: Dict[str, Optional[str]] = dict(zip(after_files, diffs))
 
         return deleted_files, common_diffs, new_files
 
@@ -267,12 +749,21 @@ class ArchiveDiffer:
             else:
                 replace(diff_file, exported_file)
 
-    def run(self):
-        """Runs the differ and archives the changed and new files."""
+    def run(self, n_workers: int = 1, use_processes: bool = False):
+        """
+        Runs the differ and archives the changed and new files.
+
+        Parameters
+        ----------
+        n_workers: int
+            Number of files to diff concurrently, see diff_exports().
+        use_processes: bool
+            Whether to diff files in processes instead of threads, see diff_exports().
+        """
         self.update_cache()
 
         # Diff exports, and make incremental versions
-        _, common_diffs, new_files = self.diff_exports()
+        _, common_diffs, new_files = self.diff_exports(n_workers, use_processes)
 
         # Archive changed and new files only
         to_archive = [f for f, diff in common_diffs.items()
@@ -297,11 +788,14 @@ class S3ArchiveDiffer(ArchiveDiffer):
     Ideally, versioning should be enabled in this bucket to track versions of each CSV file.
     """
 
+    KEEPS_MANIFEST = True
+
     def __init__(
         self, cache_dir: str, export_dir: str,
         bucket_name: str,
         indicator_prefix: str,
         aws_credentials: Dict[str, str],
+        max_transfers: int = 8,
     ):
         """
         Initialize a S3ArchiveDiffer.
@@ -322,15 +816,46 @@ class S3ArchiveDiffer(ArchiveDiffer):
             The prefix for S3 keys related to this indicator.
         aws_credentials: Dict[str, str]
             kwargs to create a boto3.Session, containing AWS credentials/profile to use.
+        max_transfers: int
+            Maximum number of files to download or upload concurrently.
         """
         super().__init__(cache_dir, export_dir)
-        self.s3 = Session(**aws_credentials).resource("s3")
+        # Allow a connection per concurrent transfer
+        self.s3 = Session(**aws_credentials).resource(
+            "s3", config=Config(max_pool_connections=max(10, max_transfers)))
         self.bucket = self.s3.Bucket(bucket_name)
         self.indicator_prefix = indicator_prefix
+        self.max_transfers = max_transfers
+
+    def _transfer(self, transfer, items: list) -> list:
+        """
+        Run transfer on every item with up to max_transfers threads at once.
+        Clients, unlike resources, are safe to share between threads, so transfer should
+        only use self.s3.meta.client.
+
+        Returns
+        -------
+        exceptions: list
+            For each item in order, the exception raised by its transfer, or None.
+        """
+        def try_transfer(item):
+            try:
+                transfer(item)
+                return None
+            except (FileNotFoundError, S3UploadFailedError, ClientError) as ex:
+                return ex
+
+        with ThreadPoolExecutor(max_workers=self.max_transfers) as executor:
+            return list(executor.map(try_transfer, items))
 
     def update_cache(self):
         """
         For making sure cache_dir is updated with all latest files from the S3 bucket.
+        Cached files whose manifest entry matches the ETag of their object are kept, all
+        others are downloaded, including those missing from cache_dir. Manifest entries
+        are only trusted while the size and modification time of their file match, see
+        cached_summary(). The first time, the manifest is built from the files already in
+        cache_dir.
         """
         # List all indicator-related objects from S3
         archive_objects = self.bucket.objects.filter(
@@ -338,17 +863,47 @@ class S3ArchiveDiffer(ArchiveDiffer):
         archive_objects = [
             obj for obj in archive_objects if obj.key.endswith(".csv")]
 
-        # Check against what we have locally and download missing ones
-        cached_files = set(basename(f)
-                           for f in glob(join(self.cache_dir, "*.csv")))
+        manifest = self.load_manifest()
+        if not manifest:
+            manifest = {basename(f): summarize_file(f)
+                        for f in glob(join(self.cache_dir, "*.csv"))}
+
+        # Check against what we have locally and download missing or outdated ones
+        to_download = []
         for obj in archive_objects:
             archive_file = basename(obj.key)
-            cached_file = join(self.cache_dir, archive_file)
 
-            if archive_file not in cached_files:
+            summary = self.cached_summary(
+                manifest, archive_file, join(self.cache_dir, archive_file))
+            if summary is not None:
+                manifest[archive_file] = summary
+
+            # The ETag of a multipart upload is not the MD5 of the file, so only
+            # check that the file is cached in that case
+            etag = obj.e_tag.strip('"')
+            if summary is not None and ("-" in etag or summary["md5"] == etag):
+                continue
+            to_download.append(obj.key)
+
+        client = self.s3.meta.client
+        exceptions = self._transfer(
+            lambda key: client.download_file(
+                self.bucket.name, key, join(self.cache_dir, basename(key))),
+            to_download)
+
+        failed = []
+        for key, ex in zip(to_download, exceptions):
+            cached_file = join(self.cache_dir, basename(key))
+            if ex is None:
                 print(f"Updating cache with {cached_file}")
-                obj.Object().download_file(cached_file)
+                manifest[basename(key)] = summarize_file(cached_file)
+            else:
+                print(f"Failed to update cache with {cached_file}: {ex}")
+                failed.append(ex)
 
+        self.save_manifest(manifest)
+        if failed:
+            raise failed[0]
         self._cache_updated = True
 
     def archive_exports(self,
@@ -358,6 +913,7 @@ class S3ArchiveDiffer(ArchiveDiffer):
     ) -> Tuple[Files, Files]:
         """
         Handles actual archiving of files to the S3 bucket.
+        Files are copied into cache_dir, then up to max_transfers files are uploaded at once.
 
         Parameters
         ----------
@@ -372,20 +928,105 @@ class S3ArchiveDiffer(ArchiveDiffer):
         """
         archive_success = []
         archive_fail = []
+        manifest = self.load_manifest()
 
-        for exported_file in exported_files:
-            cached_file = abspath(
-                join(self.cache_dir, basename(exported_file)))
-            archive_key = join(self.indicator_prefix, basename(exported_file))
+        # Update local cache
+        if update_cache:
+            for exported_file in exported_files:
+                cached_file = abspath(
+                    join(self.cache_dir, basename(exported_file)))
+                try:
+                    link_or_copy(exported_file, cached_file)
+                    manifest[basename(exported_file)] = summarize_file(cached_file)
+                except FileNotFoundError:
+                    archive_fail.append(exported_file)
+            self.save_manifest(manifest)
+
+        to_upload = [f for f in exported_files if f not in archive_fail]
+        if update_s3:
+            client = self.s3.meta.client
+            exceptions = self._transfer(
+                lambda exported_file: client.upload_file(
+                    exported_file, self.bucket.name,
+                    join(self.indicator_prefix, basename(exported_file))),
+                to_upload)
+        else:
+            exceptions = [None] * len(to_upload)
+
+        for exported_file, ex in zip(to_upload, exceptions):
+            if ex is None:
+                archive_success.append(exported_file)
+            else:
+                print(f"Failed to upload {exported_file}: {ex}")
+                archive_fail.append(exported_file)
 
-            try:
-                if update_cache:
-                    # Update local cache
-                    shutil.copyfile(exported_file, cached_file)
+        self._exports_archived = True
+
+        return archive_success, archive_fail
+
+
+class LocalArchiveDiffer(ArchiveDiffer):
+    """
+    Local or network filesystem backend for archiving
+    Archives CSV files into cache_dir itself, as "{cache_dir}/{csv_file_name}", so the
+    cache is the archive. Files are archived as reflinks of the exports when the filesystem
+    allows, see link_or_copy(), which shares their data instead of copying it, and as
+    copies otherwise.
+
+    Pass hardlink=True to hardlink them instead of copying them. A hardlinked export and
+    its archived version are the same file, so rewriting an export that is kept in
+    export_dir (a new file) in place would change the archive too: only opt in when
+    exports are always replaced or removed, never rewritten.
+    """
+
+    def __init__(self, cache_dir: str, export_dir: str, hardlink: bool = False):
+        """
+        Initialize a LocalArchiveDiffer.
+
+        Parameters
+        ----------
+        cache_dir: str
+            The directory to archive CSVs to and start diffing from.
+            Usually 'cache'.
+        export_dir: str
+            The directory with most recent exported CSVs to diff to.
+            Usually 'receiving'.
+        hardlink: bool
+            Whether to hardlink archived files to the exports when reflinks are not
+            supported, instead of copying them.
+        """
+        super().__init__(cache_dir, export_dir)
+        self.hardlink = hardlink
+
+    def update_cache(self):
+        """
+        cache_dir is the archive, so there is nothing to update it from.
+        """
+        makedirs(self.cache_dir, exist_ok=True)
+        self._cache_updated = True
 
-                if update_s3:
-                    self.bucket.Object(archive_key).upload_file(exported_file)
+    def archive_exports(self, exported_files: Files) -> Tuple[Files, Files]:
+        """
+        Handles actual archiving of files to cache_dir.
+
+        Parameters
+        ----------
+        exported_files: Files
+            List of files to be archived. Usually new and changed files.
 
+        Returns
+        -------
+        (successes, fails): Tuple[Files, Files]
+            successes: List of successfully archived files
+            fails: List of unsuccessfully archived files
+        """
+        archive_success = []
+        archive_fail = []
+
+        for exported_file in exported_files:
+            cached_file = join(self.cache_dir, basename(exported_file))
+            try:
+                link_or_copy(exported_file, cached_file, self.hardlink)
                 archive_success.append(exported_file)
             except FileNotFoundError:
                 archive_fail.append(exported_file)
@@ -400,6 +1041,11 @@ class GitArchiveDiffer(ArchiveDiffer):
     Local git repo backend for archiving
     Archives CSV files into a local git repo as commits.
     Assumes that a git repository is already set up.
+
+    With checkout_branch=False, an archiving branch other than the checked out one is never
+    checked out: cached files are read from its tree, and archived files are committed to
+    it through a temporary index, so the cost scales with the number of changed files
+    rather than with the size of the repository.
     """
 
     def __init__(
@@ -408,6 +1054,7 @@ class GitArchiveDiffer(ArchiveDiffer):
         override_dirty: bool = False,
         commit_partial_success: bool = False,
         commit_message: str = "Automated archive",
+        checkout_branch: bool = True,
     ):
         """
         Initialize a GitArchiveDiffer.
@@ -429,6 +1076,10 @@ class GitArchiveDiffer(ArchiveDiffer):
             to override_dirty=False
         commit_message: str
             The automatic commit message to use for the commit.
+        checkout_branch: bool
+            Whether to check out the branch to diff and archive. If False and the branch is
+            not the checked out one, the working tree and index are left untouched, so
+            override_dirty has no effect.
         """
         super().__init__(cache_dir, export_dir)
 
@@ -442,6 +1093,7 @@ class GitArchiveDiffer(ArchiveDiffer):
         self.override_dirty = override_dirty
         self.commit_partial_success = commit_partial_success
         self.commit_message = commit_message
+        self.checkout_branch = checkout_branch
 
     def get_branch(self, branch_name: Optional[str] = None) -> Head:
         """
@@ -465,6 +1117,23 @@ class GitArchiveDiffer(ArchiveDiffer):
 
         return self.repo.create_head(branch_name)
 
+    def uses_tree(self) -> bool:
+        """
+        Whether to read and commit to the branch's tree directly, instead of checking it out.
+        """
+        if self.checkout_branch:
+            return False
+        return self.repo.head.is_detached or self.repo.active_branch != self.branch
+
+    def cache_path(self, filename: Optional[str] = None) -> str:
+        """
+        Path of cache_dir, or of a file in it, relative to the root of the repository.
+        """
+        cache_dir = relpath(realpath(self.cache_dir), realpath(self.repo.working_tree_dir))
+        if filename is None:
+            return cache_dir
+        return filename if cache_dir == "." else join(cache_dir, filename)
+
     @contextmanager
     def archiving_branch(self):
         """
@@ -485,19 +1154,89 @@ class GitArchiveDiffer(ArchiveDiffer):
         Checks if cache_dir is clean: has everything nice committed if override_dirty=False
         """
         # Make sure cache directory is clean: has everything nicely committed
-        if not self.override_dirty:
+        # Not needed if the working tree is never used
+        if not self.override_dirty and not self.uses_tree():
             cache_clean = not self.repo.is_dirty(
                 untracked_files=True, path=abspath(self.cache_dir))
             assert cache_clean, f"There are uncommitted changes in the cache dir '{self.cache_dir}'"
 
         self._cache_updated = True
 
-    def diff_exports(self) -> Tuple[Files, FileDiffMap, Files]:
+    def export_diffs(self, exports: Iterable[Tuple[str, pd.DataFrame]]) -> Tuple[Files, Files]:
+        """
+        Not supported: the cached files would be written to whichever branch is checked
+        out, instead of the archiving branch. Export the files, then run the differ.
+        """
+        raise NotImplementedError(
+            "GitArchiveDiffer does not support export_diffs(), use run() on the exports")
+
+    def diff_exports(
+        self,
+        n_workers: int = 1,
+        use_processes: bool = False
+    ) -> Tuple[Files, FileDiffMap, Files]:
         """
         Same as base class diff_exports, but in context of specified branch
         """
+        if self.uses_tree():
+            return self._diff_exports_from_tree(n_workers, use_processes)
         with self.archiving_branch():
-            return super().diff_exports()
+            return super().diff_exports(n_workers, use_processes)
+
+    def _diff_exports_from_tree(
+        self,
+        n_workers: int,
+        use_processes: bool
+    ) -> Tuple[Files, FileDiffMap, Files]:
+        """
+        diff_exports, reading the cached files from the tree of the branch.
+        Exports are compared to their cached blob by hash, and only the cached versions of
+        changed exports are read, into temporary files to diff.
+        """
+        assert self._cache_updated
+
+        try:
+            cache_tree = self.branch.commit.tree
+            if self.cache_path() != ".":
+                cache_tree = cache_tree / self.cache_path()
+            cached_blobs = {blob.name: blob for blob in cache_tree.blobs
+                            if blob.name.endswith(".csv") and not blob.name.startswith(".")}
+        except KeyError:
+            # cache_dir is not in the branch yet
+            cached_blobs = {}
+
+        previous_files = set(cached_blobs)
+        exported_files = set(basename(f)
+                             for f in glob(join(self.export_dir, "*.csv")))
+
+        deleted_files = sorted(join(self.cache_dir, f)
+                               for f in previous_files - exported_files)
+        common_filenames = sorted(exported_files & previous_files)
+        new_files = sorted(join(self.export_dir, f)
+                           for f in exported_files - previous_files)
+
+        common_diffs: Dict[str, Optional[str]] = {
+            join(self.export_dir, f): None for f in common_filenames}
+        with TemporaryDirectory() as tmp_dir:
+            changed_filenames = []
+            for filename in common_filenames:
+                blob = cached_blobs[filename]
+                if git_blob_sha(join(self.export_dir, filename)) == blob.hexsha:
+                    continue
+                with open(join(tmp_dir, filename), "wb") as f:
+                    blob.stream_data(f)
+                changed_filenames.append(filename)
+
+            after_files = [join(self.export_dir, f) for f in changed_filenames]
+            diffs = diff_export_files(
+                [join(tmp_dir, f) for f in changed_filenames],
+                after_files,
+                [join(self.export_dir, f + ".diff") for f in changed_filenames],
+                [None] * len(changed_filenames),
+                n_workers, use_processes)
+            common_diffs.update(zip(after_files, diffs))
+
+        return deleted_files, common_diffs, new_files
 
     def archive_exports(self, exported_files: Files) -> Tuple[Files, Files]:
         """
@@ -514,6 +1253,9 @@ class GitArchiveDiffer(ArchiveDiffer):
             successes: List of successfully archived files
             fails: List of unsuccessfully archived files
         """
+        if self.uses_tree():
+            return self._archive_exports_to_tree(exported_files)
+
         archived_files = []
         archive_success = []
         archive_fail = []
@@ -534,7 +1276,7 @@ class GitArchiveDiffer(ArchiveDiffer):
                 if self.override_dirty or archive_file not in dirty_files:
                     try:
                         # Archive
-                        shutil.copyfile(exported_file, archive_file)
+                        link_or_copy(exported_file, archive_file)
 
                         archived_files.append(archive_file)
                         archive_success.append(exported_file)
@@ -564,11 +1306,357 @@ class GitArchiveDiffer(ArchiveDiffer):
 
         return archive_success, archive_fail
 
+    def _archive_exports_to_tree(self, exported_files: Files) -> Tuple[Files, Files]:
+        """
+        archive_exports, committing to the branch through a temporary index read from its
+        tree, without touching the working tree.
+        """
+        archive_success = []
+        archive_fail = []
+
+        index = IndexFile.from_tree(self.repo, self.branch.commit)
+        entries = []
+        for exported_file in exported_files:
+            try:
+                # Archive
+                with open(exported_file, "rb") as f:
+                    blob = self.repo.odb.store(
+                        IStream(Blob.type, getsize(exported_file), f))
+                entries.append(BaseIndexEntry((
+                    Blob.file_mode, blob.binsha, 0,
+                    self.cache_path(basename(exported_file)))))
+                archive_success.append(exported_file)
+
+            except FileNotFoundError as ex:
+                print(ex)
+                archive_fail.append(exported_file)
+
+        # Commit, with the branch as the only parent
+        partial_success = self.commit_partial_success and len(archive_success) > 0
+        if len(exported_files) > 0 and (
+                len(archive_success) == len(exported_files) or partial_success):
+            index.add(entries, write=False)
+            commit = Commit.create_from_tree(
+                self.repo, index.write_tree(), self.commit_message,
+                parent_commits=[self.branch.commit])
+            self.branch.commit = commit
+
+        self._exports_archived = True
+
+        return archive_success, archive_fail
+
+
+class ParquetArchiveDiffer(ArchiveDiffer):
+    """
+    Local columnar backend for archiving
+    Archives the rows of CSV files into a Parquet dataset in cache_dir, as deltas with the
+    issue date of the archiving. The dataset is partitioned by signal, geo type and month,
+    as "{cache_dir}/signal={signal}/geo_type={geo_type}/month={YYYYMM}/*.parquet", and
+    holds the columns time_value, geo_id, val, se, sample_size and issue.
+
+    Export filenames are parsed as "{time_value}_{geo_type}_{signal}.csv", and the month of
+    a time value is its first six digits. The archived version of an export is made of the
+    latest issue of each of its rows, loaded only for the partitions that are exported.
+    Only the added and changed rows are archived, so rows that are deleted from an export
+    remain archived, and keep being reported as deleted. To find those without loading the
+    whole history, the archived time values of each signal and geo type are indexed in
+    "{cache_dir}/signal={signal}/geo_type={geo_type}/_time_values.json".
+
+    Requires pyarrow, which is an optional dependency: install delphi_utils[parquet].
+    """
+
+    KEYS = ["signal", "geo_type", "time_value", "geo_id"]
+
+    def __init__(self, cache_dir: str, export_dir: str, issue: Optional[int] = None):
+        """
+        Initialize a ParquetArchiveDiffer.
+
+        Parameters
+        ----------
+        cache_dir: str
+            The directory of the Parquet dataset to archive to and diff from.
+        export_dir: str
+            The directory with most recent exported CSVs to diff to.
+            Usually 'receiving'.
+        issue: Optional[int]
+            The issue date of the archived rows, as YYYYMMDD. Defaults to today.
+        """
+        try:
+            import pyarrow  # pylint: disable=import-outside-toplevel,unused-import
+        except ImportError as ex:
+            raise ImportError(
+                "ParquetArchiveDiffer requires pyarrow, install delphi_utils[parquet]") from ex
+        super().__init__(cache_dir, export_dir)
+        self.issue = int(date.today().strftime("%Y%m%d")) if issue is None else issue
+        # Rows to archive for each exported file, from the last diff_exports()
+        self._archive_rows: Dict[str, pd.DataFrame] = {}
+
+    @staticmethod
+    def parse_filename(filename: str) -> Tuple[str, str, str]:
+        """Split an export filename into (signal, geo_type, time_value)."""
+        time_value, geo_type, signal = basename(filename)[:-len(".csv")].split("_", 2)
+        return signal, geo_type, time_value
+
+    def load_archive(
+        self,
+        signal: str,
+        geo_type: str,
+        months: Optional[List[str]] = None,
+        as_of: Optional[int] = None,
+        columns: Optional[List[str]] = None
+    ) -> pd.DataFrame:
+        """
+        Load the archived values of a signal, as they were at some issue.
+
+        Parameters
+        ----------
+        signal: str
+            The signal to load.
+        geo_type: str
+            The geo type to load.
+        months: Optional[List[str]]
+            The months (YYYYMM) of the time values to load. Loads all months if None.
+        as_of: Optional[int]
+            The last issue (YYYYMMDD) to load, to read the archive as it was then. Loads
+            all issues if None.
+        columns: Optional[List[str]]
+            Columns to load besides time_value, geo_id and issue. Loads all if None.
+
+        Returns
+        -------
+        df: pd.DataFrame
+            The latest issue of every (time_value, geo_id), with columns time_value, geo_id,
+            val, se, sample_size (or columns) and issue.
+        """
+        # pylint: disable=import-outside-toplevel
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+
+        if columns is None:
+            columns = ["val", "se", "sample_size"]
+        columns = ["time_value", "geo_id"] + columns + ["issue"]
+        signal_dir = join(self.cache_dir, f"signal={signal}", f"geo_type={geo_type}")
+        if not isdir(signal_dir):
+            return pd.DataFrame({col: [] for col in columns})
+
+        row_filter = ds.scalar(True)
+        if months is not None:
+            row_filter &= ds.field("month").isin(months)
+        if as_of is not None:
+            row_filter &= ds.field("issue") <= as_of
+        # Partitioning below the directory of a signal and geo type
+        partitioning = ds.partitioning(pa.schema([("month", pa.string())]), flavor="hive")
+        dataset = ds.dataset(signal_dir, format="parquet", partitioning=partitioning)
+        df = dataset.to_table(columns=columns, filter=row_filter).to_pandas()
+
+        return (df.sort_values("issue", kind="stable")
+                .drop_duplicates(["time_value", "geo_id"], keep="last")
+                .sort_values(["time_value", "geo_id"])
+                .reset_index(drop=True))
+
+    def archived_time_values(self, signal: str, geo_type: str) -> Set[str]:
+        """
+        The time values archived for a signal and geo type, from their index. An index that
+        is missing, e.g. in a dataset archived before there were indices, is built from the
+        archive and saved.
+
+        Parameters
+        ----------
+        signal: str
+            The signal to look up.
+        geo_type: str
+            The geo type to look up.
+
+        Returns
+        -------
+            The archived time values, as YYYYMMDD strings.
+        """
+        signal_dir = join(self.cache_dir, f"signal={signal}", f"geo_type={geo_type}")
+        index_file = join(signal_dir, TIME_VALUES_FILENAME)
+        if isfile(index_file):
+            with open(index_file, "r") as f:
+                return set(json.load(f))
+        if not isdir(signal_dir):
+            return set()
+        time_values = set(self.load_archive(signal, geo_type, columns=[])["time_value"])
+        self._save_time_values(signal_dir, time_values)
+        return time_values
+
+    @staticmethod
+    def _save_time_values(signal_dir: str, time_values: Set[str]):
+        """Atomically replace the index of archived time values of signal_dir."""
+        index_file = join(signal_dir, TIME_VALUES_FILENAME)
+        with open(index_file + ".tmp", "w") as f:
+            json.dump(sorted(time_values), f)
+        replace(index_file + ".tmp", index_file)
+
+    def update_cache(self):
+        """
+        The Parquet dataset is the cache, so there is nothing to update it from.
+        """
+        makedirs(self.cache_dir, exist_ok=True)
+        self._cache_updated = True
+
+    def export_diffs(self, exports: Iterable[Tuple[str, pd.DataFrame]]) -> Tuple[Files, Files]:
+        """
+        Not supported: cache_dir holds the Parquet dataset, not CSV files. Export the
+        files, then run the differ.
+        """
+        raise NotImplementedError(
+            "ParquetArchiveDiffer does not support export_diffs(), use run() on the exports")
+
+    def diff_exports(
+        self,
+        n_workers: int = 1,
+        use_processes: bool = False
+    ) -> Tuple[Files, FileDiffMap, Files]:
+        """
+        Same as base class diff_exports, but all exports are diffed at once against the
+        archive, with one anti-join of their rows. n_workers and use_processes are unused.
+        deleted_files are the archived files of the exported signals and geo types that
+        are not exported, as paths in cache_dir.
+        """
+        assert self._cache_updated
+
+        exported_files = sorted(glob(join(self.export_dir, "*.csv")))
+        exports = []
+        for exported_file in exported_files:
+            export_df = pd.read_csv(exported_file, dtype=EXPORT_CSV_DTYPES)
+            signal, geo_type, time_value = self.parse_filename(exported_file)
+            exports.append(export_df.assign(
+                signal=signal, geo_type=geo_type, time_value=time_value,
+                file=exported_file))
+        exports = pd.concat(exports, ignore_index=True) if exports else pd.DataFrame(
+            columns=self.KEYS + ["val", "se", "sample_size", "file"])
+
+        # Load the archive for the exported signals, geo types and months
+        archived = []
+        deleted_files = []
+        for (signal, geo_type), group in exports.groupby(["signal", "geo_type"]):
+            exported_time_values = set(group["time_value"])
+            archived_time_values = self.archived_time_values(signal, geo_type)
+            deleted_files += [
+                join(self.cache_dir, f"{time_value}_{geo_type}_{signal}.csv")
+                for time_value in archived_time_values - exported_time_values]
+            months = sorted(set(t[:6] for t in exported_time_values))
+            group_archived = self.load_archive(signal, geo_type, months)
+            archived.append(group_archived[
+                group_archived["time_value"].isin(exported_time_values)
+            ].assign(signal=signal, geo_type=geo_type))
+        archived = pd.concat(archived, ignore_index=True) if archived else pd.DataFrame(
+            columns=self.KEYS + ["val", "se", "sample_size", "issue"])
+        archived_files = set(zip(
+            archived["signal"], archived["geo_type"], archived["time_value"]))
+
+        # Anti-join the exports and the archive
+        merged = exports.merge(
+            archived.drop(columns="issue"), on=self.KEYS, how="outer",
+            suffixes=("", "_before"), indicator=True)
+        value_cols = ["val", "se", "sample_size"]
+        after = merged[value_cols].values
+        before = merged[[f"{col}_before" for col in value_cols]].values
+        same = ((after == before) | (pd.isna(after) & pd.isna(before))).all(axis=1)
+        merged["added"] = (merged["_merge"] == "left_only").values
+        merged["changed"] = ((merged["_merge"] == "both") & ~same).values
+
+        common_diffs: Dict[str, Optional[str]] = {}
+        new_files = []
+        self._archive_rows = {}
+        issues = merged[merged["added"] | merged["changed"]]
+        issue_groups = dict(iter(issues.groupby("file"))) if len(issues) > 0 else {}
+        deleted_counts = merged.loc[merged["_merge"] == "right_only"].groupby(
+            ["signal", "geo_type", "time_value"]).size()
+        for exported_file in exported_files:
+            if self.parse_filename(exported_file) not in archived_files:
+                new_files.append(exported_file)
+                self._archive_rows[exported_file] = None
+                continue
+
+            if self.parse_filename(exported_file) in deleted_counts.index:
+                print(
+                    f"Warning, diff has deleted indices in {exported_file} that will be ignored")
+
+            common_diffs[exported_file] = None
+            if exported_file not in issue_groups:
+                continue
+
+            # As in diff_export_csv, changed rows then added rows, each by geo_id
+            file_issues = issue_groups[exported_file].sort_values(
+                ["added", "geo_id"], kind="stable")
+            new_issues_df = file_issues.set_index("geo_id")[value_cols]
+            diff_file = exported_file + ".diff"
+            new_issues_df.to_csv(diff_file, na_rep="NA")
+            common_diffs[exported_file] = diff_file
+            self._archive_rows[exported_file] = new_issues_df.reset_index()
+
+        return sorted(deleted_files), common_diffs, new_files
+
+    def archive_exports(self, exported_files: Files) -> Tuple[Files, Files]:
+        """
+        Handles actual archiving of files to the Parquet dataset.
+        Files diffed by the last diff_exports() only have their added and changed rows
+        archived, others have all their rows archived.
+
+        Parameters
+        ----------
+        exported_files: Files
+            List of files to be archived. Usually new and changed files.
+
+        Returns
+        -------
+        (successes, fails): Tuple[Files, Files]
+            successes: List of successfully archived files
+            fails: List of unsuccessfully archived files
+        """
+        # pylint: disable=import-outside-toplevel
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        archive_success = []
+        archive_fail = []
+
+        rows = []
+        for exported_file in exported_files:
+            try:
+                file_rows = self._archive_rows.get(exported_file)
+                if file_rows is None:
+                    file_rows = pd.read_csv(exported_file, dtype=EXPORT_CSV_DTYPES)
+            except FileNotFoundError:
+                archive_fail.append(exported_file)
+                continue
+            signal, geo_type, time_value = self.parse_filename(exported_file)
+            rows.append(file_rows[list(EXPORT_CSV_DTYPES.keys())].assign(
+                signal=signal, geo_type=geo_type, time_value=time_value))
+            archive_success.append(exported_file)
+
+        if rows:
+            rows = pd.concat(rows, ignore_index=True)
+            rows["month"] = rows["time_value"].str[:6]
+            rows["issue"] = self.issue
+            for (signal, geo_type), signal_rows in rows.groupby(["signal", "geo_type"]):
+                signal_dir = join(self.cache_dir, f"signal={signal}", f"geo_type={geo_type}")
+                # Read (or build) the index before adding partitions
+                time_values = self.archived_time_values(signal, geo_type)
+                for month, partition in signal_rows.groupby("month"):
+                    partition_dir = join(signal_dir, f"month={month}")
+                    makedirs(partition_dir, exist_ok=True)
+                    part_file = join(partition_dir, f"{self.issue}-{uuid4().hex}.parquet")
+                    table = pa.Table.from_pandas(
+                        partition[["time_value", "geo_id", "val", "se", "sample_size", "issue"]],
+                        preserve_index=False)
+                    pq.write_table(table, part_file + ".tmp")
+                    replace(part_file + ".tmp", part_file)
+                self._save_time_values(signal_dir, time_values | set(signal_rows["time_value"]))
+
+        self._exports_archived = True
+
+        return archive_success, archive_fail
+
 
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("--archive_type", required=True, type=str,
-                        choices=["git", "s3"],
+                        choices=["git", "s3", "local", "parquet"],
                         help="Type of archive differ to use.")
     parser.add_argument("--indicator_prefix", type=str, default="",
                         help="The prefix for S3 keys related to this indicator."
@@ -584,6 +1672,20 @@ if __name__ == "__main__":
                         "staged due to `override_dirty` = False.")
     parser.add_argument("--commit_message", type=str, default="",
                         help="Commit message for `archive_type` = 'git'")
+    parser.add_argument("--no_checkout", action="store_true",
+                        help="Whether to archive into the git branch without checking it "
+                        "out, for `archive_type` = 'git'.")
+    parser.add_argument("--hardlink", action="store_true",
+                        help="Whether to hardlink archived files instead of copying them, "
+                        "for `archive_type` = 'local'. Exports must then never be "
+                        "rewritten in place.")
+    parser.add_argument("--max_transfers", type=int, default=8,
+                        help="Maximum number of concurrent S3 transfers for "
+                        "`archive_type` = 's3'.")
+    parser.add_argument("--n_workers", type=int, default=1,
+                        help="Number of export files to diff concurrently.")
+    parser.add_argument("--use_processes", action="store_true",
+                        help="Whether to diff export files in processes instead of threads.")
     args = parser.parse_args()
     params = read_params()
     run_module(args.archive_type,
@@ -591,9 +1693,14 @@ if __name__ == "__main__":
                params.export_dir,
                aws_credentials=params.aws_credentials,
                branch_name=args.branch_name,
+               checkout_branch=not args.no_checkout,
                bucket_name=params.bucket_name,
                commit_message=args.commit_message,
                commit_partial_success=args.commit_partial_success,
+               hardlink=args.hardlink,
                indicator_prefix=args.indicator_prefix,
-               override_dirty=args.override_dirty
+               max_transfers=args.max_transfers,
+               n_workers=args.n_workers,
+               override_dirty=args.override_dirty,
+               use_processes=args.use_processes
                )
@@ -0,0 +1,188 @@
+"""Compiled binary store for the GeoMapper crosswalk tables.
+
+The crosswalk CSVs in delphi_utils/data are small, but parsing them with pd.read_csv is
+slow relative to how often indicators need them. This module compiles the tables once
+into a directory of plain NumPy arrays that can be memory-mapped back in:
+- every geocode column is stored as integer codes into a sorted vocabulary shared by all
+  tables that have a column of the same name (e.g. all "fips" columns share one vocab),
+  in the smallest integer dtype that pandas uses for Categorical codes of that many
+  categories, so that Categoricals can be built on the codes without converting them,
+- weight columns are stored as float32,
+- all other numeric columns (e.g. pop) are stored with their native dtype.
+
+Store layout:
+    <store_dir>/index.json                  version, and the columns of each table
+    <store_dir>/vocab/<column>.npy          sorted unique ids for a geocode column
+    <store_dir>/<from>_<to>/<column>.npy    one array per table column
+
+Since the arrays are memory-mapped read-only, and tables are built on them without
+copying, processes that load the same store share the underlying pages through the OS
+page cache. Tables read with string geocodes are decoded into new object arrays on every
+load, so only their numeric columns stay shared; read them as Categoricals of the codes
+to share those too.
+"""
+
+import json
+from os import makedirs
+from os.path import join, isfile
+from typing import Dict, Tuple
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_string_dtype
+
+STORE_VERSION = 2
+INDEX_FILENAME = "index.json"
+VOCAB_DIR = "vocab"
+WEIGHT_DTYPE = np.float32
+
+Tables = Dict[Tuple[str, str], pd.DataFrame]
+
+# Categorical dtypes of the geocode vocabularies, keyed by (store_dir, column), so that
+# their categories are validated once per process and shared by all categorical tables
+_CATEGORIES_CACHE = {}
+
+
+def _table_dir(store_dir: str, from_code: str, to_code: str) -> str:
+    return join(store_dir, f"{from_code}_{to_code}")
+
+
+def _code_dtype(n_categories: int) -> np.dtype:
+    """Dtype of the codes of a pd.Categorical with n_categories categories."""
+    for dtype in (np.int8, np.int16, np.int32):
+        if n_categories < np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def write_crosswalk_store(tables: Tables, store_dir: str):
+    """Compile crosswalk tables into a binary store.
+
+    Parameters
+    ----------
+    tables: Dict[Tuple[str, str], pd.DataFrame]
+        Crosswalk tables keyed by (from_code, to_code), as loaded by GeoMapper.
+    store_dir: str
+        Directory to write the store to. Existing files are overwritten.
+    """
+    # Build one vocabulary per geocode column name across all tables
+    vocabs = {}
+    for table in tables.values():
+        for col in table.columns:
+            if is_string_dtype(table[col]):
+                vocabs.setdefault(col, set()).update(table[col].unique())
+    vocabs = {col: np.array(sorted(ids), dtype=str) for col, ids in vocabs.items()}
+
+    makedirs(join(store_dir, VOCAB_DIR), exist_ok=True)
+    for col, vocab in vocabs.items():
+        np.save(join(store_dir, VOCAB_DIR, f"{col}.npy"), vocab)
+
+    index = {"version": STORE_VERSION, "tables": {}}
+    for (from_code, to_code), table in tables.items():
+        table_dir = _table_dir(store_dir, from_code, to_code)
+        makedirs(table_dir, exist_ok=True)
+        for col in table.columns:
+            if col in vocabs:
+                values = np.searchsorted(vocabs[col], table[col].values).astype(
+                    _code_dtype(len(vocabs[col]))
+                )
+            elif col == "weight":
+                values = table[col].values.astype(WEIGHT_DTYPE)
+            else:
+                values = table[col].values
+            np.save(join(table_dir, f"{col}.npy"), values)
+        index["tables"][f"{from_code}_{to_code}"] = list(table.columns)
+
+    with open(join(store_dir, INDEX_FILENAME), "w") as index_file:
+        json.dump(index, index_file, indent=2)
+
+
+def is_crosswalk_store(store_dir: str) -> bool:
+    """Check that store_dir contains a store of the current version."""
+    index_file = join(store_dir, INDEX_FILENAME)
+    if not isfile(index_file):
+        return False
+    with open(index_file, "r") as f:
+        return json.load(f)["version"] == STORE_VERSION
+
+
+def read_vocabulary(store_dir: str, column: str) -> np.ndarray:
+    """Load the sorted vocabulary of ids for a geocode column."""
+    return np.load(join(store_dir, VOCAB_DIR, f"{column}.npy"))
+
+
+def read_categories(store_dir: str, column: str) -> pd.CategoricalDtype:
+    """Categorical dtype of a geocode column, with its vocabulary as categories."""
+    key = (store_dir, column)
+    if key not in _CATEGORIES_CACHE:
+        _CATEGORIES_CACHE[key] = pd.CategoricalDtype(
+            read_vocabulary(store_dir, column).astype(object)
+        )
+    return _CATEGORIES_CACHE[key]
+
+
+def read_crosswalk_arrays(
+    store_dir: str, from_code: str, to_code: str, mmap: bool = True
+) -> Dict[str, np.ndarray]:
+    """Load the raw (still integer-coded) columns of a crosswalk table.
+
+    Parameters
+    ----------
+    store_dir: str
+        Directory of a store written by write_crosswalk_store.
+    from_code, to_code: str
+        Keys of the crosswalk table, as in GeoMapper.crosswalks.
+    mmap: bool, default True
+        Whether to memory-map the arrays read-only instead of reading them into memory.
+
+    Returns
+    -------
+    Dict[str, np.ndarray]
+        Mapping of column name to array, in the column order of the original table.
+    """
+    with open(join(store_dir, INDEX_FILENAME), "r") as f:
+        columns = json.load(f)["tables"][f"{from_code}_{to_code}"]
+    table_dir = _table_dir(store_dir, from_code, to_code)
+    mmap_mode = "r" if mmap else None
+    return {
+        col: np.load(join(table_dir, f"{col}.npy"), mmap_mode=mmap_mode)
+        for col in columns
+    }
+
+
+def read_crosswalk_table(
+    store_dir: str, from_code: str, to_code: str, categorical: bool = False
+) -> pd.DataFrame:
+    """Load a crosswalk table from the store.
+
+    The result has the same columns as the CSV table, except that weights are float32.
+    Its numeric columns, and the codes of its categorical columns, are the memory-mapped
+    arrays of the store rather than copies, so they are read-only.
+
+    Parameters
+    ----------
+    store_dir: str
+        Directory of a store written by write_crosswalk_store.
+    from_code, to_code: str
+        Keys of the crosswalk table, as in GeoMapper.crosswalks.
+    categorical: bool, default False
+        Whether to return the geocode columns as Categoricals of their stored codes, with
+        the vocabulary of the column as categories, instead of decoding them into object
+        columns of strings. Decoding allocates a string per row on every load, while
+        the categories are read once per process and column (see read_categories).
+    """
+    arrays = read_crosswalk_arrays(store_dir, from_code, to_code)
+    data = {}
+    for col, values in arrays.items():
+        if np.issubdtype(values.dtype, np.integer) and isfile(
+            join(store_dir, VOCAB_DIR, f"{col}.npy")
+        ):
+            if categorical:
+                data[col] = pd.Categorical.from_codes(
+                    values, dtype=read_categories(store_dir, col)
+                )
+            else:
+                data[col] = read_vocabulary(store_dir, col)[values].astype(object)
+        else:
+            data[col] = np.asarray(values)
+    return pd.DataFrame(data, copy=False)
@@ -1,9 +1,45 @@
 # -*- coding: utf-8 -*-
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import logging
 from os.path import join
+from typing import Iterator, List, Sequence, Tuple
 
+import numpy as np
 import pandas as pd
 
+from .archive import ArchiveDiffer
+
+def _export_frames(
+    df: pd.DataFrame,
+    start_date: datetime,
+    metric: str,
+    geo_res: str,
+    sensor: str,
+) -> Iterator[Tuple[str, pd.DataFrame]]:
+    """Split data into (export filename, export) pairs, one per date from start_date.
+
+    The rows are sorted by date once, keeping their order within each date, so each export
+    is a contiguous slice instead of a scan of all rows.
+    """
+    timestamps = pd.to_datetime(df["timestamp"])
+    after_start = (timestamps >= start_date).values
+    if not after_start.any():
+        return
+    df = df.loc[after_start, ["geo_id", "val", "se", "sample_size"]]
+    timestamps = timestamps[after_start]
+
+    order = np.argsort(timestamps.values, kind="stable")
+    df = df.iloc[order]
+    timestamps = timestamps.iloc[order]
+    values = timestamps.values
+    # Start of the rows of each date, and end of the rows of the last one
+    bounds = np.append(np.flatnonzero(np.r_[True, values[1:] != values[:-1]]), len(df))
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        date = timestamps.iloc[start]
+        export_fn = f'{date.strftime("%Y%m%d")}_{geo_res}_' f"{metric}_{sensor}.csv"
+        yield export_fn, df.iloc[start:end]
+
 def create_export_csv(
     df: pd.DataFrame,
     start_date: datetime,
@@ -11,6 +47,7 @@ def create_export_csv(
     metric: str,
     geo_res: str,
     sensor: str,
+    n_workers: int = 1,
 ):
     """Export data in the format expected by the Delphi API.
 
@@ -26,15 +63,152 @@ def create_export_csv(
         Geographic resolution to which the data has been aggregated
     sensor: str
         Sensor that has been calculated (cumulative_counts vs new_counts)
+    n_workers: int
+        Number of files to write concurrently, in threads. Writes files one at a time if 1.
     """
-    df = df.copy()
-    df["timestamp"] = pd.to_datetime(df["timestamp"])
-    dates = pd.Series(
-        df[df["timestamp"] >= start_date]["timestamp"].unique()
-    ).sort_values()
-    for date in dates:
-        export_fn = f'{date.strftime("%Y%m%d")}_{geo_res}_' f"{metric}_{sensor}.csv"
-        export_file = join(export_dir, export_fn)
-        df[df["timestamp"] == date][["geo_id", "val", "se", "sample_size",]].to_csv(
-            export_file, index=False, na_rep="NA"
-        )
+    def write(export):
+        export_fn, export_df = export
+        export_df.to_csv(join(export_dir, export_fn), index=False, na_rep="NA")
+
+    exports = _export_frames(df, start_date, metric, geo_res, sensor)
+    if n_workers == 1:
+        for export in exports:
+            write(export)
+    else:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            # Consume the results, to raise any exception from the writes
+            list(executor.map(write, exports))
+
+def create_export_csv_diffs(
+    df: pd.DataFrame,
+    start_date: datetime,
+    arch_diff: ArchiveDiffer,
+    metric: str,
+    geo_res: str,
+    sensor: str,
+) -> Tuple[List[str], List[str]]:
+    """Export data in the format expected by the Delphi API, as diffs against the archive.
+
+    Same as create_export_csv, but each export is diffed in memory against its cached
+    version, and only the new and changed rows are written to arch_diff.export_dir,
+    while the cache is updated. See ArchiveDiffer.export_diffs.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        Columns: geo_id, timestamp, val, se, sample_size
+    arch_diff: ArchiveDiffer
+        Archive differ whose cache is up to date (after arch_diff.update_cache())
+    metric: str
+        Metric we are considering
+    geo_res: str
+        Geographic resolution to which the data has been aggregated
+    sensor: str
+        Sensor that has been calculated (cumulative_counts vs new_counts)
+
+    Returns
+    -------
+    (export_files, cached_files): Tuple[List[str], List[str]]
+        The diff files written to the export directory, and the updated cache files to
+        archive.
+    """
+    return arch_diff.export_diffs(_export_frames(df, start_date, metric, geo_res, sensor))
+
+def _assert_valid(invalid: np.ndarray, geo_ids: np.ndarray, dates: Sequence, message: str):
+    """Raise an AssertionError naming the first (geo_id, date) flagged as invalid."""
+    if invalid.any():
+        geo_index, date_index = np.argwhere(invalid)[0]
+        raise AssertionError(f"{message}, {geo_ids[geo_index]} on {dates[date_index]}")
+
+def write_sensor_csvs(
+    output_path: str,
+    geo_level: str,
+    signal_name: str,
+    dates: Sequence[datetime],
+    geo_ids: Sequence,
+    rates: np.ndarray,
+    se: np.ndarray,
+    include: np.ndarray,
+    write_se: bool = False,
+    n_workers: int = 1,
+) -> int:
+    """Write sensor values to one CSV per date, in the format expected by the Delphi API.
+
+    The included values are checked all at once before any file is written: they must not
+    be NaN, their standard errors must be below 5, and both must be positive if the
+    standard errors are written. The rows of all files are then formatted at once, with
+    columns geo_id, val (formatted as "%f"), se, direction and sample_size.
+
+    Parameters
+    ----------
+    output_path: str
+        Export directory
+    geo_level: str
+        Geographic resolution of the values
+    signal_name: str
+        Name of the signal, used in the filenames
+    dates: Sequence[datetime]
+        Dates of the files, as written in their names
+    geo_ids: Sequence
+        Geographic ids of the values
+    rates: np.ndarray
+        Values, of shape (len(geo_ids), len(dates))
+    se: np.ndarray
+        Standard errors of the values, of the same shape
+    include: np.ndarray
+        Booleans of the same shape, of whether to write each value
+    write_se: bool
+        Whether to write the standard errors, instead of "NA" for privacy
+    n_workers: int
+        Number of files to write concurrently, in threads. Writes files one at a time if 1.
+
+    Returns
+    -------
+    int
+        The number of rows written
+    """
+    geo_ids = np.asarray(geo_ids)
+    rates = np.asarray(rates, dtype=float)
+    se = np.asarray(se, dtype=float)
+    include = np.asarray(include, dtype=bool)
+
+    _assert_valid(include & np.isnan(rates), geo_ids, dates, "value for included sensor is nan")
+    _assert_valid(include & np.isnan(se), geo_ids, dates, "se for included sensor is nan")
+    for geo_index, date_index in np.argwhere(include & (rates > 90)):
+        logging.warning("value suspiciously high, %s: %s",
+                        geo_ids[geo_index], rates[geo_index, date_index])
+    _assert_valid(include & (se >= 5), geo_ids, dates, "se suspiciously high")
+    if write_se:
+        _assert_valid(include & ((rates <= 0) | (se <= 0)), geo_ids, dates,
+                      "p=0, std_err=0 invalid")
+
+    # Format the rows of all files at once, ordered by date then geo_id, with vals formatted
+    # as "%f" and standard errors as their shortest repr, as "%s" does
+    date_indices, geo_indices = np.nonzero(include.T)
+    geo_strs = np.array([str(geo_id) for geo_id in geo_ids], dtype=object)
+    val_strs = np.array(["%f" % val for val in rates[geo_indices, date_indices].tolist()],
+                        dtype=object)
+    if write_se:
+        se_strs = np.array([repr(val) for val in se[geo_indices, date_indices].tolist()],
+                           dtype=object)
+    else:
+        # for privacy reasons we will not report the standard error
+        se_strs = "NA"
+    lines = geo_strs[geo_indices] + "," + val_strs + "," + se_strs + ",NA,NA\n"
+    # Start of the rows of each date, and end of the rows of the last one
+    bounds = np.searchsorted(date_indices, np.arange(len(dates) + 1))
+
+    def write(date_index):
+        filename = f"{dates[date_index].strftime('%Y%m%d')}_{geo_level}_{signal_name}.csv"
+        with open(join(output_path, filename), "w") as outfile:
+            outfile.write("geo_id,val,se,direction,sample_size\n")
+            outfile.write("".join(lines[bounds[date_index]:bounds[date_index + 1]]))
+
+    if n_workers == 1:
+        for date_index in range(len(dates)):
+            write(date_index)
+    else:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            list(executor.map(write, range(len(dates))))
+
+    return len(lines)
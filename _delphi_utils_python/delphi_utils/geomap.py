@@ -4,8 +4,6 @@ Authors: Dmitry Shemetov @dshemetov, James Sharpnack @jsharpna, Maria Jahja
 Created: 2020-06-01
 
 TODO:
-- use a caching utility to store the crossfiles
-  see: https://github.com/cmu-delphi/covidcast-indicators/issues/282
 - remove deprecated functions once integration into JHU and Quidel is refactored
   see: https://github.com/cmu-delphi/covidcast-indicators/issues/283
 """
@@ -14,8 +12,17 @@ from os.path import join
 import warnings
 import pkg_resources
 
+import numpy as np
 import pandas as pd
-from pandas.api.types import is_string_dtype
+from pandas.api.types import is_categorical_dtype, is_integer_dtype, is_string_dtype
+from scipy import sparse
+
+from .crosswalk_store import (
+    is_crosswalk_store,
+    read_categories,
+    read_crosswalk_table,
+    write_crosswalk_store,
+)
 
 DATA_PATH = "data"
 CROSSWALK_FILEPATHS = {
@@ -39,6 +46,30 @@ CROSSWALK_FILEPATHS = {
     },
     "jhu_uid": {"fips": join(DATA_PATH, "jhu_uid_fips_table.csv")},
 }
+STATE_DTYPES = {"state_code": str, "state_id": str, "state_name": str}
+CROSSWALK_DTYPES = {
+    # Weighted crosswalks
+    ("zip", "fips"): {"zip": str, "fips": str, "weight": float},
+    ("fips", "zip"): {"fips": str, "zip": str, "weight": float},
+    ("jhu_uid", "fips"): {"jhu_uid": str, "fips": str, "weight": float},
+    ("zip", "msa"): {"zip": str, "msa": str, "weight": float},
+    ("fips", "hrr"): {"fips": str, "hrr": str, "weight": float},
+    # Unweighted crosswalks
+    ("zip", "hrr"): {"zip": str, "hrr": str},
+    ("fips", "msa"): {"fips": str, "msa": str},
+    # Special table of state codes, state IDs, and state names
+    ("state", "state"): STATE_DTYPES,
+    ("state_code", "hhs_region_number"): {"state_code": str, "hhs_region_number": str},
+    ("zip", "state"): {"zip": str, "weight": float, **STATE_DTYPES},
+    ("fips", "state"): {"fips": str, **STATE_DTYPES},
+    # Population tables
+    ("fips", "pop"): {"fips": str, "pop": int},
+    ("zip", "pop"): {"zip": str, "pop": int},
+}
+
+# Crosswalk tables shared by all GeoMapper instances in the process, keyed by
+# (crosswalk_store, from_code, to_code). Treat the cached tables as read-only.
+_CROSSWALK_CACHE = {}
 
 
 class GeoMapper:
@@ -65,6 +96,7 @@ class GeoMapper:
     - [x] fips -> megacounty
     - [x] fips -> hrr
     - [x] nation
+    - [x] chains of the above, e.g. jhu_uid -> fips -> hrr : product of weights
     - [ ] zip -> dma (postponed)
 
     The GeoMapper instance loads crosswalk tables from the package data_dir. The
@@ -93,15 +125,19 @@ class GeoMapper:
                                 date_col="timestamp", dropna=False)
     """
 
-    def __init__(self):
+    def __init__(self, crosswalk_store=None):
         """Initialize geomapper. Holds loading the crosswalk tables
         until a conversion function is first used.
 
         Parameters
         ---------
-        crosswalk_files : dict
-            A dictionary of the filenames for the crosswalk tables.
+        crosswalk_store : str, default None
+            Directory of a compiled crosswalk store (see build_crosswalk_store) to load
+            the tables from. If None, the tables are parsed from the package CSVs.
         """
+        if crosswalk_store is not None and not is_crosswalk_store(crosswalk_store):
+            raise ValueError(f"No crosswalk store found in '{crosswalk_store}'.")
+        self.crosswalk_store = crosswalk_store
         self.crosswalk_filepaths = CROSSWALK_FILEPATHS
         self.crosswalks = {
             "zip": {"fips": None, "hrr": None, "msa": None, "pop": None, "state": None},
@@ -113,82 +149,367 @@ class GeoMapper:
 
     # Utility functions
     def _load_crosswalk(self, from_code, to_code):
-        """Loads the crosswalk from from_code -> to_code."""
-        stream = pkg_resources.resource_stream(
-            __name__, self.crosswalk_filepaths[from_code][to_code]
-        )
+        """Loads the crosswalk from from_code -> to_code.
+
+        Tables are parsed at most once per process and store: later calls, from this or
+        any other GeoMapper instance (including forked workers), reuse the cached table.
+        """
         if self.crosswalks[from_code][to_code] is None:
-            # Weighted crosswalks
-            if (from_code, to_code) in [
-                ("zip", "fips"),
-                ("fips", "zip"),
-                ("jhu_uid", "fips"),
-                ("zip", "msa"),
-                ("fips", "hrr"),
-            ]:
-                self.crosswalks[from_code][to_code] = pd.read_csv(
-                    stream,
-                    dtype={
-                        from_code: str,
-                        to_code: str,
-                        "weight": float,
-                    },
-                )
-            # Unweighted crosswalks
-            elif (from_code, to_code) in [
-                ("zip", "hrr"),
-                ("fips", "msa"),
-            ]:
-                self.crosswalks[from_code][to_code] = pd.read_csv(
-                    stream,
-                    dtype={from_code: str, to_code: str},
-                )
-            # Special table of state codes, state IDs, and state names
-            elif (from_code, to_code) == ("state", "state"):
-                self.crosswalks[from_code][to_code] = pd.read_csv(
-                    stream,
-                    dtype={
-                        "state_code": str,
-                        "state_id": str,
-                        "state_name": str,
-                    },
-                )
-            elif (from_code, to_code) == ("state_code", "hhs_region_number"):
-                self.crosswalks[from_code][to_code] = pd.read_csv(
-                    stream,
-                    dtype={"state_code": str, "hhs_region_number": str},
-                )
-            elif (from_code, to_code) == ("zip", "state"):
-                self.crosswalks[from_code][to_code] = pd.read_csv(
-                    stream,
-                    dtype={
-                        "zip": str,
-                        "weight": float,
-                        "state_code": str,
-                        "state_id": str,
-                        "state_name": str,
-                    },
+            key = (self.crosswalk_store, from_code, to_code)
+            if key not in _CROSSWALK_CACHE:
+                if self.crosswalk_store is None:
+                    stream = pkg_resources.resource_stream(
+                        __name__, self.crosswalk_filepaths[from_code][to_code]
+                    )
+                    _CROSSWALK_CACHE[key] = pd.read_csv(
+                        stream, dtype=CROSSWALK_DTYPES[(from_code, to_code)]
+                    )
+                else:
+                    _CROSSWALK_CACHE[key] = read_crosswalk_table(
+                        self.crosswalk_store, from_code, to_code
+                    )
+            self.crosswalks[from_code][to_code] = _CROSSWALK_CACHE[key]
+        return self.crosswalks[from_code][to_code]
+
+    def build_crosswalk_store(self, store_dir):
+        """Compile all the crosswalk tables into a binary store in store_dir.
+
+        The store can then be passed to GeoMapper(crosswalk_store=store_dir). See
+        delphi_utils.crosswalk_store for the format.
+        """
+        tables = {
+            (from_code, to_code): self._load_crosswalk(from_code, to_code)
+            for from_code, to_codes in self.crosswalk_filepaths.items()
+            for to_code in to_codes
+            if (from_code, to_code) in CROSSWALK_DTYPES
+        }
+        write_crosswalk_store(tables, store_dir)
+
+    @staticmethod
+    def _direct_crosswalk_key(from_code, new_code):
+        """Key of the table with a direct from_code -> new_code mapping, or None."""
+        state_codes = ["state_code", "state_id", "state_name"]
+        # state codes are all stored in one table
+        if from_code in state_codes and new_code in state_codes:
+            key = ("state", "state") if from_code != new_code else None
+        elif new_code in state_codes:
+            key = (from_code, "state")
+        elif new_code != "pop":
+            key = (from_code, new_code)
+        else:
+            key = None
+        return key if key in CROSSWALK_DTYPES else None
+
+    @staticmethod
+    def plan_conversion(from_code, new_code):
+        """Finds the shortest chain of crosswalk tables from from_code to new_code.
+
+        Return
+        ---------
+        path: list of str
+            The geocodes along the chain, starting with from_code and ending with
+            new_code. None if new_code can not be reached.
+        """
+        geocodes = sorted(
+            {code for dtypes in CROSSWALK_DTYPES.values() for code in dtypes}
+            - {"weight", "pop"}
+        )
+        paths = {from_code: [from_code]}
+        queue = [from_code]
+        while queue and new_code not in paths:
+            code = queue.pop(0)
+            for next_code in geocodes:
+                if next_code not in paths and GeoMapper._direct_crosswalk_key(
+                    code, next_code
+                ):
+                    paths[next_code] = paths[code] + [next_code]
+                    queue.append(next_code)
+        return paths.get(new_code)
+
+    def _get_crosswalk(self, from_code, new_code):
+        """Loads the crosswalk table holding the from_code -> new_code mapping.
+
+        If there is no table with a direct mapping, the crosswalks along the path found by
+        plan_conversion are composed into a table with columns from_code, new_code and
+        weight, the product of the weights along the path, and cached.
+        """
+        key = self._direct_crosswalk_key(from_code, new_code)
+        if key is not None:
+            return self._load_crosswalk(from_code=key[0], to_code=key[1])
+
+        if from_code == new_code:
+            raise ValueError(f"There is no crosswalk from {from_code} to itself.")
+
+        cache_key = (self.crosswalk_store, "composed", from_code, new_code)
+        if cache_key not in _CROSSWALK_CACHE:
+            path = self.plan_conversion(from_code, new_code)
+            if path is None:
+                raise ValueError(
+                    f"There is no crosswalk path from {from_code} to {new_code}."
                 )
-            elif (from_code, to_code) == ("fips", "state"):
-                self.crosswalks[from_code][to_code] = pd.read_csv(
-                    stream,
-                    dtype={
-                        "fips": str,
-                        "state_code": str,
-                        "state_id": str,
-                        "state_name": str,
-                    },
+            crosswalk = None
+            for hop_from, hop_to in zip(path[:-1], path[1:]):
+                hop = self._get_crosswalk(hop_from, hop_to)
+                hop = hop[[col for col in (hop_from, hop_to, "weight") if col in hop]]
+                if crosswalk is None:
+                    crosswalk = hop
+                    continue
+                crosswalk = crosswalk.merge(hop, on=hop_from, suffixes=("", "_hop"))
+                if "weight_hop" in crosswalk.columns:
+                    crosswalk["weight"] = crosswalk["weight"] * crosswalk["weight_hop"]
+                    crosswalk = crosswalk.drop(columns="weight_hop")
+                crosswalk = crosswalk.drop(columns=hop_from)
+            if "weight" in crosswalk.columns:
+                crosswalk = crosswalk.groupby([from_code, new_code]).sum().reset_index()
+            else:
+                crosswalk = crosswalk.drop_duplicates().reset_index(drop=True)
+            _CROSSWALK_CACHE[cache_key] = crosswalk
+        return _CROSSWALK_CACHE[cache_key]
+
+    def geocode_categories(self, geocode):
+        """Sorted ids of a geocode type across all the crosswalk tables.
+
+        These are the categories of the categorical geocode columns created with
+        add_geocode(..., categorical=True), so that those columns share one dictionary
+        with the crosswalks and with each other. With a crosswalk store, they are the
+        vocabulary of the geocode in the store.
+        """
+        key = (self.crosswalk_store, "categories", geocode)
+        if key not in _CROSSWALK_CACHE:
+            tables = [
+                table for table, dtypes in CROSSWALK_DTYPES.items()
+                if dtypes.get(geocode) is str
+            ]
+            if self.crosswalk_store is not None and tables:
+                _CROSSWALK_CACHE[key] = read_categories(
+                    self.crosswalk_store, geocode
+                ).categories
+            else:
+                ids = set()
+                for from_code, to_code in tables:
+                    crosswalk = self._load_crosswalk(from_code=from_code, to_code=to_code)
+                    ids.update(crosswalk[geocode].unique())
+                _CROSSWALK_CACHE[key] = pd.Index(sorted(ids))
+        return _CROSSWALK_CACHE[key]
+
+    def _categorical_crosswalk(self, from_code, new_code):
+        """Loads the from_code -> new_code crosswalk with categorical geocode columns.
+
+        Direct crosswalks in a crosswalk store are read as the categorical codes that are
+        stored, without decoding their geocodes to strings.
+        """
+        key = (self.crosswalk_store, "categorical", from_code, new_code)
+        if key not in _CROSSWALK_CACHE:
+            direct_key = self._direct_crosswalk_key(from_code, new_code)
+            if self.crosswalk_store is not None and direct_key is not None:
+                crosswalk = read_crosswalk_table(
+                    self.crosswalk_store, *direct_key, categorical=True
                 )
-            # Population tables
-            elif (from_code, to_code) in [("fips", "pop"), ("zip", "pop")]:
-                self.crosswalks[from_code][to_code] = pd.read_csv(
-                    stream,
-                    dtype={
-                        from_code: str,
-                        "pop": int,
-                    },
+            else:
+                crosswalk = self._get_crosswalk(from_code, new_code).copy()
+                for col in crosswalk.columns:
+                    if is_string_dtype(crosswalk[col]):
+                        crosswalk[col] = pd.Categorical(
+                            crosswalk[col], categories=self.geocode_categories(col)
+                        )
+            _CROSSWALK_CACHE[key] = crosswalk
+        return _CROSSWALK_CACHE[key]
+
+    def _to_categorical(self, geocodes, from_code):
+        """Converts a column of geocodes to a Categorical sharing the crosswalk categories.
+
+        Integer FIPS and ZIP codes are matched numerically, so only the ones missing from
+        the crosswalks are formatted as strings; those are appended to the categories.
+        """
+        categories = self.geocode_categories(from_code)
+        if is_categorical_dtype(geocodes):
+            if geocodes.cat.categories.equals(categories):
+                return geocodes
+            geocodes = geocodes.astype(geocodes.cat.categories.dtype)
+
+        if is_integer_dtype(geocodes) and from_code in ["fips", "zip"]:
+            codes = pd.Index(categories.astype(int)).get_indexer(geocodes.values)
+            missing = codes < 0
+            extra = pd.Index(pd.unique(geocodes.values[missing]))
+            extra = extra.astype(str).str.zfill(5)
+        else:
+            geocodes = self._normalize_geocodes(geocodes, from_code)
+            codes = categories.get_indexer(geocodes.values)
+            missing = (codes < 0) & geocodes.notna().values
+            extra = pd.Index(pd.unique(geocodes.values[missing]))
+
+        if len(extra) > 0:
+            categories = categories.append(extra)
+            codes[missing] = categories.get_indexer(
+                self._normalize_geocodes(geocodes[missing], from_code).values
+            )
+        return pd.Series(
+            pd.Categorical.from_codes(codes, categories=categories),
+            index=geocodes.index,
+            name=geocodes.name,
+        )
+
+    def _crosswalk_matrix(self, from_code, new_code, from_values):
+        """Builds the weighted crosswalk as a sparse (new geo x from geo) matrix.
+
+        Parameters
+        ---------
+        from_code: str
+            Geocode type of from_values.
+        new_code: str
+            Geocode type to map to.
+        from_values: pd.Index
+            The from geocodes, in column order of the matrix. Geocodes that are not in the
+            crosswalk get an empty column.
+
+        Return
+        ---------
+        (matrix, new_values): (sparse.csr_matrix, pd.Index)
+            matrix[i, j] is the weight of from_values[j] in new_values[i], new_values
+            are sorted.
+        """
+        if new_code == "nation":
+            new_index = pd.Index(["us"])
+            from_idx = np.arange(len(from_values))
+            new_idx = np.zeros(len(from_values), dtype=int)
+            weights = np.ones(len(from_values))
+        elif new_code == from_code:
+            from_idx = np.arange(len(from_values))
+            new_idx, new_index = pd.factorize(from_values, sort=True)
+            weights = np.ones(len(from_values))
+        else:
+            crosswalk = self._get_crosswalk(from_code, new_code)
+            from_idx = from_values.get_indexer(crosswalk[from_code])
+            crosswalk = crosswalk[from_idx >= 0]
+            from_idx = from_idx[from_idx >= 0]
+            new_idx, new_index = pd.factorize(crosswalk[new_code], sort=True)
+            if "weight" in crosswalk.columns:
+                weights = crosswalk["weight"].values.astype(float)
+            else:
+                weights = np.ones(len(crosswalk))
+        matrix = sparse.csr_matrix(
+            (weights, (new_idx, from_idx)), shape=(len(new_index), len(from_values))
+        )
+        return matrix, pd.Index(new_index)
+
+    @staticmethod
+    def _normalize_geocodes(geocodes, from_code):
+        """Converts a column of geocodes to (zero-padded) strings, if needed."""
+        if is_string_dtype(geocodes):
+            return geocodes
+        if is_categorical_dtype(geocodes) and is_string_dtype(geocodes.cat.categories):
+            return geocodes
+        if from_code in ["fips", "zip"]:
+            return geocodes.astype(str).str.zfill(5)
+        return geocodes.astype(str)
+
+    def _is_weighted(self, from_code, new_code):
+        """Checks whether the from_code -> new_code crosswalk has weights."""
+        if new_code == "nation":
+            if from_code not in ["fips", "zip"]:
+                raise ValueError(
+                    "Conversion to the nation level is only supported from the FIPS "
+                    "and ZIP codes."
                 )
-        return self.crosswalks[from_code][to_code]
+            return False
+        if new_code == from_code:
+            return False
+        return "weight" in self._get_crosswalk(from_code, new_code).columns
+
+    @staticmethod
+    def _build_panel(df, geocodes, date_col, data_cols):
+        """Pivots data_cols into a dense (geo x date) panel per column, side by side.
+
+        NAs are zeroed and duplicated (geo, date) rows are summed.
+
+        Return
+        ---------
+        (geo_values, date_values, panel, present)
+            geo_values and date_values (None if date_col is None) label the panel rows and
+            the columns of each data column block. present marks the (geo, date) pairs in
+            df.
+        """
+        geo_idx, geo_values = pd.factorize(geocodes)
+        if date_col is None:
+            date_idx, date_values = np.zeros(len(df), dtype=int), None
+            n_dates = 1
+        else:
+            date_idx, date_values = pd.factorize(df[date_col], sort=True)
+            n_dates = len(date_values)
+
+        flat_idx = geo_idx * n_dates + date_idx
+        size = len(geo_values) * n_dates
+        panel = np.empty((len(geo_values), n_dates * len(data_cols)))
+        for i, col in enumerate(data_cols):
+            values = df[col].fillna(0).values.astype(float)
+            panel[:, i * n_dates : (i + 1) * n_dates] = np.bincount(
+                flat_idx, weights=values, minlength=size
+            ).reshape(len(geo_values), n_dates)
+        present = np.bincount(flat_idx, minlength=size).reshape(len(geo_values), n_dates)
+        return pd.Index(geo_values), date_values, panel, present > 0
+
+    @staticmethod
+    def _aggregate_panel(
+        panel, matrix, new_values, new_col, date_col, data_cols, int_dtypes=None
+    ):
+        """Aggregates a panel from _build_panel with a crosswalk matrix.
+
+        As in the merge engine of replace_geocode, only the (date, new geo) pairs that
+        some input row maps to are returned, ordered by date and then new geo.
+        int_dtypes maps the data columns to cast back to their integer dtype.
+        """
+        _, date_values, values, present = panel
+        n_dates = present.shape[1]
+        result = matrix @ values
+        structure = matrix.copy()
+        structure.data[:] = 1.0
+        present = (structure @ present.astype(float)) > 0
+
+        date_pos, new_pos = np.nonzero(present.T)
+        out = pd.DataFrame()
+        if date_col is not None:
+            out[date_col] = date_values.take(date_pos)
+        out[new_col] = new_values.take(new_pos).values
+        for i, col in enumerate(data_cols):
+            col_values = result[new_pos, i * n_dates + date_pos]
+            if int_dtypes and col in int_dtypes:
+                col_values = col_values.round().astype(int_dtypes[col])
+            out[col] = col_values
+        return out
+
+    def _replace_geocode_sparse(
+        self, df, from_code, new_codes, from_col, new_col, date_col, data_cols
+    ):
+        """The sparse engine of replace_geocode, for one or more new_codes at once.
+
+        The input is pivoted once into a dense (from geo x date) panel per data column,
+        and each new geocode is then one sparse-dense product against its crosswalk
+        matrix.
+        """
+        geocodes = self._normalize_geocodes(df[from_col], from_code)
+        if data_cols is None:
+            data_cols = [col for col in df.columns if col not in (from_col, date_col)]
+        int_dtypes = {
+            col: df[col].dtype for col in data_cols if is_integer_dtype(df[col])
+        }
+        weighted = {
+            new_code: self._is_weighted(from_code, new_code) for new_code in new_codes
+        }
+
+        panel = self._build_panel(df, geocodes, date_col, data_cols)
+        out = {}
+        for new_code in new_codes:
+            matrix, new_values = self._crosswalk_matrix(from_code, new_code, panel[0])
+            out[new_code] = self._aggregate_panel(
+                panel,
+                matrix,
+                new_values,
+                new_code if new_col is None else new_col,
+                date_col,
+                data_cols,
+                None if weighted[new_code] else int_dtypes,
+            )
+        return out
 
     @staticmethod
     def convert_fips_to_mega(data, fips_col="fips", mega_col="megafips"):
@@ -198,6 +519,37 @@ class GeoMapper:
         data[mega_col] = data[mega_col].str.slice_replace(start=2, stop=5, repl="000")
         return data
 
+    @staticmethod
+    def _megafips(data, thr_count, thr_win_len, thr_col, fips_col, date_col, mega_col):
+        """The megaFIPS of each row of data, see megacounty_creation."""
+        if "_thr_col_roll" in data.columns:
+            raise ValueError("Column name '_thr_col_roll' is reserved.")
+
+        # Build a (fips x day) panel of thr_col, padded with thr_win_len days of zeros on
+        # the left, so the trailing window sums are differences of its cumulative sum.
+        fips_idx, fips_values = pd.factorize(data[fips_col], sort=True)
+        dates = pd.to_datetime(data[date_col])
+        day_idx = ((dates - dates.min()) // pd.Timedelta(days=1)).values.astype(int)
+        n_days = day_idx.max() + 1 + thr_win_len
+        panel = np.bincount(
+            fips_idx * n_days + day_idx + thr_win_len,
+            weights=data[thr_col].fillna(0).values.astype(float),
+            minlength=len(fips_values) * n_days,
+        ).reshape(len(fips_values), n_days)
+        np.cumsum(panel, axis=1, out=panel)
+        thr_col_roll = (
+            panel[fips_idx, day_idx + thr_win_len] - panel[fips_idx, day_idx]
+        )
+
+        mega_values = GeoMapper.convert_fips_to_mega(
+            pd.DataFrame({fips_col: fips_values}), fips_col=fips_col, mega_col=mega_col
+        )[mega_col].values
+        return np.where(
+            thr_col_roll > thr_count,
+            np.asarray(fips_values, dtype=object)[fips_idx],
+            mega_values[fips_idx],
+        )
+
     @staticmethod
     def megacounty_creation(
         data,
@@ -220,39 +572,40 @@ class GeoMapper:
         date_col: str, date column (is not aggregated, groupby), if None then no dates
         mega_col: str, the megacounty column to create
 
+        The trailing thr_win_len day sums of thr_col are computed for all FIPS at once
+        from a (fips x day) panel, so (fips, date) pairs are assumed unique. Missing days
+        count as zero.
+
         Return
         ---------
         data: copy of dataframe
             A dataframe with a new column, mega_col, that contains megaFIPS (aggregate
             of FIPS clusters) values depending on the number of data samples available.
         """
-        if "_thr_col_roll" in data.columns:
-            raise ValueError("Column name '_thr_col_roll' is reserved.")
+        megafips = GeoMapper._megafips(
+            data, thr_count, thr_win_len, thr_col, fips_col, date_col, mega_col
+        )
+        fips_idx = pd.factorize(data[fips_col], sort=True)[0]
 
-        def agg_sum_iter(data):
-            data_gby = (
-                data[[fips_col, date_col, thr_col]]
-                .set_index(date_col)
-                .groupby(fips_col)
-            )
-            for _, subdf in data_gby:
-                subdf_roll = subdf[thr_col].rolling(f"{thr_win_len}D").sum()
-                subdf["_thr_col_roll"] = subdf_roll
-                yield subdf
-
-        data_roll = pd.concat(agg_sum_iter(data))
-        data_roll.reset_index(inplace=True)
-        data_roll = GeoMapper.convert_fips_to_mega(
-            data_roll, fips_col=fips_col, mega_col=mega_col
+        # Keep the rows grouped by fips, in their original order within each group
+        order = np.argsort(fips_idx, kind="stable")
+        index = pd.MultiIndex.from_arrays(
+            [data[fips_col].values[order], data[date_col].values[order]],
+            names=[fips_col, date_col],
         )
-        data_roll.loc[data_roll["_thr_col_roll"] > thr_count, mega_col] = data_roll.loc[
-            data_roll["_thr_col_roll"] > thr_count, fips_col
-        ]
-        return data_roll.set_index([fips_col, date_col])[mega_col]
+        return pd.Series(megafips[order], index=index, name=mega_col)
 
     # Conversion functions
     def add_geocode(
-        self, df, from_code, new_code, from_col=None, new_col=None, dropna=True
+        self,
+        df,
+        from_code,
+        new_code,
+        from_col=None,
+        new_col=None,
+        dropna=True,
+        categorical=False,
+        inplace=False,
     ):
         """Add a new geocode column to a dataframe.
 
@@ -262,6 +615,8 @@ class GeoMapper:
         - jhu_uid -> fips
         - state_x -> state_y, where x and y are in {code, id, name}
         - state_code -> hhs_region_number
+        - any chain of the above, e.g. jhu_uid -> hrr or zip -> hhs_region_number, through
+          a composed crosswalk (see plan_conversion)
 
         Parameters
         ---------
@@ -283,18 +638,34 @@ class GeoMapper:
             and if False, the join is left. The inner join will drop records from the input database
             that have no translation in the crosswalk, while the outer join will keep those records
             as NA.
+        categorical: bool, default False
+            If True, from_col and new_col are pd.Categorical columns whose categories are
+            shared with the crosswalk tables (see geocode_categories), so the merge runs
+            on integer codes instead of strings. Integer FIPS and ZIP codes are then
+            matched without formatting them as strings. Use .astype(str) to get string
+            geocodes back, e.g. right before exporting.
+        inplace: bool, default False
+            If True, df is not copied and from_col is normalized in place. When every
+            from geocode maps to a single new geocode (e.g. fips -> state or msa), new_col
+            is also added to df in place, and with dropna=True the unmatched rows are
+            dropped from it, keeping its index. Otherwise, the result is the merge of df
+            with the crosswalk, as usual.
 
         Return
         ---------
         df: pd.DataFrame
-            A copy of the dataframe with a new geocode column added.
+            A copy of the dataframe with a new geocode column added, or df itself if
+            modified in place.
         """
-        df = df.copy()
+        if not inplace:
+            df = df.copy()
         from_col = from_code if from_col is None else from_col
         new_col = new_code if new_col is None else new_col
         state_codes = ["state_code", "state_id", "state_name"]
 
-        if not is_string_dtype(df[from_col]):
+        if categorical:
+            df[from_col] = self._to_categorical(df[from_col], from_code)
+        elif not is_string_dtype(df[from_col]):
             if from_code in ["fips", "zip"]:
                 df[from_col] = df[from_col].astype(str).str.zfill(5)
             else:
@@ -302,29 +673,45 @@ class GeoMapper:
 
         # Assuming that the passed-in records are all United States data, at the moment
         if (from_code, new_code) in [("fips", "nation"), ("zip", "nation")]:
-            df[new_col] = df[from_col].apply(lambda x: "us")
+            df[new_col] = "us"
+            if categorical:
+                df[new_col] = df[new_col].astype("category")
             return df
         elif new_code == "nation":
             raise ValueError(
                 "Conversion to the nation level is only supported from the FIPS and ZIP codes."
             )
+        # There is no crosswalk from a geocode to itself, each geocode maps to itself
+        if from_code == new_code:
+            df[new_col] = df[from_col]
+            return df
 
-        # state codes are all stored in one table
-        if from_code in state_codes and new_code in state_codes:
-            crosswalk = self._load_crosswalk(from_code="state", to_code="state")
-            crosswalk = crosswalk.rename(
-                columns={from_code: from_col, new_code: new_col}
-            )
-        elif new_code in state_codes:
-            crosswalk = self._load_crosswalk(from_code=from_code, to_code="state")
-            crosswalk = crosswalk.rename(
-                columns={from_code: from_col, new_code: new_col}
-            )
+        if categorical:
+            crosswalk = self._categorical_crosswalk(from_code, new_code)
+            # Match any categories added for geocodes missing from the crosswalks
+            if len(df[from_col].cat.categories) > len(crosswalk[from_code].cat.categories):
+                crosswalk = crosswalk.copy()
+                crosswalk[from_code] = crosswalk[from_code].cat.set_categories(
+                    df[from_col].cat.categories
+                )
         else:
-            crosswalk = self._load_crosswalk(from_code=from_code, to_code=new_code)
-            crosswalk = crosswalk.rename(
-                columns={from_code: from_col, new_code: new_col}
-            )
+            crosswalk = self._get_crosswalk(from_code, new_code)
+        crosswalk = crosswalk.rename(columns={from_code: from_col, new_code: new_col})
+
+        if (
+            inplace
+            and "weight" not in crosswalk.columns
+            and crosswalk[from_col].is_unique
+        ):
+            df[new_col] = crosswalk.set_index(from_col)[new_col].reindex(df[from_col]).values
+            missing = df[new_col].isna().values
+            if dropna and missing.any():
+                # Drop by position, as labels of a duplicate index may match kept rows
+                index = df.index[~missing]
+                df.reset_index(drop=True, inplace=True)
+                df.drop(index=np.flatnonzero(missing), inplace=True)
+                df.index = index
+            return df
 
         if dropna:
             df = df.merge(crosswalk, left_on=from_col, right_on=from_col, how="inner")
@@ -352,6 +739,9 @@ class GeoMapper:
         date_col="date",
         data_cols=None,
         dropna=True,
+        engine="merge",
+        categorical=False,
+        inplace=False,
     ):
         """Replace a geocode column in a dataframe.
 
@@ -361,6 +751,8 @@ class GeoMapper:
         - jhu_uid -> fips
         - state_x -> state_y, where x and y are in {code, id, name}
         - state_code -> hhs_region_number
+        - any chain of the above, e.g. jhu_uid -> hrr or zip -> hhs_region_number, through
+          a composed crosswalk (see plan_conversion)
 
         Parameters
         ---------
@@ -386,6 +778,19 @@ class GeoMapper:
             and if False, the join is left. The inner join will drop records from the input database
             that have no translation in the crosswalk, while the outer join will keep those records
             as NA.
+        engine: {'merge', 'sparse'}, default 'merge'
+            How to aggregate. 'merge' merges with the crosswalk table and runs a groupby.
+            'sparse' multiplies a (from geo x date) panel of each data column by the
+            crosswalk as a sparse matrix, which avoids building the merged frame and is
+            faster for large inputs. Both give the same result, except that the 'sparse'
+            engine only returns date_col, new_col and data_cols, which must be numeric.
+        categorical: bool, default False
+            If True, new_col is a pd.Categorical column and the merge and groupby run on
+            integer codes, see add_geocode. Only used by the 'merge' engine.
+        inplace: bool, default False
+            If True, df is not copied before being merged with the crosswalk, and may be
+            modified, see add_geocode. Only used by the 'merge' engine, the 'sparse' engine
+            never copies df.
 
         Return
         ---------
@@ -395,23 +800,164 @@ class GeoMapper:
         from_col = from_code if from_col is None else from_col
         new_col = new_code if new_col is None else new_col
 
+        if engine == "sparse":
+            return self._replace_geocode_sparse(
+                df, from_code, [new_code], from_col, new_col, date_col, data_cols
+            )[new_code]
+        if engine != "merge":
+            raise ValueError(f"Unknown engine '{engine}', use 'merge' or 'sparse'.")
+
         df = self.add_geocode(
-            df, from_code, new_code, from_col=from_col, new_col=new_col, dropna=dropna
-        ).drop(columns=from_col)
+            df,
+            from_code,
+            new_code,
+            from_col=from_col,
+            new_col=new_col,
+            dropna=dropna,
+            categorical=categorical,
+            inplace=inplace,
+        )
+        if from_col != new_col:
+            df.drop(columns=from_col, inplace=True)
 
         if "weight" in df.columns:
             if data_cols is None:
                 data_cols = list(set(df.columns) - {date_col, new_col, "weight"})
 
-            # Multiply and aggregate (this automatically zeros NAs)
-            df[data_cols] = df[data_cols].multiply(df["weight"], axis=0)
+            # Multiply and aggregate (this automatically zeros NAs), one column at a time
+            # to avoid a temporary copy of all of them
+            for col in data_cols:
+                df[col] *= df["weight"]
             df.drop("weight", axis=1, inplace=True)
 
+        # observed=True keeps categorical keys to the groups present in the data, whose
+        # order then needs restoring
         if not date_col is None:
-            df = df.groupby([date_col, new_col]).sum().reset_index()
+            df = df.groupby([date_col, new_col], observed=True).sum()
         else:
-            df = df.groupby([new_col]).sum().reset_index()
-        return df
+            df = df.groupby([new_col], observed=True).sum()
+        if categorical:
+            df = df.sort_index()
+        return df.reset_index()
+
+    def replace_geocodes(
+        self,
+        df,
+        from_code,
+        new_codes,
+        from_col=None,
+        new_col=None,
+        date_col="date",
+        data_cols=None,
+    ):
+        """Aggregate a dataframe to several geocodes in one pass.
+
+        Equivalent to calling replace_geocode(..., engine="sparse") once for every code
+        in new_codes, but the from geocodes are normalized and the data pivoted into a
+        (from geo x date) panel only once, and each new geocode is then a single sparse
+        matrix product. The input dataframe is not copied.
+
+        Parameters
+        ---------
+        df: pd.DataFrame
+            Input dataframe.
+        from_code: {'fips', 'zip', 'jhu_uid', 'state_code', 'state_id', 'state_name'}
+            Specifies the geocode type of the data in from_col.
+        new_codes: list of str
+            The geocode types to aggregate to, any of those supported by replace_geocode.
+            Passing from_code itself aggregates the data without changing its geocodes.
+        from_col: str, default None
+            Name of the column in data to match and remove. If None, then the name is
+            assumed to be from_code.
+        new_col: str, default None
+            Name of the new geocode column in every output. If None, then each output uses
+            its new geocode type as the name.
+        date_col: str or None, default "date"
+            Specify which column contains the date values. Used for value aggregation.
+            If None, then the aggregation is done only on geo_id.
+        data_cols: list, default None
+            A list of numeric data column names to aggregate. If set to None, then all the
+            columns are used except for from_col and date_col.
+
+        Return
+        ---------
+        dfs: dict of pd.DataFrame
+            Maps every code in new_codes to the dataframe aggregated to that geocode.
+        """
+        from_col = from_code if from_col is None else from_col
+        return self._replace_geocode_sparse(
+            df, from_code, list(new_codes), from_col, new_col, date_col, data_cols
+        )
+
+    def replace_geocode_chunked(
+        self,
+        chunks,
+        from_code,
+        new_code,
+        from_col=None,
+        new_col=None,
+        date_col="date",
+        data_cols=None,
+        dropna=True,
+        chunksize=1_000_000,
+    ):
+        """Replace a geocode column in data that is read one chunk at a time.
+
+        Gives the same result as replace_geocode on the concatenation of the chunks, but
+        only one chunk is held in memory at a time: each chunk is aggregated to new_code,
+        and the partial sums are added into an accumulator indexed by (date, new geo). So
+        peak memory is bounded by the chunk size plus the output size, not the input size.
+
+        Parameters
+        ---------
+        chunks: iterable of pd.DataFrame, or str
+            The input dataframe in chunks of rows, or the path of a CSV file to read in
+            chunks of chunksize rows. Chunks passed in are not modified; only chunks read
+            from a CSV file are converted in place.
+        from_code, new_code, from_col, new_col, date_col, data_cols, dropna:
+            See replace_geocode.
+        chunksize: int, default 1_000_000
+            Number of rows per chunk when reading chunks from a CSV file.
+
+        Return
+        ---------
+        df: pd.DataFrame
+            The aggregated dataframe, as returned by replace_geocode.
+        """
+        from_col = from_code if from_col is None else from_col
+        new_col = new_code if new_col is None else new_col
+        # Chunks read here are not shared with the caller, so are converted in place
+        inplace = isinstance(chunks, str)
+        if inplace:
+            chunks = pd.read_csv(
+                chunks,
+                chunksize=chunksize,
+                dtype={from_col: str},
+                parse_dates=None if date_col is None else [date_col],
+            )
+
+        keys = [new_col] if date_col is None else [date_col, new_col]
+        total = None
+        for chunk in chunks:
+            partial = self.replace_geocode(
+                chunk,
+                from_code,
+                new_code,
+                from_col=from_col,
+                new_col=new_col,
+                date_col=date_col,
+                data_cols=data_cols,
+                dropna=dropna,
+                inplace=inplace,
+            ).set_index(keys)
+            if total is None:
+                total = partial
+            else:
+                total = pd.concat([total, partial]).groupby(level=keys, sort=False).sum()
+
+        if total is None:
+            raise ValueError("No data chunks to aggregate.")
+        return total.sort_index().reset_index()
 
     def add_population_column(self, data, geocode_type, geocode_col=None):
         """
@@ -463,6 +1009,7 @@ class GeoMapper:
         date_col="date",
         mega_col="megafips",
         count_cols=None,
+        inplace=False,
     ):
         """Convert and aggregate from FIPS to megaFIPS
 
@@ -477,6 +1024,9 @@ class GeoMapper:
             mega_col: str, the megacounty column to create
             count_cols: list, the count data columns to aggregate, if None (default) all non
                         data/geo are used
+            inplace: bool, if True, data is not copied: its columns other than the fips, date
+                     and count columns are dropped, its fips column is normalized, the
+                     megaFIPS column added and the fips column dropped in place
 
         Return
         ---------
@@ -484,26 +1034,21 @@ class GeoMapper:
                 A dataframe with data aggregated into megaFIPS codes (aggregate
                 of FIPS clusters) values depending on the number of data samples available.
         """
-        data = data.copy()
+        if not inplace:
+            data = data.copy()
         if count_cols:
-            data = data[[fips_col, date_col] + count_cols]
+            keep_cols = [fips_col, date_col] + count_cols
+            data.drop(columns=[col for col in data.columns if col not in keep_cols],
+                      inplace=True)
 
         if not is_string_dtype(data[fips_col]):
             data[fips_col] = data[fips_col].astype(str).str.zfill(5)
 
-        mega_data = GeoMapper.megacounty_creation(
-            data,
-            thr_count,
-            thr_win_len,
-            thr_col=thr_col,
-            fips_col=fips_col,
-            date_col=date_col,
-            mega_col=mega_col,
+        data[mega_col] = GeoMapper._megafips(
+            data, thr_count, thr_win_len, thr_col, fips_col, date_col, mega_col
         )
-        data.set_index([fips_col, date_col], inplace=True)
-        data = data.join(mega_data)
-        data = data.reset_index().groupby([date_col, mega_col]).sum()
-        return data.reset_index()
+        data.drop(columns=fips_col, inplace=True)
+        return data.groupby([date_col, mega_col]).sum().reset_index()
 
     ### DEPRECATED FUNCTIONS BELOW
 
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Smoothers for daily signals, shared by the indicators."""
+
+import numpy as np
+
+# Kernel weights below this are dropped, see kernel_width()
+KERNEL_TOL = np.finfo(float).eps
+
+
+def kernel_width(bandwidth: float, tol: float = KERNEL_TOL) -> int:
+    """Number of lags (including lag 0) with a Gaussian kernel weight of at least tol.
+
+    The weight at lag d is exp(-d^2 / bandwidth), so the first lag K whose weight is below
+    tol is the smallest integer above sqrt(bandwidth * log(1 / tol)).
+
+    Parameters
+    ----------
+    bandwidth: float
+        Bandwidth of the kernel, in terms of variance
+    tol: float
+        Smallest weight to keep
+
+    Returns
+    -------
+    int
+        The number of lags to keep
+    """
+    return int(np.floor(np.sqrt(bandwidth * np.log(1 / tol)))) + 1
+
+
+def left_gauss_linear(
+    arr: np.ndarray, bandwidth: float, tol: float = KERNEL_TOL
+) -> np.ndarray:
+    """Smooth a signal using a local linear left Gaussian filter, in linear time.
+
+    The value at each index is the intercept of a linear regression on the values up to
+    that index, weighted by exp(-d^2 / bandwidth) at lag d. The weights are truncated to
+    the lags of kernel_width(bandwidth, tol), so each value only depends on the last
+    K = kernel_width(bandwidth, tol) values and the cost is O(n K) instead of O(n^2).
+    Every dropped weight is below tol, and all of them sum to at most
+    tol / (1 - exp(-2K / bandwidth)), so with the default tol of machine epsilon the
+    result matches the fit on the whole history up to rounding errors.
+
+    The regression is solved in closed form from the weighted moments of the lags (which
+    only depend on the index for the first K indices) and the weighted sums of the values.
+    The value at index 0 is NaN, as a line is not determined by a single point. NaN values
+    only make the K estimates that use them NaN.
+
+    Parameters
+    ----------
+    arr: np.ndarray
+        Signals to smooth, along the last axis. Other axes are smoothed independently,
+        for example the rows of a (geo x date) matrix.
+    bandwidth: float
+        Bandwidth of the kernel, in terms of variance
+    tol: float
+        Smallest kernel weight to keep
+
+    Returns
+    -------
+    np.ndarray
+        The smoothed signals, as floats of the same shape as arr
+    """
+    arr = np.asarray(arr, dtype=float)
+    n_days = arr.shape[-1]
+    width = min(kernel_width(bandwidth, tol), max(n_days, 1))
+    lags = np.arange(width)
+    weights = np.exp(-(lags ** 2) / bandwidth)
+
+    # Weighted sums of the values and of the values times their offsets (-lag)
+    val_sum = np.zeros_like(arr)
+    offset_val_sum = np.zeros_like(arr)
+    for lag, weight in zip(lags, weights):
+        lagged = weight * arr[..., :n_days - lag]
+        val_sum[..., lag:] += lagged
+        offset_val_sum[..., lag:] -= lag * lagged
+
+    # Weighted moments of the offsets, over the lags available at each index
+    available = np.minimum(np.arange(n_days), width - 1)
+    moment0 = np.cumsum(weights)[available]
+    moment1 = np.cumsum(-lags * weights)[available]
+    moment2 = np.cumsum(lags ** 2 * weights)[available]
+
+    det = moment0 * moment2 - moment1 ** 2
+    det[:1] = np.nan
+    return (moment2 * val_sum - moment1 * offset_val_sum) / det
@@ -1,7 +1,17 @@
 # -*- coding: utf-8 -*-
 from json import load
-from os.path import exists
+from os import link, remove, replace
+from os.path import dirname, exists, join
 from shutil import copyfile
+from uuid import uuid4
+
+try:
+    from fcntl import ioctl
+except ImportError:  # On Windows
+    ioctl = None
+
+# ioctl request to clone a file into another, sharing its blocks (Linux)
+FICLONE = 0x40049409
 
 def read_params():
     """Reads a file named 'params.json' in the current working directory.
@@ -14,3 +24,51 @@ def read_params():
 
     with open("params.json", "r") as json_file:
         return load(json_file)
+
+def _reflink(src, dst):
+    """Create dst as a copy-on-write clone of src, or raise OSError if not supported."""
+    if ioctl is None:
+        raise OSError("Reflinks are not supported on this platform")
+    with open(src, "rb") as src_f, open(dst, "wb") as dst_f:
+        ioctl(dst_f.fileno(), FICLONE, src_f.fileno())
+
+def _hardlink(src, dst):
+    """Create dst as a hardlink to src, and return whether it succeeded."""
+    try:
+        link(src, dst)
+        return True
+    except OSError:
+        return False
+
+def link_or_copy(src, dst, hardlink=False):
+    """Copies the file src to dst, sharing its data instead when the filesystem allows.
+
+    The copy is a reflink (copy-on-write clone) when the filesystem supports them, else a
+    hardlink if hardlink is True, else a full copy. It is made next to dst and renamed over
+    it, so readers of dst never see a partial file.
+
+    A hardlinked dst is the same file as src: rewriting either in place (instead of
+    replacing it) changes both, so only pass hardlink=True when neither is rewritten.
+
+    Parameters
+    ----------
+    src: str
+        The file to copy.
+    dst: str
+        The path to copy to, which is replaced if it exists.
+    hardlink: bool
+        Whether to hardlink dst to src when reflinks are not supported.
+    """
+    tmp = join(dirname(dst), f".{uuid4().hex}.tmp")
+    try:
+        try:
+            _reflink(src, tmp)
+        except OSError:
+            if exists(tmp):
+                remove(tmp)
+            if not (hardlink and _hardlink(src, tmp)):
+                copyfile(src, tmp)
+        replace(tmp, dst)
+    finally:
+        if exists(tmp):
+            remove(tmp)
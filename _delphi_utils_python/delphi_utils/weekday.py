@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""Weekday effects of daily counts, shared by the indicators."""
+
+from typing import Tuple
+
+import numpy as np
+from scipy.linalg import solveh_banded
+
+# Coefficients of a third difference, x[i + 3] - 3 x[i + 2] + 3 x[i + 1] - x[i]
+_THIRD_DIFF = np.array([-1.0, 3.0, -3.0, 1.0])
+
+
+def _third_diff(arr: np.ndarray) -> np.ndarray:
+    """Third differences D arr, of length len(arr) - 3."""
+    return arr[3:] - 3 * arr[2:-1] + 3 * arr[1:-2] - arr[:-3]
+
+
+def _third_diff_transpose(arr: np.ndarray) -> np.ndarray:
+    """D^T arr, of length len(arr) + 3."""
+    out = np.zeros(len(arr) + 3)
+    for offset, coef in enumerate(_THIRD_DIFF):
+        out[offset:offset + len(arr)] += coef * arr
+    return out
+
+
+def _third_diff_gram(weights: np.ndarray) -> np.ndarray:
+    """D^T diag(weights) D, in the upper banded form of scipy.linalg.solveh_banded."""
+    n_diffs = len(weights)
+    banded = np.zeros((4, n_diffs + 3))
+    for row, row_coef in enumerate(_THIRD_DIFF):
+        for col in range(row, 4):
+            banded[3 - (col - row), col:col + n_diffs] += row_coef * _THIRD_DIFF[col] * weights
+    return banded
+
+
+def fit_weekday_params(
+    nums: np.ndarray,
+    denoms: np.ndarray,
+    dayofweek: np.ndarray,
+    lam: float = 10,
+    tol: float = 1e-9,
+    max_iter: int = 100,
+) -> Tuple[np.ndarray, bool]:
+    """Fit weekday effects of a ratio, as an L1 trend filtered Poisson GLM.
+
+    Models log(nums_t / denoms_t) = alpha_{wd(t)} + phi_t, where the weekday effects alpha
+    sum to 0 (Sunday's is the negative sum of the others), by minimizing
+
+        sum_t (denoms_t exp(alpha_{wd(t)} + phi_t) - nums_t (alpha_{wd(t)} + phi_t)) / n
+            + lam^2 / (n - 2) ||D phi||_1
+
+    where D takes third differences, which is the problem that the indicators solved with
+    cvxpy. Instead of a generic conic solver, this uses a primal-dual interior point method
+    on the problem with ||D phi||_1 split into the bounds -u <= D phi <= u. Each Newton
+    step reduces to a banded system in phi, of bandwidth 3 plus the 6 weekday effects,
+    which is solved by a banded Cholesky factorization in O(n). It usually converges in
+    20 to 30 steps, until the duality gap and the dual residuals are below tol relative
+    to the scale of the problem.
+
+    If nums are all 0, the weekday effects are 0 and phi is -inf, as the fitted rates are 0.
+
+    Parameters
+    ----------
+    nums: np.ndarray
+        Daily numerators
+    denoms: np.ndarray
+        Daily denominators, of the same length
+    dayofweek: np.ndarray
+        Day of the week of each day, from 0 (Monday) to 6 (Sunday)
+    lam: float
+        Penalty parameter
+    tol: float
+        Relative tolerance of the duality gap and dual residuals
+    max_iter: int
+        Maximum number of Newton steps
+
+    Returns
+    -------
+    np.ndarray
+        The weekday effects of Monday to Saturday followed by phi, of length n + 6
+    bool
+        Whether the fit converged. If not, because all max_iter steps were used or the
+        line search stalled, the parameters are the last iterate and should not be trusted.
+    """
+    nums = np.asarray(nums, dtype=float)
+    denoms = np.asarray(denoms, dtype=float)
+    dayofweek = np.asarray(dayofweek)
+    n_days = len(nums)
+    n_diffs = n_days - 3
+    penalty = lam * lam / (n_days - 2)
+    if not nums.any():
+        return np.concatenate([np.zeros(6), np.full(n_days, -np.inf)]), True
+
+    # Weekday indicators, with -1 for all weekdays on Sundays
+    design = np.zeros((n_days, 6))
+    not_sunday = np.flatnonzero(dayofweek != 6)
+    design[not_sunday, dayofweek[not_sunday]] = 1
+    design[dayofweek == 6, :] = -1
+
+    # Start from a constant phi, with the bounds u and the duals of -u <= D phi and
+    # D phi <= u strictly feasible
+    alpha = np.zeros(6)
+    phi = np.full(n_days, np.log(nums.sum() / denoms.sum()))
+    bound = np.ones(n_diffs)
+    dual_lower = np.full(n_diffs, penalty / 2)
+    dual_upper = np.full(n_diffs, penalty / 2)
+    residual_scale = max(1.0, nums.sum() / n_days)
+
+    def residuals(alpha, phi, bound, dual_lower, dual_upper, centering):
+        fitted = denoms * np.exp(design @ alpha + phi) / n_days
+        grad = fitted - nums / n_days
+        diffs = _third_diff(phi)
+        slack_lower, slack_upper = bound + diffs, bound - diffs
+        return (
+            design.T @ grad,
+            grad + _third_diff_transpose(dual_upper - dual_lower),
+            penalty - dual_lower - dual_upper,
+            dual_lower * slack_lower - centering,
+            dual_upper * slack_upper - centering,
+        ), fitted, slack_lower, slack_upper
+
+    def norm(residual):
+        return np.sqrt(sum(np.sum(part ** 2) for part in residual))
+
+    barrier = 1.0
+    converged = False
+    for _ in range(max_iter):
+        diffs = _third_diff(phi)
+        gap = (bound + diffs) @ dual_lower + (bound - diffs) @ dual_upper
+        barrier = max(10 * 2 * n_diffs / gap, barrier)
+        residual, fitted, slack_lower, slack_upper = residuals(
+            alpha, phi, bound, dual_lower, dual_upper, 1 / barrier)
+        res_alpha, res_phi, res_bound, res_lower, res_upper = residual
+        if (gap <= tol * max(1.0, penalty * bound.sum())
+                and np.sqrt(res_alpha @ res_alpha + res_phi @ res_phi) <= tol * residual_scale):
+            converged = True
+            break
+
+        # Newton step, with the bounds and duals eliminated: the system in phi is banded
+        # and the 6 weekday effects are solved for by their Schur complement
+        ratio_lower, ratio_upper = dual_lower / slack_lower, dual_upper / slack_upper
+        ratio_sum, ratio_diff = ratio_lower + ratio_upper, ratio_upper - ratio_lower
+        step_bound_rhs = -res_lower / slack_lower - res_upper / slack_upper - res_bound
+        dual_rhs = (-res_upper / slack_upper + res_lower / slack_lower
+                    - ratio_diff * step_bound_rhs / ratio_sum)
+        phi_system = _third_diff_gram(4 * ratio_lower * ratio_upper / ratio_sum)
+        phi_system[3] += fitted
+        cross = design.T * fitted
+        solved = solveh_banded(
+            phi_system, np.column_stack([-res_phi - _third_diff_transpose(dual_rhs), cross.T]))
+        schur = cross @ design - cross @ solved[:, 1:]
+        step_alpha = np.linalg.solve(schur, -res_alpha - cross @ solved[:, 0])
+        step_phi = solved[:, 0] - solved[:, 1:] @ step_alpha
+        step_diffs = _third_diff(step_phi)
+        step_bound = (step_bound_rhs + ratio_diff * step_diffs) / ratio_sum
+        step_lower = (-res_lower - dual_lower * (step_bound + step_diffs)) / slack_lower
+        step_upper = (-res_upper - dual_upper * (step_bound - step_diffs)) / slack_upper
+
+        # Largest step keeping the duals and slacks positive, then backtrack until the
+        # residuals decrease enough
+        step = 1.0
+        for value, change in ((dual_lower, step_lower), (dual_upper, step_upper),
+                              (slack_lower, step_bound + step_diffs),
+                              (slack_upper, step_bound - step_diffs)):
+            decreasing = change < 0
+            if decreasing.any():
+                step = min(step, 0.99 * np.min(-value[decreasing] / change[decreasing]))
+        start_norm = norm(residual)
+        while True:
+            point = (alpha + step * step_alpha, phi + step * step_phi,
+                     bound + step * step_bound, dual_lower + step * step_lower,
+                     dual_upper + step * step_upper)
+            if norm(residuals(*point, 1 / barrier)[0]) <= (1 - 0.01 * step) * start_norm:
+                break
+            step /= 2
+            if step < 1e-10:
+                break
+        alpha, phi, bound, dual_lower, dual_upper = point
+        if step < 1e-10:
+            # The line search stalled, so further steps would not make progress
+            break
+
+    return np.concatenate([alpha, phi]), converged
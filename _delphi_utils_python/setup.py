@@ -9,6 +9,7 @@ required = [
     "pandas>=1.1.0",
     "pytest",
     "pytest-cov",
+    "scipy",
     "xlrd"
 ]
 
@@ -20,6 +21,7 @@ setup(
     author_email="",
     url="https://github.com/cmu-delphi/",
     install_requires=required,
+    extras_require={"parquet": ["pyarrow"]},
     classifiers=[
         "Development Status :: 5 - Production/Stable",
         "Intended Audience :: Developers",
@@ -1,7 +1,8 @@
 
+from importlib.util import find_spec
 from io import StringIO, BytesIO
-from os import listdir, mkdir
-from os.path import join
+from os import listdir, mkdir, remove, stat, utime
+from os.path import join, isfile, samefile
 
 from boto3 import Session
 from git import Repo, exc
@@ -11,7 +12,11 @@ import pandas as pd
 from pandas.testing import assert_frame_equal
 import pytest
 
-from delphi_utils import ArchiveDiffer, GitArchiveDiffer, S3ArchiveDiffer
+from delphi_utils import (
+    ArchiveDiffer, GitArchiveDiffer, LocalArchiveDiffer, ParquetArchiveDiffer, S3ArchiveDiffer)
+from delphi_utils.archive import (
+    MANIFEST_FILENAME, diff_export_csv, diff_export_csv_sorted, diff_export_file,
+    summarize_file)
 
 CSV_DTYPES = {"geo_id": str, "val": float, "se": float, "sample_size": float}
 
@@ -59,6 +64,35 @@ CSVS_AFTER = {
         "sample_size": [20.0]}),
 }
 
+# An export as create_export_csv_diffs passes it to export_diffs, with integer sample sizes
+EXPORT_DF = pd.DataFrame({
+    "geo_id": ["1", "2"],
+    "val": [1.5, 2.0],
+    "se": [np.nan, 0.2],
+    "sample_size": [10, 20]})
+EXPORT_CSV = "geo_id,val,se,sample_size\n1,1.5,NA,10\n2,2.0,0.2,20\n"
+
+
+def check_export_diffs(arch_diff, cache_dir, export_dir):
+    """Export EXPORT_DF twice with export_diffs, the second time with one changed value."""
+    arch_diff.update_cache()
+    export_files, cached_files = arch_diff.export_diffs([("csv0.csv", EXPORT_DF)])
+    assert export_files == [join(export_dir, "csv0.csv")]
+    assert cached_files == [join(cache_dir, "csv0.csv")]
+    # Both are written exactly as create_export_csv writes exports
+    for filename in export_files + cached_files:
+        with open(filename) as f:
+            assert f.read() == EXPORT_CSV
+    remove(export_files[0])
+
+    changed_df = EXPORT_DF.assign(val=[1.5, 2.5])
+    export_files, cached_files = arch_diff.export_diffs([("csv0.csv", changed_df)])
+    with open(export_files[0]) as f:
+        assert f.read() == "geo_id,val,se,sample_size\n2,2.5,0.2,20\n"
+    with open(cached_files[0]) as f:
+        assert f.read() == EXPORT_CSV.replace("2,2.0", "2,2.5")
+    return cached_files
+
 
 class TestArchiveDiffer:
 
@@ -71,7 +105,8 @@ class TestArchiveDiffer:
         with pytest.raises(NotImplementedError):
             arch_diff.archive_exports(None)
 
-    def test_diff_and_filter_exports(self, tmp_path):
+    @pytest.mark.parametrize("n_workers,use_processes", [(1, False), (2, False), (2, True)])
+    def test_diff_and_filter_exports(self, tmp_path, n_workers, use_processes):
         cache_dir = join(str(tmp_path), "cache")
         export_dir = join(str(tmp_path), "export")
         mkdir(cache_dir)
@@ -99,12 +134,13 @@ class TestArchiveDiffer:
             df.to_csv(join(export_dir, f"{csv_name}.csv"), index=False)
         arch_diff._cache_updated = True
 
-        deleted_files, common_diffs, new_files = arch_diff.diff_exports()
+        deleted_files, common_diffs, new_files = arch_diff.diff_exports(
+            n_workers, use_processes)
 
         # Check return values
         assert set(deleted_files) == {join(cache_dir, "csv2.csv")}
-        assert set(common_diffs.keys()) == {
-            join(export_dir, f) for f in ["csv0.csv", "csv1.csv"]}
+        assert list(common_diffs.keys()) == [
+            join(export_dir, f) for f in ["csv0.csv", "csv1.csv"]]
         assert set(new_files) == {join(export_dir, "csv3.csv")}
         assert common_diffs[join(export_dir, "csv0.csv")] is None
         assert common_diffs[join(export_dir, "csv1.csv")] == join(
@@ -135,6 +171,74 @@ class TestArchiveDiffer:
             pd.read_csv(join(export_dir, "csv1.csv"), dtype=CSV_DTYPES),
             csv1_diff)
 
+    def test_diff_sorted(self, tmp_path):
+        before_file = join(str(tmp_path), "before.csv")
+        after_file = join(str(tmp_path), "after.csv")
+        diff_file = join(str(tmp_path), "diff.csv")
+        CSVS_BEFORE["csv1"].to_csv(before_file, index=False, na_rep="NA")
+        CSVS_AFTER["csv1"].to_csv(after_file, index=False, na_rep="NA")
+
+        assert diff_export_csv_sorted(before_file, after_file, diff_file) == (1, 1, 1)
+        assert_frame_equal(
+            pd.read_csv(diff_file, dtype=CSV_DTYPES),
+            CSVS_AFTER["csv1"].iloc[1:].reset_index(drop=True))
+
+        # Unsorted files are rejected, and diffed in memory by diff_export_file instead
+        CSVS_AFTER["csv1"].iloc[::-1].to_csv(after_file, index=False, na_rep="NA")
+        with pytest.raises(ValueError):
+            diff_export_csv_sorted(before_file, after_file, diff_file)
+        assert diff_export_file(before_file, after_file, diff_file) == diff_file
+        assert_frame_equal(
+            pd.read_csv(diff_file, dtype=CSV_DTYPES),
+            CSVS_AFTER["csv1"].iloc[1:].reset_index(drop=True))
+
+        # Equal values written differently are not changes
+        with open(after_file, "w") as f:
+            f.write("geo_id,val,se,sample_size\n1,1,NaN,10\n2,2.0,0.20,20\n3,3,0.3,3e1\n")
+        assert diff_export_file(before_file, after_file, diff_file) is None
+        assert not isfile(diff_file)
+
+    def test_diff_sorted_other_columns(self, tmp_path):
+        before_file = join(str(tmp_path), "before.csv")
+        after_file = join(str(tmp_path), "after.csv")
+        diff_file = join(str(tmp_path), "diff.csv")
+        # Other columns are parsed as pd.read_csv infers them in each file: missing_val
+        # is int before and float after, missing_se float in both and note str in both
+        with open(before_file, "w") as f:
+            f.write("geo_id,val,se,sample_size,missing_val,missing_se,note\n"
+                    "1,1.0,NA,10,0,NA,a\n"
+                    "2,2.0,0.2,20,0,nan,NA\n"
+                    "3,3.0,0.3,30,1,3,c\n")
+        with open(after_file, "w") as f:
+            f.write("geo_id,val,se,sample_size,missing_val,missing_se,note\n"
+                    "1,1,,10.0,0.0,,a\n"
+                    "2,2.0,0.2,20,0,NA,\n"
+                    "3,3.0,0.3,30,2,3.0,d\n"
+                    "4,4.0,0.4,40,NA,5,e\n")
+
+        assert diff_export_csv_sorted(before_file, after_file, diff_file) == (0, 1, 1)
+        with open(diff_file) as f:
+            sorted_diff = f.read()
+        deleted_df, changed_df, added_df = diff_export_csv(before_file, after_file)
+        assert (len(deleted_df), len(changed_df), len(added_df)) == (0, 1, 1)
+        pd.concat([changed_df, added_df]).to_csv(diff_file, na_rep="NA")
+        with open(diff_file) as f:
+            assert sorted_diff == f.read()
+        assert sorted_diff == (
+            "geo_id,val,se,sample_size,missing_val,missing_se,note\n"
+            "3,3.0,0.3,30.0,2.0,3.0,d\n"
+            "4,4.0,0.4,40.0,NA,5.0,e\n")
+
+        # A column that is numeric in one file and str in the other always differs, as
+        # in diff_export_csv
+        with open(after_file, "w") as f:
+            f.write("geo_id,val,se,sample_size,missing_val,missing_se,note\n"
+                    "1,1.0,NA,10,0,NA,a\n"
+                    "2,2.0,0.2,20,0,nan,NA\n"
+                    "3,3.0,0.3,30,x,3,c\n")
+        assert diff_export_csv_sorted(before_file, after_file, diff_file) == (0, 3, 0)
+        assert [len(df) for df in diff_export_csv(before_file, after_file)] == [0, 3, 0]
+
 
 AWS_CREDENTIALS = {
     "aws_access_key_id": "FAKE_TEST_ACCESS_KEY_ID",
@@ -186,9 +290,90 @@ class TestS3ArchiveDiffer:
             self.bucket_name, self.indicator_prefix,
             AWS_CREDENTIALS)
 
-        # Should download csv2 into cache folder
+        # Should download csv2 into cache folder, and record both in the manifest
+        arch_diff.update_cache()
+        assert set(listdir(cache_dir)) == {"csv1.csv", "csv2.csv", MANIFEST_FILENAME}
+        manifest = arch_diff.load_manifest()
+        assert set(manifest.keys()) == {"csv1.csv", "csv2.csv"}
+        assert manifest["csv2.csv"] == summarize_file(join(cache_dir, "csv2.csv"))
+        assert manifest["csv2.csv"]["rows"] == 3
+
+        # Should only download csv1 again once its object changes
+        s3_client.put_object(
+            Bucket=self.bucket_name,
+            Key=f"{self.indicator_prefix}/csv1.csv",
+            Body=BytesIO(csv2_buf.getvalue().encode()))
+        arch_diff.update_cache()
+        assert_frame_equal(
+            pd.read_csv(join(cache_dir, "csv1.csv"), dtype=CSV_DTYPES), csv2)
+        assert arch_diff.load_manifest()["csv1.csv"]["md5"] == manifest["csv2.csv"]["md5"]
+
+        # Should download csv2 again once it is missing from the cache folder, even though
+        # its manifest entry still matches its object
+        remove(join(cache_dir, "csv2.csv"))
+        arch_diff.update_cache()
+        assert_frame_equal(
+            pd.read_csv(join(cache_dir, "csv2.csv"), dtype=CSV_DTYPES), csv2)
+
+        # Should download csv2 again once its contents change, even with the same size
+        with open(join(cache_dir, "csv2.csv"), "r+") as f:
+            f.write("x")
+        arch_diff.update_cache()
+        assert_frame_equal(
+            pd.read_csv(join(cache_dir, "csv2.csv"), dtype=CSV_DTYPES), csv2)
+        assert arch_diff.load_manifest()["csv2.csv"] == summarize_file(
+            join(cache_dir, "csv2.csv"))
+
+    @mock_s3
+    def test_manifest_diff(self, tmp_path, s3_client):
+        cache_dir = join(str(tmp_path), "cache")
+        export_dir = join(str(tmp_path), "export")
+        mkdir(cache_dir)
+        mkdir(export_dir)
+        s3_client.create_bucket(Bucket=self.bucket_name)
+
+        arch_diff = S3ArchiveDiffer(
+            cache_dir, export_dir,
+            self.bucket_name, self.indicator_prefix,
+            AWS_CREDENTIALS)
         arch_diff.update_cache()
-        assert set(listdir(cache_dir)) == {"csv1.csv", "csv2.csv"}
+
+        csv1 = CSVS_BEFORE["csv1"]
+        csv1.to_csv(join(export_dir, "csv1.csv"), index=False)
+        arch_diff.archive_exports([join(export_dir, "csv1.csv")])
+        assert arch_diff.load_manifest()["csv1.csv"] == summarize_file(
+            join(cache_dir, "csv1.csv"))
+
+        # An unchanged export is found from the manifest, without reading the cached
+        # file: overwriting it with the same size and modification time goes unnoticed
+        cached_stat = stat(join(cache_dir, "csv1.csv"))
+        with open(join(cache_dir, "csv1.csv"), "r+") as f:
+            # the val of geo_id 1, from 1.0 to 2.0
+            f.seek(len("geo_id,val,se,sample_size\n1,"))
+            f.write("2")
+        utime(join(cache_dir, "csv1.csv"), ns=(cached_stat.st_atime_ns, cached_stat.st_mtime_ns))
+        _, common_diffs, _ = arch_diff.diff_exports()
+        assert common_diffs == {join(export_dir, "csv1.csv"): None}
+
+        # but a change of modification time gets the cached file summarized again
+        utime(join(cache_dir, "csv1.csv"))
+        _, common_diffs, _ = arch_diff.diff_exports()
+        assert common_diffs == {join(export_dir, "csv1.csv"): join(export_dir, "csv1.csv.diff")}
+
+    @mock_s3
+    def test_export_diffs(self, tmp_path, s3_client):
+        cache_dir = join(str(tmp_path), "cache")
+        export_dir = join(str(tmp_path), "export")
+        mkdir(cache_dir)
+        mkdir(export_dir)
+        s3_client.create_bucket(Bucket=self.bucket_name)
+
+        arch_diff = S3ArchiveDiffer(
+            cache_dir, export_dir,
+            self.bucket_name, self.indicator_prefix,
+            AWS_CREDENTIALS)
+        cached_files = check_export_diffs(arch_diff, cache_dir, export_dir)
+        assert arch_diff.load_manifest()["csv0.csv"] == summarize_file(cached_files[0])
 
     @mock_s3
     def test_archive_exports(self, tmp_path, s3_client):
@@ -221,6 +406,53 @@ class TestS3ArchiveDiffer:
 
         assert_frame_equal(pd.read_csv(body, dtype=CSV_DTYPES), csv1)
 
+    @mock_s3
+    def test_concurrent_transfers(self, tmp_path, s3_client):
+        cache_dir = join(str(tmp_path), "cache")
+        export_dir = join(str(tmp_path), "export")
+        mkdir(cache_dir)
+        mkdir(export_dir)
+        s3_client.create_bucket(Bucket=self.bucket_name)
+
+        csv_names = [f"csv{i}.csv" for i in range(20)]
+        for i, csv_name in enumerate(csv_names):
+            CSVS_BEFORE["csv0"].assign(val=i).to_csv(
+                join(export_dir, csv_name), index=False)
+
+        arch_diff = S3ArchiveDiffer(
+            cache_dir, export_dir,
+            self.bucket_name, self.indicator_prefix,
+            AWS_CREDENTIALS, max_transfers=4)
+        exported_files = [join(export_dir, f) for f in csv_names]
+        successes, fails = arch_diff.archive_exports(
+            exported_files + [join(export_dir, "not_a_csv.csv")])
+        assert successes == exported_files
+        assert fails == [join(export_dir, "not_a_csv.csv")]
+
+        # Failed uploads are reported per file
+        arch_diff_missing_bucket = S3ArchiveDiffer(
+            cache_dir, export_dir,
+            "missing-bucket", self.indicator_prefix,
+            AWS_CREDENTIALS, max_transfers=4)
+        successes, fails = arch_diff_missing_bucket.archive_exports(
+            exported_files[:3], update_cache=False)
+        assert successes == []
+        assert fails == exported_files[:3]
+
+        # Download all the objects into a fresh cache
+        new_cache_dir = join(str(tmp_path), "new_cache")
+        mkdir(new_cache_dir)
+        arch_diff = S3ArchiveDiffer(
+            new_cache_dir, export_dir,
+            self.bucket_name, self.indicator_prefix,
+            AWS_CREDENTIALS, max_transfers=4)
+        arch_diff.update_cache()
+        assert set(listdir(new_cache_dir)) == set(csv_names) | {MANIFEST_FILENAME}
+        for i, csv_name in enumerate(csv_names):
+            assert_frame_equal(
+                pd.read_csv(join(new_cache_dir, csv_name), dtype=CSV_DTYPES),
+                CSVS_BEFORE["csv0"].assign(val=float(i)))
+
     @mock_s3
     def test_run(self, tmp_path, s3_client):
         cache_dir = join(str(tmp_path), "cache")
@@ -268,8 +500,88 @@ class TestS3ArchiveDiffer:
             csv1_diff)
 
 
+class TestLocalArchiveDiffer:
+
+    @pytest.mark.parametrize("hardlink", [False, True])
+    def test_run(self, tmp_path, hardlink):
+        cache_dir = str(tmp_path / "cache")
+        export_dir = str(tmp_path / "export")
+        mkdir(cache_dir)
+        mkdir(export_dir)
+
+        # Set up the cache to be `CSVS_BEFORE`, and the exports to be `CSVS_AFTER`.
+        for csv_name, df in CSVS_BEFORE.items():
+            df.to_csv(join(cache_dir, f"{csv_name}.csv"), index=False)
+        for csv_name, df in CSVS_AFTER.items():
+            df.to_csv(join(export_dir, f"{csv_name}.csv"), index=False)
+
+        # Create and run differ.
+        arch_diff = LocalArchiveDiffer(cache_dir, export_dir, hardlink)
+        arch_diff.run()
+
+        # Check that the cache now contains the exported files, and kept deleted ones
+        assert set(listdir(cache_dir)) == {"csv0.csv", "csv1.csv", "csv2.csv", "csv3.csv"}
+        for csv_name, df in CSVS_AFTER.items():
+            assert_frame_equal(
+                pd.read_csv(join(cache_dir, f"{csv_name}.csv"), dtype=CSV_DTYPES), df)
+
+        # Check exports directory just has incremental changes
+        assert set(listdir(export_dir)) == {"csv1.csv", "csv3.csv"}
+        csv1_diff = pd.DataFrame({
+            "geo_id": ["2", "4"],
+            "val": [2.1, 4.0],
+            "se": [0.21, np.nan],
+            "sample_size": [21.0, 40.0]})
+        assert_frame_equal(
+            pd.read_csv(join(export_dir, "csv1.csv"), dtype=CSV_DTYPES),
+            csv1_diff)
+
+        # The diff replaced the export, so did not change its archived version
+        assert not samefile(join(export_dir, "csv1.csv"), join(cache_dir, "csv1.csv"))
+        if not hardlink:
+            assert not samefile(join(export_dir, "csv3.csv"), join(cache_dir, "csv3.csv"))
+
+    def test_default_copies(self, tmp_path):
+        cache_dir = str(tmp_path / "cache")
+        export_dir = str(tmp_path / "export")
+        mkdir(cache_dir)
+        mkdir(export_dir)
+        CSVS_AFTER["csv3"].to_csv(join(export_dir, "csv3.csv"), index=False)
+
+        arch_diff = LocalArchiveDiffer(cache_dir, export_dir)
+        assert not arch_diff.hardlink
+        arch_diff.run()
+
+        # Rewriting the kept export in place does not change the archive
+        with open(join(export_dir, "csv3.csv"), "r+") as f:
+            f.write("x")
+        assert_frame_equal(
+            pd.read_csv(join(cache_dir, "csv3.csv"), dtype=CSV_DTYPES), CSVS_AFTER["csv3"])
+
+
+    def test_export_diffs(self, tmp_path):
+        cache_dir = str(tmp_path / "cache")
+        export_dir = str(tmp_path / "export")
+        mkdir(export_dir)
+        check_export_diffs(LocalArchiveDiffer(cache_dir, export_dir), cache_dir, export_dir)
+
+
 class TestGitArchiveDiffer:
 
+    def test_export_diffs(self, tmp_path):
+        cache_dir = str(tmp_path / "cache")
+        export_dir = str(tmp_path / "export")
+        mkdir(cache_dir)
+        mkdir(export_dir)
+        Repo.init(cache_dir)
+
+        # The cached files would not be written to the archiving branch
+        arch_diff = GitArchiveDiffer(cache_dir, export_dir)
+        arch_diff.update_cache()
+        with pytest.raises(NotImplementedError):
+            arch_diff.export_diffs([("csv0.csv", EXPORT_DF)])
+        assert listdir(export_dir) == []
+
     def test_init_args(self, tmp_path):
         cache_dir = str(tmp_path / "cache")
         export_dir = str(tmp_path / "export")
@@ -467,3 +779,179 @@ class TestGitArchiveDiffer:
         assert_frame_equal(
             pd.read_csv(join(export_dir, "csv1.csv"), dtype=CSV_DTYPES),
             csv1_diff)
+
+    def test_run_without_checkout(self, tmp_path):
+        cache_dir = str(tmp_path / "cache")
+        export_dir = str(tmp_path / "export")
+        mkdir(cache_dir)
+        mkdir(export_dir)
+
+        branch_name = "test-branch"
+
+        repo = Repo.init(cache_dir)
+        repo.index.commit(message="Initial commit")
+        original_branch = repo.active_branch
+        original_commit = original_branch.commit
+
+        # Set up the archive branch to contain `CSVS_BEFORE`, in a subdirectory.
+        archive_dir = join(cache_dir, "archive")
+        mkdir(archive_dir)
+        repo.create_head(branch_name).checkout()
+        for csv_name, df in CSVS_BEFORE.items():
+            df.to_csv(join(archive_dir, f"{csv_name}.csv"), index=False)
+        repo.index.add([join(archive_dir, f"{csv_name}.csv") for csv_name in CSVS_BEFORE])
+        repo.index.commit(message="Archive")
+        original_branch.checkout()
+        mkdir(archive_dir)
+
+        for csv_name, df in CSVS_AFTER.items():
+            df.to_csv(join(export_dir, f"{csv_name}.csv"), index=False)
+
+        # A dirty working tree does not matter, since it is never used
+        with open(join(archive_dir, "csv1.csv"), "w") as f:
+            f.write("dirty")
+
+        arch_diff = GitArchiveDiffer(
+            archive_dir, export_dir,
+            branch_name=branch_name, checkout_branch=False)
+        assert arch_diff.uses_tree()
+        arch_diff.archiving_branch = None
+        arch_diff.run()
+
+        # The archive branch contains `CSVS_AFTER` (and the deleted csv2)
+        tree = repo.heads[branch_name].commit.tree / "archive"
+        assert {blob.name for blob in tree.blobs} == {"csv0.csv", "csv1.csv", "csv2.csv", "csv3.csv"}
+        for csv_name, df in CSVS_AFTER.items():
+            blob = tree / f"{csv_name}.csv"
+            assert_frame_equal(
+                pd.read_csv(BytesIO(blob.data_stream.read()), dtype=CSV_DTYPES), df)
+
+        # The working tree and checked out branch are untouched
+        assert repo.active_branch == original_branch
+        assert original_branch.commit == original_commit
+        assert listdir(archive_dir) == ["csv1.csv"]
+
+        # Check exports directory just has incremental changes
+        assert set(listdir(export_dir)) == {"csv1.csv", "csv3.csv"}
+        csv1_diff = pd.DataFrame({
+            "geo_id": ["2", "4"],
+            "val": [2.1, 4.0],
+            "se": [0.21, np.nan],
+            "sample_size": [21.0, 40.0]})
+        assert_frame_equal(
+            pd.read_csv(join(export_dir, "csv1.csv"), dtype=CSV_DTYPES),
+            csv1_diff)
+
+
+@pytest.mark.skipif(find_spec("pyarrow") is None, reason="pyarrow is an optional dependency")
+class TestParquetArchiveDiffer:
+
+    @staticmethod
+    def export_name(csv_name):
+        # One time value per test CSV, of a single signal
+        return f"2020080{int(csv_name[-1]) + 1}_state_sig.csv"
+
+    def test_export_diffs(self, tmp_path):
+        cache_dir = str(tmp_path / "cache")
+        export_dir = str(tmp_path / "export")
+        mkdir(export_dir)
+
+        # The Parquet dataset does not hold CSV files
+        arch_diff = ParquetArchiveDiffer(cache_dir, export_dir)
+        arch_diff.update_cache()
+        with pytest.raises(NotImplementedError):
+            arch_diff.export_diffs([(self.export_name("csv0"), EXPORT_DF)])
+        assert listdir(export_dir) == [] and listdir(cache_dir) == []
+
+    def test_run(self, tmp_path):
+        cache_dir = str(tmp_path / "cache")
+        export_dir = str(tmp_path / "export")
+        mkdir(export_dir)
+
+        # Archive `CSVS_BEFORE` on a first issue
+        for csv_name, df in CSVS_BEFORE.items():
+            df.to_csv(join(export_dir, self.export_name(csv_name)), index=False)
+        arch_diff = ParquetArchiveDiffer(cache_dir, export_dir, issue=20200801)
+        arch_diff.run()
+        assert set(listdir(export_dir)) == {self.export_name(f) for f in CSVS_BEFORE}
+        for f in listdir(export_dir):
+            remove(join(export_dir, f))
+
+        # Then `CSVS_AFTER` on a second issue
+        for csv_name, df in CSVS_AFTER.items():
+            df.to_csv(join(export_dir, self.export_name(csv_name)), index=False)
+        arch_diff = ParquetArchiveDiffer(cache_dir, export_dir, issue=20200802)
+        arch_diff.update_cache()
+        deleted_files, common_diffs, new_files = arch_diff.diff_exports()
+
+        assert deleted_files == [join(cache_dir, self.export_name("csv2"))]
+        assert common_diffs == {
+            join(export_dir, self.export_name("csv0")): None,
+            join(export_dir, self.export_name("csv1")):
+                join(export_dir, self.export_name("csv1") + ".diff")}
+        assert new_files == [join(export_dir, self.export_name("csv3"))]
+
+        succs, fails = arch_diff.archive_exports(
+            [join(export_dir, self.export_name(f)) for f in ["csv1", "csv3"]])
+        assert len(succs) == 2 and fails == []
+        arch_diff.filter_exports(common_diffs)
+
+        # Check exports directory just has incremental changes
+        assert set(listdir(export_dir)) == {self.export_name(f) for f in ["csv1", "csv3"]}
+        csv1_diff = pd.DataFrame({
+            "geo_id": ["2", "4"],
+            "val": [2.1, 4.0],
+            "se": [0.21, np.nan],
+            "sample_size": [21.0, 40.0]})
+        assert_frame_equal(
+            pd.read_csv(join(export_dir, self.export_name("csv1")), dtype=CSV_DTYPES),
+            csv1_diff)
+
+        # Only the changed rows were archived in the second issue, and earlier issues can
+        # still be read back
+        archive = arch_diff.load_archive("sig", "state")
+        archive = archive[archive["time_value"] == "20200802"]
+        assert archive["geo_id"].tolist() == ["1", "2", "3", "4"]
+        assert archive["issue"].tolist() == [20200801, 20200802, 20200801, 20200802]
+        assert archive["val"].tolist() == [1.0, 2.1, 3.0, 4.0]
+        archive = arch_diff.load_archive("sig", "state", as_of=20200801)
+        archive = archive[archive["time_value"] == "20200802"].reset_index(drop=True)
+        assert_frame_equal(
+            archive[["geo_id", "val", "se", "sample_size"]],
+            CSVS_BEFORE["csv1"])
+
+    def test_archived_time_values(self, tmp_path, monkeypatch):
+        cache_dir = str(tmp_path / "cache")
+        export_dir = str(tmp_path / "export")
+        mkdir(export_dir)
+        index_file = join(cache_dir, "signal=sig", "geo_type=state", "_time_values.json")
+
+        arch_diff = ParquetArchiveDiffer(cache_dir, export_dir, issue=20200801)
+        assert arch_diff.archived_time_values("sig", "state") == set()
+        for csv_name, df in CSVS_BEFORE.items():
+            df.to_csv(join(export_dir, self.export_name(csv_name)), index=False)
+        arch_diff.run()
+        assert isfile(index_file)
+        assert arch_diff.archived_time_values("sig", "state") == {
+            "20200801", "20200802", "20200803"}
+
+        # A missing index is rebuilt from the archive
+        remove(index_file)
+        assert arch_diff.archived_time_values("sig", "state") == {
+            "20200801", "20200802", "20200803"}
+        assert isfile(index_file)
+
+        # Diffing reads the index and the exported months, not the whole history
+        loaded_months = []
+        load_archive = arch_diff.load_archive
+        def recording_load_archive(signal, geo_type, months=None, **kwargs):
+            loaded_months.append(months)
+            return load_archive(signal, geo_type, months=months, **kwargs)
+        monkeypatch.setattr(arch_diff, "load_archive", recording_load_archive)
+        for f in listdir(export_dir):
+            remove(join(export_dir, f))
+        CSVS_AFTER["csv1"].to_csv(join(export_dir, self.export_name("csv1")), index=False)
+        deleted_files, _, _ = arch_diff.diff_exports()
+        assert loaded_months and None not in loaded_months
+        assert deleted_files == [
+            join(cache_dir, self.export_name(f)) for f in ["csv0", "csv2"]]
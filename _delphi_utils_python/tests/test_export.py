@@ -4,12 +4,15 @@ from datetime import datetime
 from os import listdir, remove
 from os.path import join
 
+import numpy as np
 import pandas as pd
-from delphi_utils import create_export_csv
+from delphi_utils import (
+    ArchiveDiffer, create_export_csv, create_export_csv_diffs, write_sensor_csvs)
 
 
 class TestExport:
-    def test_export_csv(self):
+    @pytest.mark.parametrize("n_workers", [1, 2])
+    def test_export_csv(self, n_workers):
 
         # Clean receiving directory
         for fname in listdir("test_dir"):
@@ -36,6 +39,7 @@ class TestExport:
             metric="deaths",
             geo_res="county",
             sensor="test",
+            n_workers=n_workers,
         )
 
         assert set(listdir("test_dir")) == set(
@@ -45,3 +49,92 @@ class TestExport:
                 "20200315_county_deaths_test.csv",
             ]
         )
+        with open(join("test_dir", "20200215_county_deaths_test.csv")) as f:
+            assert f.read() == (
+                "geo_id,val,se,sample_size\n51093,3.6,0.15,100\n51175,2.1,0.22,100\n"
+            )
+
+    def test_export_csv_diffs(self, tmp_path):
+        cache_dir = tmp_path / "cache"
+        export_dir = tmp_path / "export"
+        cache_dir.mkdir()
+        export_dir.mkdir()
+        arch_diff = ArchiveDiffer(str(cache_dir), str(export_dir))
+        arch_diff._cache_updated = True
+
+        df = pd.DataFrame(
+            {
+                "geo_id": ["51093", "51175", "51093", "51175"],
+                "timestamp": [datetime(2020, 2, 15)] * 2 + [datetime(2020, 3, 1)] * 2,
+                "val": [3.6, 2.1, 2.2, 0.1 + 0.2],
+                "se": [0.15, np.nan, 0.20, 0.34],
+                "sample_size": [100, 100, 101, 100],
+            }
+        )
+        kwargs = {
+            "start_date": datetime(2020, 2, 15),
+            "arch_diff": arch_diff,
+            "metric": "deaths",
+            "geo_res": "county",
+            "sensor": "test",
+        }
+
+        # Everything is new at first, and fills the cache
+        export_files, cached_files = create_export_csv_diffs(df, **kwargs)
+        filenames = ["20200215_county_deaths_test.csv", "20200301_county_deaths_test.csv"]
+        assert export_files == [str(export_dir / f) for f in filenames]
+        assert cached_files == [str(cache_dir / f) for f in filenames]
+        assert set(listdir(cache_dir)) == set(filenames)
+        # The cache holds the exports exactly as create_export_csv writes them
+        with open(cache_dir / filenames[0]) as f:
+            assert f.read() == "geo_id,val,se,sample_size\n51093,3.6,0.15,100\n51175,2.1,NA,100\n"
+        for f in filenames:
+            remove(export_dir / f)
+
+        # Unchanged values, including NAs and floats without short representations, are
+        # not exported again, and only the changed rows are
+        df.loc[3, "val"] = 2.5
+        export_files, cached_files = create_export_csv_diffs(df, **kwargs)
+        assert export_files == [str(export_dir / filenames[1])]
+        assert cached_files == [str(cache_dir / filenames[1])]
+        assert pd.read_csv(export_files[0], dtype={"geo_id": str}).to_dict("list") == {
+            "geo_id": ["51175"], "val": [2.5], "se": [0.34], "sample_size": [100.0]
+        }
+        cached = pd.read_csv(cached_files[0], dtype={"geo_id": str})
+        assert cached["val"].tolist() == [2.2, 2.5]
+
+    @pytest.mark.parametrize("write_se", [False, True])
+    def test_write_sensor_csvs(self, tmp_path, write_se):
+        kwargs = {
+            "output_path": str(tmp_path),
+            "geo_level": "county",
+            "signal_name": "test",
+            "dates": [datetime(2020, 5, 1), datetime(2020, 5, 2)],
+            "geo_ids": ["51093", "51175"],
+            "rates": np.array([[0.1, 0.5], [1.0, 2.0]]),
+            "se": np.array([[0.1, 1.0], [0.5, np.nan]]),
+            "include": np.array([[True, True], [True, False]]),
+            "write_se": write_se,
+        }
+
+        assert write_sensor_csvs(**kwargs) == 3
+        with open(tmp_path / "20200501_county_test.csv") as f:
+            assert f.read() == (
+                "geo_id,val,se,direction,sample_size\n"
+                + ("51093,0.100000,0.1,NA,NA\n51175,1.000000,0.5,NA,NA\n" if write_se else
+                   "51093,0.100000,NA,NA,NA\n51175,1.000000,NA,NA,NA\n")
+            )
+        with open(tmp_path / "20200502_county_test.csv") as f:
+            assert f.read() == (
+                "geo_id,val,se,direction,sample_size\n"
+                + ("51093,0.500000,1.0,NA,NA\n" if write_se else "51093,0.500000,NA,NA,NA\n")
+            )
+
+        # Included values must be valid
+        for name, geo_index, date_index, value in [
+            ("rates", 0, 1, np.nan), ("se", 0, 1, np.nan), ("se", 1, 0, 10)
+        ]:
+            invalid_kwargs = {**kwargs, name: kwargs[name].copy()}
+            invalid_kwargs[name][geo_index, date_index] = value
+            with pytest.raises(AssertionError):
+                write_sensor_csvs(**invalid_kwargs)
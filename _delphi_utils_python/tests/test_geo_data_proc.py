@@ -0,0 +1,101 @@
+from importlib.util import module_from_spec, spec_from_file_location
+from os.path import dirname, join
+import subprocess
+import sys
+
+import pytest
+
+GEO_DATA_PROC = join(dirname(__file__), "..", "data_proc", "geomap", "geo_data_proc.py")
+
+
+@pytest.fixture
+def geo_data_proc(tmp_path, monkeypatch):
+    """The crosswalk build script, with small build steps writing into tmp_path."""
+    pytest.importorskip("requests")
+    spec = spec_from_file_location("geo_data_proc", GEO_DATA_PROC)
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+    module.runs = []
+
+    def copy_source(source_dir):
+        module.runs.append("copy_source")
+        with open(join(source_dir, "a.csv")) as f:
+            (output_dir / "a_table.csv").write_text(f.read())
+
+    def upper_source(source_dir):
+        module.runs.append("upper_source")
+        with open(join(source_dir, "b.csv")) as f:
+            (output_dir / "b_table.csv").write_text(f.read().upper())
+
+    def derive_table():
+        module.runs.append("derive_table")
+        (output_dir / "ab_table.csv").write_text(
+            (output_dir / "a_table.csv").read_text()
+            + (output_dir / "b_table.csv").read_text())
+
+    def write_store():
+        module.runs.append("write_store")
+        (output_dir / "store").mkdir(exist_ok=True)
+        (output_dir / "store" / "index.json").write_text("{}")
+
+    monkeypatch.setattr(module, "OUTPUT_DIR", str(output_dir))
+    monkeypatch.setattr(module, "STORE_OUT_DIR", str(output_dir / "store"))
+    monkeypatch.setattr(module, "SOURCE_FILES", {
+        "a": ("https://unused/a.csv", "a.csv"), "b": ("https://unused/b.csv", "b.csv")})
+    monkeypatch.setattr(module, "BUILD_STEPS", [
+        (copy_source, ["a"], [], ["a_table.csv"]),
+        (upper_source, ["b"], [], ["b_table.csv"]),
+        (derive_table, [], ["a_table.csv", "b_table.csv"], ["ab_table.csv"]),
+    ])
+    monkeypatch.setattr(module, "write_store", write_store)
+    return module
+
+
+class TestBuildCrosswalks:
+    def test_incremental(self, tmp_path, geo_data_proc):
+        source_dir = tmp_path / "source"
+        source_dir.mkdir()
+        (source_dir / "a.csv").write_text("a\n1\n")
+        (source_dir / "b.csv").write_text("b\nx\n")
+
+        geo_data_proc.build_crosswalks(str(source_dir), incremental=True)
+        assert geo_data_proc.runs == [
+            "copy_source", "upper_source", "derive_table", "write_store"]
+
+        # Unchanged fingerprints skip the rebuild, even of rewritten source files
+        geo_data_proc.runs.clear()
+        (source_dir / "b.csv").write_text("b\nx\n")
+        geo_data_proc.build_crosswalks(str(source_dir), incremental=True)
+        assert geo_data_proc.runs == []
+
+        # A changed source file reruns its step, and the steps reading its tables
+        (source_dir / "a.csv").write_text("a\n2\n")
+        geo_data_proc.build_crosswalks(str(source_dir), incremental=True)
+        assert geo_data_proc.runs == ["copy_source", "derive_table", "write_store"]
+        assert (tmp_path / "output" / "ab_table.csv").read_text() == "a\n2\nB\nX\n"
+
+        # A missing output table is rebuilt
+        geo_data_proc.runs.clear()
+        (tmp_path / "output" / "b_table.csv").unlink()
+        geo_data_proc.build_crosswalks(str(source_dir), incremental=True)
+        assert geo_data_proc.runs == ["upper_source", "write_store"]
+
+        # A full build reruns every step
+        geo_data_proc.runs.clear()
+        geo_data_proc.build_crosswalks(str(source_dir))
+        assert geo_data_proc.runs == [
+            "copy_source", "upper_source", "derive_table", "write_store"]
+
+        with pytest.raises(ValueError):
+            geo_data_proc.build_crosswalks(incremental=True)
+
+    def test_download_requires_source_dir(self):
+        pytest.importorskip("requests")
+        out = subprocess.run(
+            [sys.executable, GEO_DATA_PROC, "--download"], capture_output=True, text=True
+        )
+        assert out.returncode == 2
+        assert "--download requires --source_dir" in out.stderr
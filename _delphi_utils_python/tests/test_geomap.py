@@ -1,3 +1,8 @@
+from os import environ, sysconf
+import subprocess
+import sys
+
+from delphi_utils.crosswalk_store import read_crosswalk_table
 from delphi_utils.geomap import GeoMapper
 
 import pytest
@@ -6,6 +11,34 @@ import pandas as pd
 import numpy as np
 
 
+# Measures the peak RSS growth of an in-place conversion of a synthetic fips x date
+# frame with argv[1] rows, relative to the size of the frame
+MEMORY_SCRIPT = """
+import resource, sys
+import numpy as np, pandas as pd
+from delphi_utils import GeoMapper
+
+gmpr = GeoMapper()
+fips = gmpr._load_crosswalk("fips", "pop")["fips"].values
+gmpr._load_crosswalk("fips", "state")
+n_days = int(sys.argv[1]) // len(fips)
+df = pd.DataFrame({
+    "fips": np.repeat(fips, n_days),
+    "date": np.tile(pd.date_range("2020-01-01", periods=n_days).values, len(fips)),
+    "den": np.ones(len(fips) * n_days),
+    "num": np.ones(len(fips) * n_days),
+})
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.argv[2] == "megacounty":
+    gmpr.fips_to_megacounty(df, 100, 7, thr_col="den", inplace=True)
+else:
+    gmpr.replace_geocode(df, "fips", "state_id", inplace=True)
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print((after - before) * 1024 / df.memory_usage(index=True).sum())
+"""
+MEMORY_TEST_ROWS = int(environ.get("DELPHI_UTILS_MEMORY_TEST_ROWS", 50_000_000))
+
+
 class TestGeoMapper:
     fips_data = pd.DataFrame(
         {
@@ -138,6 +171,72 @@ class TestGeoMapper:
         cw = gmpr._load_crosswalk(from_code="zip", to_code="state")
         assert cw.groupby("zip")["weight"].sum().round(5).eq(1.0).all()
 
+    def test_crosswalk_cache(self):
+        # Crosswalks are parsed once and then shared between GeoMapper instances
+        cw = GeoMapper()._load_crosswalk(from_code="zip", to_code="fips")
+        assert GeoMapper()._load_crosswalk(from_code="zip", to_code="fips") is cw
+
+    def test_crosswalk_store(self, tmp_path):
+        gmpr = GeoMapper()
+        gmpr.build_crosswalk_store(str(tmp_path))
+        gmpr_store = GeoMapper(crosswalk_store=str(tmp_path))
+        for from_code, to_code in [("zip", "fips"), ("state", "state"), ("fips", "pop")]:
+            cw = gmpr._load_crosswalk(from_code=from_code, to_code=to_code)
+            cw_store = gmpr_store._load_crosswalk(from_code=from_code, to_code=to_code)
+            assert tuple(cw_store.columns) == tuple(cw.columns)
+            for col in cw.columns:
+                if col == "weight":
+                    assert cw_store[col].dtype == np.float32
+                    assert np.allclose(cw_store[col], cw[col])
+                else:
+                    assert (cw_store[col] == cw[col]).all()
+        new_data = gmpr.replace_geocode(self.zip_data, "zip", "fips")
+        new_data_store = gmpr_store.replace_geocode(self.zip_data, "zip", "fips")
+        assert np.allclose(new_data[["count", "total"]], new_data_store[["count", "total"]])
+
+        # Numeric columns and categorical codes are the memory-mapped arrays, not copies
+        def memory_map(values):
+            while values is not None and not isinstance(values, np.memmap):
+                values = getattr(values, "base", None)
+            return values
+
+        cw_store = read_crosswalk_table(str(tmp_path), "zip", "fips", categorical=True)
+        for values in [
+            cw_store["weight"].values,
+            cw_store["zip"].cat.codes.values,
+            cw_store["fips"].cat.codes.values,
+        ]:
+            mmap = memory_map(values)
+            assert mmap is not None and np.shares_memory(values, mmap)
+        pop_store = read_crosswalk_table(str(tmp_path), "fips", "pop")
+        assert np.shares_memory(pop_store["pop"].values, memory_map(pop_store["pop"].values))
+
+        # Categorical crosswalks are read from the stored codes, with the same categories
+        for geocode in ["zip", "fips", "state_id"]:
+            assert gmpr_store.geocode_categories(geocode).equals(
+                gmpr.geocode_categories(geocode)
+            )
+        cw = gmpr._categorical_crosswalk("zip", "fips")
+        cw_store = gmpr_store._categorical_crosswalk("zip", "fips")
+        for col in ["zip", "fips"]:
+            assert cw_store[col].cat.categories.equals(cw[col].cat.categories)
+            assert (cw_store[col].cat.codes == cw[col].cat.codes).all()
+        for data, from_code, new_code in [
+            (self.zip_data, "zip", "fips"),
+            (self.fips_data_5, "fips", "state_id"),
+            (self.jhu_uid_data, "jhu_uid", "hrr"),
+        ]:
+            new_data = gmpr.replace_geocode(data, from_code, new_code, categorical=True)
+            new_data_store = gmpr_store.replace_geocode(
+                data, from_code, new_code, categorical=True
+            )
+            assert new_data[new_code].equals(new_data_store[new_code])
+            assert np.allclose(
+                new_data[["count", "total"]], new_data_store[["count", "total"]]
+            )
+        with pytest.raises(ValueError):
+            GeoMapper(crosswalk_store=str(tmp_path / "missing"))
+
     def test_load_zip_fips_table(self):
         gmpr = GeoMapper()
         fips_data = gmpr._load_crosswalk(from_code="zip", to_code="fips")
@@ -221,6 +320,17 @@ class TestGeoMapper:
             new_data = gmpr.megacounty_creation(
                 self.mega_data_2, 6, 50, thr_col="_thr_col_roll"
             )
+        # Trailing window sums match a per-FIPS rolling sum
+        mega = gmpr.megacounty_creation(self.mega_data, 40, 5)
+        rolled = (
+            self.mega_data.set_index("date").groupby("fips")["visits"].rolling("5D").sum()
+        )
+        expected = np.where(
+            rolled.values > 40, rolled.index.get_level_values("fips"), "01000"
+        )
+        assert mega.index.equals(rolled.index)
+        assert (mega.values == expected).all()
+        assert (mega == "01002").any() and (mega == "01000").any()
         new_data = gmpr.fips_to_megacounty(
             self.mega_data, 6, 50, count_cols=["count", "visits"]
         )
@@ -275,6 +385,223 @@ class TestGeoMapper:
         assert new_data.shape[0] == 4
         assert np.allclose(new_data["count"].sum(), self.zip_data["count"].sum())
 
+    def test_replace_geocode_sparse(self):
+        gmpr = GeoMapper()
+        cases = [
+            (self.fips_data_3, "fips", "zip"),
+            (self.fips_data_3, "fips", "hrr"),
+            (self.fips_data_3, "fips", "msa"),
+            (self.fips_data_4, "fips", "state_id"),
+            (self.fips_data_5, "fips", "state_code"),
+            (self.zip_data, "zip", "fips"),
+            (self.zip_data, "zip", "msa"),
+            (self.zip_data, "zip", "nation"),
+            (self.jhu_uid_data, "jhu_uid", "fips"),
+        ]
+        for data, from_code, new_code in cases:
+            new_data = gmpr.replace_geocode(data, from_code, new_code)
+            new_data2 = gmpr.replace_geocode(data, from_code, new_code, engine="sparse")
+            assert tuple(new_data.columns) == tuple(new_data2.columns)
+            assert (new_data.dtypes == new_data2.dtypes).all()
+            assert new_data.iloc[:, :2].equals(new_data2.iloc[:, :2])
+            assert np.allclose(
+                new_data[["count", "total"]].values, new_data2[["count", "total"]].values
+            )
+
+        # Unweighted integer data keeps its dtype and exact values
+        new_data = gmpr.replace_geocode(self.zip_data, "zip", "hrr")
+        new_data2 = gmpr.replace_geocode(self.zip_data, "zip", "hrr", engine="sparse")
+        assert new_data.equals(new_data2)
+
+        new_data = gmpr.replace_geocode(
+            self.fips_data_5.drop(columns=["date"]), "fips", "hrr", date_col=None,
+            engine="sparse"
+        )
+        assert new_data["hrr"].tolist() == ["1", "183", "184", "382", "7"]
+        assert np.allclose(new_data["count"], [1.772347, 7157.392404, 2863.607596, 1.0, 0.227653])
+
+        with pytest.raises(ValueError):
+            gmpr.replace_geocode(self.zip_data, "zip", "fips", engine="unknown")
+
+    def test_replace_geocodes(self):
+        gmpr = GeoMapper()
+        new_codes = ["fips", "state_id", "msa", "hrr", "nation"]
+        new_dfs = gmpr.replace_geocodes(self.fips_data_5, "fips", new_codes)
+        assert set(new_dfs.keys()) == set(new_codes)
+        for new_code in new_codes[1:]:
+            new_data = gmpr.replace_geocode(self.fips_data_5, "fips", new_code)
+            assert new_data.iloc[:, :2].equals(new_dfs[new_code].iloc[:, :2])
+            assert np.allclose(
+                new_data[["count", "total"]].values,
+                new_dfs[new_code][["count", "total"]].values,
+            )
+        # Aggregating to from_code itself keeps the geocodes
+        assert new_dfs["fips"]["fips"].tolist() == ["01123", "18181", "48253", "72003"]
+        assert new_dfs["fips"]["count"].tolist() == [2, 10021, 1, 0]
+
+        new_dfs = gmpr.replace_geocodes(
+            self.zip_data, "zip", ["fips", "hrr"], new_col="geo_id", data_cols=["count"]
+        )
+        assert tuple(new_dfs["hrr"].columns) == ("date", "geo_id", "count")
+        assert np.allclose(new_dfs["fips"]["count"].sum(), self.zip_data["count"].sum())
+
+    def test_replace_geocode_chunked(self, tmp_path):
+        gmpr = GeoMapper()
+        for new_code in ["fips", "state_id", "hrr", "nation"]:
+            new_data = gmpr.replace_geocode(self.zip_data, "zip", new_code)
+            chunks = (self.zip_data.iloc[i : i + 2].copy() for i in range(0, 6, 2))
+            chunked_data = gmpr.replace_geocode_chunked(chunks, "zip", new_code)
+            pd.testing.assert_frame_equal(new_data, chunked_data, check_dtype=False)
+
+        # The chunks passed in are left unchanged
+        chunks = [self.zip_data.iloc[i : i + 2].copy() for i in range(0, 6, 2)]
+        originals = [chunk.copy() for chunk in chunks]
+        gmpr.replace_geocode_chunked(chunks, "zip", "hrr")
+        for chunk, original in zip(chunks, originals):
+            pd.testing.assert_frame_equal(chunk, original)
+
+        csv_file = tmp_path / "zip_data.csv"
+        self.zip_data.to_csv(csv_file, index=False)
+        new_data = gmpr.replace_geocode(self.zip_data, "zip", "msa", new_col="geo_id")
+        chunked_data = gmpr.replace_geocode_chunked(
+            str(csv_file), "zip", "msa", new_col="geo_id", chunksize=4
+        )
+        pd.testing.assert_frame_equal(new_data, chunked_data, check_dtype=False)
+
+        with pytest.raises(ValueError):
+            gmpr.replace_geocode_chunked([], "zip", "fips")
+
+    def test_categorical_geocodes(self):
+        gmpr = GeoMapper()
+        for data, from_code, new_code in [
+            (self.fips_data_3, "fips", "hrr"),
+            (self.fips_data_5, "fips", "state_id"),
+            (self.zip_data, "zip", "fips"),
+            (self.zip_data, "zip", "nation"),
+            (self.jhu_uid_data, "jhu_uid", "fips"),
+        ]:
+            new_data = gmpr.replace_geocode(data, from_code, new_code)
+            new_data2 = gmpr.replace_geocode(data, from_code, new_code, categorical=True)
+            assert pd.api.types.is_categorical_dtype(new_data2[new_code])
+            new_data2[new_code] = new_data2[new_code].astype(str)
+            assert new_data.iloc[:, :2].equals(new_data2.iloc[:, :2])
+            assert np.allclose(
+                new_data[["count", "total"]].values, new_data2[["count", "total"]].values
+            )
+
+        # Integer geocodes share the crosswalk categories, unknown ones are appended
+        new_data = gmpr.add_geocode(
+            self.fips_data_5, "fips", "hrr", dropna=False, categorical=True
+        )
+        assert new_data["fips"].cat.categories.equals(gmpr.geocode_categories("fips"))
+        assert set(new_data["fips"].astype(str)) == {"01123", "48253", "72003", "18181"}
+        new_data = gmpr.add_geocode(
+            self.fips_data_3, "fips", "hrr", dropna=False, categorical=True
+        )
+        categories = new_data["fips"].cat.categories
+        assert categories[:-1].equals(gmpr.geocode_categories("fips"))
+        assert categories[-1] == "10999"
+        assert new_data["hrr"].isna().sum() == 3
+
+    def test_composed_crosswalks(self):
+        gmpr = GeoMapper()
+        assert gmpr.plan_conversion("jhu_uid", "hrr") == ["jhu_uid", "fips", "hrr"]
+        assert gmpr.plan_conversion("state_id", "hhs_region_number") == [
+            "state_id", "state_code", "hhs_region_number"
+        ]
+        assert gmpr.plan_conversion("hrr", "msa") is None
+
+        cw = gmpr._get_crosswalk("jhu_uid", "hrr")
+        assert tuple(cw.columns) == ("jhu_uid", "hrr", "weight")
+        assert gmpr._get_crosswalk("jhu_uid", "hrr") is cw
+        cw = gmpr._get_crosswalk("state_id", "hhs_region_number")
+        assert tuple(cw.columns) == ("state_id", "hhs_region_number")
+
+        # There is no crosswalk from a geocode to itself, conversions keep the geocodes
+        assert gmpr.plan_conversion("zip", "zip") == ["zip"]
+        for code in ["zip", "state_id"]:
+            with pytest.raises(ValueError, match="to itself"):
+                gmpr._get_crosswalk(code, code)
+        new_data = gmpr.add_geocode(self.zip_data, "zip", "zip", new_col="zip2")
+        assert new_data["zip2"].equals(self.zip_data["zip"])
+        new_data = gmpr.replace_geocode(self.zip_data, "zip", "zip")
+        new_data2 = gmpr.replace_geocode(self.zip_data, "zip", "zip", engine="sparse")
+        expected = self.zip_data.sort_values(["date", "zip"]).reset_index(drop=True)
+        assert new_data[["date", "zip"]].equals(expected[["date", "zip"]])
+        assert np.allclose(new_data[["count", "total"]], expected[["count", "total"]])
+        assert new_data2[["date", "zip"]].equals(expected[["date", "zip"]])
+        assert np.allclose(new_data2[["count", "total"]], expected[["count", "total"]])
+
+        for engine in ["merge", "sparse"]:
+            new_data = gmpr.replace_geocode(self.jhu_uid_data, "jhu_uid", "hrr", engine=engine)
+            new_data2 = gmpr.replace_geocode(
+                gmpr.replace_geocode(self.jhu_uid_data, "jhu_uid", "fips"), "fips", "hrr"
+            )
+            assert new_data.iloc[:, :2].equals(new_data2.iloc[:, :2])
+            assert np.allclose(
+                new_data[["count", "total"]].values, new_data2[["count", "total"]].values
+            )
+
+        new_data = gmpr.replace_geocode(self.zip_data, "zip", "hhs_region_number")
+        assert new_data["hhs_region_number"].tolist() == ["5", "9", "5", "9"]
+        with pytest.raises(ValueError):
+            gmpr.replace_geocode(self.zip_data, "hrr", "msa", from_col="zip")
+
+    def test_inplace(self):
+        gmpr = GeoMapper()
+        # Many to one: the new geocode is added to the input itself
+        data = self.fips_data_5.copy()
+        new_data = gmpr.add_geocode(data, "fips", "msa", inplace=True)
+        assert new_data is data
+        assert data["fips"].tolist() == ["48253", "72003"]
+        assert data["msa"].tolist() == ["10180", "10380"]
+
+        # Unmatched rows are dropped by position, not by their (duplicate) index labels
+        data = self.fips_data_5.set_index(pd.Index([0, 0, 1, 1], name="key"))
+        new_data = gmpr.add_geocode(data, "fips", "msa", inplace=True)
+        assert new_data is data
+        assert data.index.tolist() == [0, 1] and data.index.name == "key"
+        assert data["fips"].tolist() == ["48253", "72003"]
+        assert data["msa"].tolist() == ["10180", "10380"]
+
+        for from_code, new_code in [("fips", "state_id"), ("fips", "hrr"), ("fips", "nation")]:
+            new_data = gmpr.replace_geocode(self.fips_data_5, from_code, new_code)
+            new_data2 = gmpr.replace_geocode(
+                self.fips_data_5.copy(), from_code, new_code, inplace=True
+            )
+            assert new_data.equals(new_data2)
+
+        new_data = gmpr.fips_to_megacounty(self.mega_data, 6, 50)
+        data = self.mega_data.copy()
+        new_data2 = gmpr.fips_to_megacounty(data, 6, 50, inplace=True)
+        assert new_data.equals(new_data2)
+        assert "fips" not in data.columns
+
+        # With count_cols, the other columns are dropped from the caller's frame itself
+        data = self.mega_data.assign(extra=1)
+        new_data = gmpr.fips_to_megacounty(data, 6, 50, count_cols=["count", "visits"])
+        assert "extra" in data.columns
+        new_data2 = gmpr.fips_to_megacounty(
+            data, 6, 50, count_cols=["count", "visits"], inplace=True
+        )
+        assert new_data.equals(new_data2)
+        assert set(data.columns) == {"date", "count", "visits", "megafips"}
+
+    @pytest.mark.skipif(
+        sysconf("SC_AVPHYS_PAGES") * sysconf("SC_PAGE_SIZE") < MEMORY_TEST_ROWS * 128,
+        reason="not enough memory for the synthetic input",
+    )
+    @pytest.mark.parametrize("conversion", ["megacounty", "state_id"])
+    def test_inplace_memory(self, conversion):
+        # Peak memory of in-place conversions stays within the size of the input
+        out = subprocess.run(
+            [sys.executable, "-c", MEMORY_SCRIPT, str(MEMORY_TEST_ROWS), conversion],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        assert float(out.stdout) < 1.25
+
     def test_add_population_column(self):
         gmpr = GeoMapper()
         new_data = gmpr.add_population_column(self.fips_data_3, "fips")
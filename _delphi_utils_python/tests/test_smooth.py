@@ -0,0 +1,50 @@
+import pytest
+
+import numpy as np
+
+from delphi_utils.smooth import kernel_width, left_gauss_linear
+
+
+def left_gauss_linear_reference(arr, bandwidth):
+    """The fit on the whole history at every index, that left_gauss_linear truncates."""
+    n = len(arr)
+    out = np.zeros(n)
+    X = np.vstack([np.ones(n), np.arange(n)]).T
+    for idx in range(n):
+        weights = np.exp(-((np.arange(idx + 1) - idx) ** 2) / bandwidth)
+        XwX = np.dot(X[: (idx + 1), :].T * weights, X[: (idx + 1), :])
+        Xwy = np.dot(X[: (idx + 1), :].T * weights, arr[: (idx + 1)])
+        try:
+            out[idx] = np.dot(X[idx], np.linalg.solve(XwX, Xwy))
+        except np.linalg.LinAlgError:
+            out[idx] = np.nan
+    return out
+
+
+class TestLeftGaussLinear:
+    def test_kernel_width(self):
+        width = kernel_width(100)
+        assert np.exp(-((width - 1) ** 2) / 100) >= np.finfo(float).eps
+        assert np.exp(-(width ** 2) / 100) < np.finfo(float).eps
+
+    @pytest.mark.parametrize("bandwidth", [1, 10, 100, 1000])
+    @pytest.mark.parametrize("n_days", [1, 2, 30, 300])
+    def test_matches_reference(self, bandwidth, n_days):
+        arr = np.random.default_rng(0).poisson(100, n_days).astype(float)
+        expected = left_gauss_linear_reference(arr, bandwidth)
+        smoothed = left_gauss_linear(arr, bandwidth)
+        assert np.isnan(smoothed[0])
+        assert np.allclose(smoothed[1:], expected[1:], rtol=1e-8)
+
+    def test_linear_signals(self):
+        signal = np.ones(10)
+        assert np.allclose(left_gauss_linear(signal, 100)[1:], signal[1:])
+
+        signal = np.arange(1, 10) + np.random.normal(0, 1, 9)
+        assert np.allclose(left_gauss_linear(signal, 0.1)[1:], signal[1:])
+
+    def test_rows_are_independent(self):
+        arr = np.random.default_rng(0).poisson(100, (3, 50)).astype(float)
+        smoothed = left_gauss_linear(arr, 100)
+        for row, smoothed_row in zip(arr, smoothed):
+            assert np.array_equal(left_gauss_linear(row, 100), smoothed_row, equal_nan=True)
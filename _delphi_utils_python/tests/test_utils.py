@@ -2,7 +2,7 @@ import pytest
 
 import os
 
-from delphi_utils import read_params
+from delphi_utils import link_or_copy, read_params
 
 
 class TestReadParams:
@@ -14,3 +14,24 @@ class TestReadParams:
         os.remove("params.json")
         params = read_params()
         assert params["test"] == "yes"
+
+
+class TestLinkOrCopy:
+    @pytest.mark.parametrize("hardlink", [False, True])
+    def test_link_or_copy(self, tmp_path, hardlink):
+        src = tmp_path / "src.csv"
+        dst = tmp_path / "dst.csv"
+        src.write_text("geo_id,val\n1,1.0\n")
+        dst.write_text("old")
+
+        link_or_copy(str(src), str(dst), hardlink)
+        assert dst.read_text() == src.read_text()
+        # Nothing is left behind but the copy
+        assert sorted(os.listdir(tmp_path)) == ["dst.csv", "src.csv"]
+        if not hardlink:
+            assert not os.path.samefile(src, dst)
+
+    def test_missing_file(self, tmp_path):
+        with pytest.raises(FileNotFoundError):
+            link_or_copy(str(tmp_path / "missing.csv"), str(tmp_path / "dst.csv"), True)
+        assert os.listdir(tmp_path) == []
@@ -0,0 +1,90 @@
+import pytest
+
+import numpy as np
+import pandas as pd
+
+from delphi_utils.weekday import fit_weekday_params
+
+WEEKDAY_EFFECTS = np.array([0.1, 0.05, 0, 0, -0.05, -0.2])
+
+
+def weekday_design(dayofweek):
+    """Weekday indicators, with -1 for all weekdays on Sundays."""
+    design = np.zeros((len(dayofweek), 6))
+    not_sunday = np.flatnonzero(dayofweek != 6)
+    design[not_sunday, dayofweek[not_sunday]] = 1
+    design[dayofweek == 6, :] = -1
+    return design
+
+
+def objective(params, nums, denoms, dayofweek, lam=10):
+    """Penalized negative mean Poisson log likelihood, as in the indicators' cvxpy fit."""
+    n_days = len(nums)
+    eta = weekday_design(dayofweek) @ params[:6] + params[6:]
+    return ((denoms @ np.exp(eta) - nums @ eta) / n_days
+            + lam * lam / (n_days - 2) * np.abs(np.diff(params[6:], 3)).sum())
+
+
+def synthetic_counts(n_days, scale, seed=0):
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range("2020-02-01", periods=n_days)
+    dayofweek = np.asarray(dates.dayofweek)
+    effects = np.append(WEEKDAY_EFFECTS, -WEEKDAY_EFFECTS.sum())[dayofweek]
+    trend = np.log(0.05 + 0.03 * np.sin(np.arange(n_days) / 30))
+    denoms = rng.poisson(scale, n_days).astype(float) + 1
+    nums = rng.poisson(denoms * np.exp(trend + effects)).astype(float)
+    return nums, denoms, dayofweek
+
+
+class TestFitWeekdayParams:
+    @pytest.mark.parametrize("n_days, scale", [(60, 1e3), (300, 1e5), (700, 1e6)])
+    def test_optimal(self, n_days, scale):
+        nums, denoms, dayofweek = synthetic_counts(n_days, scale)
+        params, converged = fit_weekday_params(nums, denoms, dayofweek)
+        assert converged
+        assert params.shape == (n_days + 6,)
+
+        # the weekday effects are stationary, and no perturbation improves the objective
+        grad = (denoms * np.exp(weekday_design(dayofweek) @ params[:6] + params[6:])
+                - nums) / n_days
+        assert np.allclose(weekday_design(dayofweek).T @ grad, 0, atol=1e-6 * scale)
+        best = objective(params, nums, denoms, dayofweek)
+        rng = np.random.default_rng(1)
+        for _ in range(20):
+            perturbed = params + rng.normal(0, 1e-4, params.shape)
+            assert objective(perturbed, nums, denoms, dayofweek) >= best
+
+    def test_recovers_weekday_effects(self):
+        nums, denoms, dayofweek = synthetic_counts(300, 1e5)
+        params, _ = fit_weekday_params(nums, denoms, dayofweek)
+        assert np.allclose(params[:6], WEEKDAY_EFFECTS, atol=0.01)
+
+    def test_not_converged(self):
+        nums, denoms, dayofweek = synthetic_counts(300, 1e5)
+        params, converged = fit_weekday_params(nums, denoms, dayofweek, max_iter=3)
+        assert not converged
+        assert params.shape == (306,)
+
+    def test_zero_nums(self):
+        _, denoms, dayofweek = synthetic_counts(60, 1e3)
+        params, converged = fit_weekday_params(np.zeros(60), denoms, dayofweek)
+        assert converged
+        assert np.array_equal(params[:6], np.zeros(6))
+        assert np.all(np.isneginf(params[6:]))
+
+    def test_matches_cvxpy(self):
+        cp = pytest.importorskip("cvxpy")
+        nums, denoms, dayofweek = synthetic_counts(200, 1e4)
+        params, _ = fit_weekday_params(nums, denoms, dayofweek)
+
+        n_days = len(nums)
+        design = np.hstack([weekday_design(dayofweek), np.eye(n_days)])
+        b = cp.Variable(n_days + 6)
+        ll = (nums @ (design @ b + np.log(denoms))
+              - cp.sum(cp.exp(design @ b + np.log(denoms)))) / n_days
+        penalty = 10 * cp.norm(cp.diff(b[6:], 3), 1) / (n_days - 2)
+        cp.Problem(cp.Minimize(-ll + 10 * penalty)).solve()
+
+        assert np.allclose(params[:6], b.value[:6], atol=1e-3)
+        assert (objective(params, nums, denoms, dayofweek)
+                <= objective(b.value, nums, denoms, dayofweek) + 1e-8)
@@ -12,6 +12,7 @@ import logging
 # third party
 import numpy as np
 import pandas as pd
+from delphi_utils.smooth import kernel_width
 
 # first party
 from .config import Config
@@ -61,37 +62,55 @@ class CHCSensor:
             den = den.values
         if isinstance(num,(pd.DataFrame,pd.Series)):
             num = num.values
-        revden = den[::-1]
-        revnum = num[::-1].reshape(-1, 1)
-        new_num = np.full_like(revnum, np.nan, dtype=float)
-        new_den = np.full_like(revden, np.nan, dtype=float)
-        n, p = revnum.shape
-
-        for i in range(n):
-            visit_cumsum = revden[i:].cumsum()
-
-            # calculate backfill window
-            closest_fill_day = np.where(visit_cumsum >= min_visits_to_fill)[0]
-            if len(closest_fill_day) > 0:
-                closest_fill_day = min(k, closest_fill_day[0])
-            else:
-                closest_fill_day = k
-
-            if closest_fill_day == 0:
-                new_den[i] = revden[i]
-
-                for j in range(p):
-                    new_num[i, j] = revnum[i, j]
-            else:
-                den_bin = revden[i: (i + closest_fill_day + 1)]
-                new_den[i] = den_bin.sum()
-
-                for j in range(p):
-                    num_bin = revnum[i: (i + closest_fill_day + 1), j]
-                    new_num[i, j] = num_bin.sum()
-
-        new_num = new_num[::-1]
-        new_den = new_den[::-1]
+        new_num, new_den = CHCSensor.backfill_panel(
+            np.reshape(num, (1, -1)), np.reshape(den, (1, -1)), k, min_visits_to_fill)
+        return new_num.reshape(-1, 1), new_den[0]
+
+    @staticmethod
+    def backfill_panel(
+            num,
+            den,
+            k=Config.MAX_BACKFILL_WINDOW,
+            min_visits_to_fill=Config.MIN_CUM_VISITS):
+        """
+        Same as backfill, on matrices with one row per geo_id, for all days at once.
+
+        The visits of the last k + 1 days of every day are gathered into one array, whose
+        cumulative sums give the window of each day without a loop over days. The bins
+        are then summed by length, adding the same values in the same order as one
+        day at a time, so that the results are identical.
+
+        Args:
+            num: array of covid counts, of shape (number of geo_ids, number of dates)
+            den: array of total visits, of the same shape
+            k: maximum number of days used to average a backfill correction
+            min_visits_to_fill: minimum number of total visits needed in order to sum a bin
+
+        Returns: arrays of adjusted covid counts and adjusted visit counts, of the same shape
+        """
+        num = np.asarray(num, dtype=float)
+        den = np.asarray(den, dtype=float)
+        days = np.arange(den.shape[-1])
+
+        # the days of each bin, from the day itself backwards, with those before the
+        # first day masked out
+        bin_days = days[:, None] - np.arange(k + 1)
+        available = bin_days >= 0
+        bin_days = np.where(available, bin_days, 0)
+        num_bins = num[..., bin_days]
+        den_bins = den[..., bin_days]
+
+        # calculate window: the first day reaching min_visits_to_fill, at most k days back
+        filled = (np.cumsum(den_bins, axis=-1) >= min_visits_to_fill) & available
+        window = np.where(filled.any(axis=-1), filled.argmax(axis=-1), k)
+        bin_lengths = np.minimum(window, days) + 1
+
+        new_num = num.copy()
+        new_den = den.copy()
+        for length in np.unique(bin_lengths[window > 0]):
+            in_bin = (bin_lengths == length) & (window > 0)
+            new_num[in_bin] = num_bins[in_bin][:, :length].sum(axis=-1)
+            new_den[in_bin] = den_bins[in_bin][:, :length].sum(axis=-1)
 
         return new_num, new_den
 
@@ -110,18 +129,64 @@ class CHCSensor:
             dictionary of results
 
         """
+        res = CHCSensor.fit_panel(
+            y_data[num_col].values.reshape(1, -1), y_data[den_col].values.reshape(1, -1),
+            y_data.index, first_sensor_date, [geo_id])
+        index = y_data.index[y_data.index >= first_sensor_date]
+        rate = pd.Series(res["rate"][0], index=index)
+        se = pd.Series(res["se"][0], index=index)
+
+        logging.debug(f"{geo_id}: {rate[-1] / 100:.3f},[{se[-1] / 100:.3f}]")
+        return {"geo_id": geo_id, "rate": rate, "se": se,
+                "incl": pd.Series(res["incl"][0], index=index)}
+
+    @staticmethod
+    def history_length():
+        """Number of days before a date whose counts its fitted value depends on.
+
+        The backfill of a date uses the counts of at most Config.MAX_BACKFILL_WINDOW
+        days before it, and the smoother only uses the last
+        kernel_width(Config.SMOOTHER_BANDWIDTH) values, see delphi_utils.smooth.
+
+        Returns: number of days
+        """
+        return Config.MAX_BACKFILL_WINDOW + kernel_width(Config.SMOOTHER_BANDWIDTH) - 1
+
+    @staticmethod
+    def fit_panel(num, den, dates, first_sensor_date, geo_ids):
+        """Fitting routine for all geo_ids at once.
+
+        Same as fit, on matrices of counts with one row per geo_id, so that the
+        smoothing and rate calculations run on every geo_id in one vectorized call.
+
+        Args:
+            num: array of covid counts, of shape (number of geo_ids, number of dates)
+            den: array of total visits, of the same shape
+            dates: DatetimeIndex of the columns
+            first_sensor_date: datetime of first date
+            geo_ids: unique identifiers of the rows
+
+        Returns:
+            dictionary of results, with arrays of rate, se and incl of shape
+            (number of geo_ids, number of dates from first_sensor_date)
+
+        """
+        num = np.asarray(num, dtype=float)
+        den = np.asarray(den, dtype=float)
+
+        # the values from first_sensor_date only depend on the last CHCSensor.history_length()
+        # days before it, so the older dates do not need to be fit
+        start = max(np.count_nonzero(np.asarray(dates < first_sensor_date))
+                    - CHCSensor.history_length(), 0)
+        num, den, dates = num[:, start:], den[:, start:], dates[start:]
+
         # backfill
-        total_counts, total_visits = CHCSensor.backfill(y_data[num_col].values, y_data[den_col].values)
+        total_counts, total_visits = CHCSensor.backfill_panel(num, den)
 
         # calculate smoothed counts and jeffreys rate
         # the left_gauss_linear smoother is not guaranteed to return values greater than 0
 
-        smoothed_total_counts, smoothed_total_visits = CHCSensor.gauss_smooth(total_counts.flatten(),total_visits)
-
-        # in smoothing, the numerator may have become more than the denominator
-        # simple fix is to clip the max values elementwise to the denominator (note that
-        # this has only been observed in synthetic data)
-        # smoothed_total_counts = np.clip(smoothed_total_counts, 0, smoothed_total_visits)
+        smoothed_total_counts, smoothed_total_visits = CHCSensor.gauss_smooth(total_counts,total_visits)
 
         smoothed_total_rates = (
                 (smoothed_total_counts + 0.5) / (smoothed_total_visits + 1)
@@ -129,19 +194,19 @@ class CHCSensor:
 
         # checks - due to the smoother, the first value will be NA
         assert (
-                np.sum(np.isnan(smoothed_total_rates[1:])) == 0
+                np.sum(np.isnan(smoothed_total_rates[:, 1:])) == 0
         ), "NAs in rate calculation"
+        nonpositive = np.any(smoothed_total_rates[:, 1:] <= 0, axis=1)
         assert (
-                np.sum(smoothed_total_rates[1:] <= 0) == 0
-        ), f"0 or negative value, {geo_id}"
+                not nonpositive.any()
+        ), f"0 or negative value, {geo_ids[np.argmax(nonpositive)]}"
 
         # cut off at sensor indexes
-        rate_data = pd.DataFrame({'rate':smoothed_total_rates, 'den': smoothed_total_visits}, index=y_data.index)
-        rate_data = rate_data[first_sensor_date:]
-        include = rate_data['den'] >= Config.MIN_DEN
-        valid_rates = rate_data[include]
-        se_valid = valid_rates.eval('sqrt(rate * (1 - rate) / den)')
-        rate_data['se'] = se_valid
-
-        logging.debug(f"{geo_id}: {rate_data['rate'][-1]:.3f},[{rate_data['se'][-1]:.3f}]")
-        return {"geo_id": geo_id, "rate": 100 * rate_data['rate'], "se": 100 * rate_data['se'], "incl": include}
+        sensor_idxs = np.asarray(dates >= first_sensor_date)
+        rate = smoothed_total_rates[:, sensor_idxs]
+        den = smoothed_total_visits[:, sensor_idxs]
+        include = den >= Config.MIN_DEN
+        with np.errstate(divide="ignore", invalid="ignore"):
+            se = np.where(include, np.sqrt(rate * (1 - rate) / den), np.nan)
+
+        return {"geo_id": geo_ids, "rate": 100 * rate, "se": 100 * se, "incl": include}
@@ -6,13 +6,14 @@ Author: Maria Jahja
 Created: 2020-04-16
 
 """
-import numpy as np
+from delphi_utils import smooth as utils_smooth
 
 from .config import Config
 
 
 def left_gauss_linear(s, h=Config.SMOOTHER_BANDWIDTH):
     """Smooth the y-values using a local linear left Gaussian filter.
+    Runs in linear time, see delphi_utils.smooth.left_gauss_linear.
 
     Args:
         y: one dimensional signal to smooth.
@@ -20,17 +21,4 @@ def left_gauss_linear(s, h=Config.SMOOTHER_BANDWIDTH):
 
     Returns: a smoothed 1D signal.
     """
-
-    n = len(s)
-    t = np.zeros_like(s)
-    X = np.vstack([np.ones(n), np.arange(n)]).T
-    for idx in range(n):
-        wts = np.exp(-((np.arange(idx + 1) - idx) ** 2) / h)
-        XwX = np.dot(X[: (idx + 1), :].T * wts, X[: (idx + 1), :])
-        Xwy = np.dot(X[: (idx + 1), :].T * wts, s[: (idx + 1)].reshape(-1, 1))
-        try:
-            beta = np.linalg.solve(XwX, Xwy)
-            t[idx] = np.dot(X[: (idx + 1), :], beta)[-1]
-        except np.linalg.LinAlgError:
-            t[idx] = np.nan
-    return t
+    return utils_smooth.left_gauss_linear(s, h)
@@ -8,7 +8,7 @@ Modified: 2020-09-27
     - partially concede few naming changes for pylint
 
 """
-import numpy as np
+from delphi_utils import smooth as utils_smooth
 
 from .config import Config
 
@@ -16,6 +16,7 @@ from .config import Config
 def left_gauss_linear(arr, bandwidth=Config.SMOOTHER_BANDWIDTH):
     """
     Smooth the y-values using a local linear left Gaussian filter.
+    Runs in linear time, see delphi_utils.smooth.left_gauss_linear.
 
     Args:
         arr: one dimensional signal to smooth.
@@ -24,17 +25,4 @@ def left_gauss_linear(arr, bandwidth=Config.SMOOTHER_BANDWIDTH):
     Returns: a smoothed 1D signal.
 
     """
-
-    n_rows = len(arr)
-    out_arr = np.zeros_like(arr)
-    X = np.vstack([np.ones(n_rows), np.arange(n_rows)]).T
-    for idx in range(n_rows):
-        weights = np.exp(-((np.arange(idx + 1) - idx) ** 2) / bandwidth)
-        XwX = np.dot(X[: (idx + 1), :].T * weights, X[: (idx + 1), :])
-        Xwy = np.dot(X[: (idx + 1), :].T * weights, arr[: (idx + 1)].reshape(-1, 1))
-        try:
-            beta = np.linalg.solve(XwX, Xwy)
-            out_arr[idx] = np.dot(X[: (idx + 1), :], beta)[-1]
-        except np.linalg.LinAlgError:
-            out_arr[idx] = np.nan
-    return out_arr
+    return utils_smooth.left_gauss_linear(arr, bandwidth)
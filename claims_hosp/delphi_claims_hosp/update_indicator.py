@@ -8,12 +8,10 @@ Created: 2020-09-27
 
 # standard packages
 import logging
-from multiprocessing import Pool, cpu_count
 
 # third party
-import numpy as np
 import pandas as pd
-from delphi_utils import GeoMapper
+from delphi_utils import GeoMapper, write_sensor_csvs
 
 # first party
 from .config import Config, GeoConstants
@@ -38,7 +36,7 @@ class ClaimsHospIndicatorUpdater:
             enddate: last indicator date (YYYY-mm-dd)
             dropdate: data drop date (YYYY-mm-dd)
             geo: geographic resolution, one of ["county", "state", "msa", "hrr"]
-            parallel: boolean to run the indicator update in parallel
+            parallel: unused, as all geo_ids are fit at once (kept for compatibility)
             weekday: boolean to adjust for weekday effects
             write_se: boolean to write out standard errors, if true, use an obfuscated name
             signal_name: string signal name
@@ -153,45 +151,19 @@ class ClaimsHospIndicatorUpdater:
         # handle if we need to adjust by weekday
         wd_params = Weekday.get_params(data_frame) if self.weekday else None
 
-        # run fitting code (maybe in parallel)
-        rates = {}
-        std_errs = {}
-        valid_inds = {}
-        if not self.parallel:
-            for geo_id, sub_data in data_frame.groupby(level=0):
-                sub_data.reset_index(level=0, inplace=True)
-                if self.weekday:
-                    sub_data = Weekday.calc_adjustment(wd_params, sub_data)
-                res = ClaimsHospIndicator.fit(sub_data, self.burnindate, geo_id)
-                res = pd.DataFrame(res)
-                rates[geo_id] = np.array(res.loc[final_output_inds, "rate"])
-                std_errs[geo_id] = np.array(res.loc[final_output_inds, "se"])
-                valid_inds[geo_id] = np.array(res.loc[final_output_inds, "incl"])
-        else:
-            n_cpu = min(Config.MAX_CPU_POOL, cpu_count())
-            logging.debug("starting pool with %d workers", n_cpu)
-            with Pool(n_cpu) as pool:
-                pool_results = []
-                for geo_id, sub_data in data_frame.groupby(level=0, as_index=False):
-                    sub_data.reset_index(level=0, inplace=True)
-                    if self.weekday:
-                        sub_data = Weekday.calc_adjustment(wd_params, sub_data)
-                    pool_results.append(
-                        pool.apply_async(
-                            ClaimsHospIndicator.fit,
-                            args=(sub_data, self.burnindate, geo_id,),
-                        )
-                    )
-                pool_results = [proc.get() for proc in pool_results]
-                for res in pool_results:
-                    geo_id = res["geo_id"]
-                    res = pd.DataFrame(res)
-                    rates[geo_id] = np.array(res.loc[final_output_inds, "rate"])
-                    std_errs[geo_id] = np.array(res.loc[final_output_inds, "se"])
-                    valid_inds[geo_id] = np.array(res.loc[final_output_inds, "incl"])
+        # run fitting code on all geo_ids at once, one row per geo_id
+        nums = data_frame["num"].unstack()
+        dens = data_frame["den"].unstack()
+        if self.weekday:
+            nums = Weekday.calc_adjustment_panel(wd_params, nums, nums.columns)
+        unique_geo_ids = list(dens.index)
+        res = ClaimsHospIndicator.fit_panel(
+            nums.values, dens.values, dens.columns, self.burnindate, unique_geo_ids)
+        rates = dict(zip(unique_geo_ids, res["rate"][:, final_output_inds]))
+        std_errs = dict(zip(unique_geo_ids, res["se"][:, final_output_inds]))
+        valid_inds = dict(zip(unique_geo_ids, res["incl"][:, final_output_inds]))
 
         # write out results
-        unique_geo_ids = list(rates.keys())
         output_dict = {
             "rates": rates,
             "se": std_errs,
@@ -218,38 +190,17 @@ class ClaimsHospIndicatorUpdater:
                          self.signal_name)
 
         geo_level = output_dict["geo_level"]
-        dates = output_dict["dates"]
         geo_ids = output_dict["geo_ids"]
-        all_rates = output_dict["rates"]
-        all_se = output_dict["se"]
-        all_include = output_dict["include"]
-        out_n = 0
-        for i, date in enumerate(dates):
-            filename = "%s/%s_%s_%s.csv" % (
-                output_path,
-                (date + Config.DAY_SHIFT).strftime("%Y%m%d"),
-                geo_level,
-                self.signal_name,
-            )
-            with open(filename, "w") as outfile:
-                outfile.write("geo_id,val,se,direction,sample_size\n")
-                for geo_id in geo_ids:
-                    val = all_rates[geo_id][i]
-                    se = all_se[geo_id][i]
-                    if all_include[geo_id][i]:
-                        assert not np.isnan(val), "value for included value is nan"
-                        assert not np.isnan(se), "se for included rate is nan"
-                        if val > 90:
-                            logging.warning("value suspicious, %s: %d", geo_id, val)
-                        assert se < 5, f"se suspicious, {geo_id}: {se}"
-                        if self.write_se:
-                            assert val > 0 and se > 0, "p=0, std_err=0 invalid"
-                            outfile.write(
-                                "%s,%f,%s,%s,%s\n" % (geo_id, val, se, "NA", "NA"))
-                        else:
-                            # for privacy reasons we will not report the standard error
-                            outfile.write(
-                                "%s,%f,%s,%s,%s\n" % (geo_id, val, "NA", "NA", "NA"))
-                        out_n += 1
+        out_n = write_sensor_csvs(
+            output_path,
+            geo_level,
+            self.signal_name,
+            [date + Config.DAY_SHIFT for date in output_dict["dates"]],
+            geo_ids,
+            [output_dict["rates"][geo_id] for geo_id in geo_ids],
+            [output_dict["se"][geo_id] for geo_id in geo_ids],
+            [output_dict["include"][geo_id] for geo_id in geo_ids],
+            self.write_se,
+        )
 
         logging.debug("wrote %d rows for %d %s", out_n, len(geo_ids), geo_level)
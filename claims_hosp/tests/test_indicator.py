@@ -50,6 +50,19 @@ class TestLoadData:
         assert np.array_equal(exp_num4, num4)
         assert np.array_equal(exp_den4, den4)
 
+    def test_backwards_pad_panel(self):
+        den = nr.uniform(0, 200, (5, 30))
+        den[2, 10] = np.nan
+        num = nr.uniform(0, 0.3, (5, 30)) * den
+
+        # adjusting all rows at once is the same as adjusting them one at a time
+        for k, min_visits_to_fill in [(0, 100), (3, 100), (7, 500), (10, 1000)]:
+            num1, den1 = ClaimsHospIndicator.backwards_pad_panel(num, den, k, min_visits_to_fill)
+            for row in range(num.shape[0]):
+                num0, den0 = ClaimsHospIndicator.backwards_pad(num[row], den[row], k, min_visits_to_fill)
+                assert np.array_equal(num1[row], num0.flatten(), equal_nan=True)
+                assert np.array_equal(den1[row], den0, equal_nan=True)
+
     def test_fit_fips(self):
         date_range = pd.date_range("2020-05-01", "2020-05-20")
         all_fips = self.fips_data.fips.unique()
@@ -73,6 +86,40 @@ class TestLoadData:
                 assert np.nanmin(res0["se"]) > 0
                 assert res0["incl"].sum() > 0
 
+    def test_fit_panel(self):
+        date_range = pd.date_range("2020-05-01", "2020-05-20")
+        all_fips = self.fips_data.fips.unique()
+        loc_index_fips_data = self.fips_data.set_index(["fips", "date"])
+        sample_fips = nr.choice(all_fips, 10, replace=False)
+        sub_datas = [loc_index_fips_data.loc[fips].reindex(date_range, fill_value=0)
+                     for fips in sample_fips]
+
+        # fitting all geo_ids at once is the same as fitting them one at a time
+        res = ClaimsHospIndicator.fit_panel(
+            np.vstack([sub_data["num"] for sub_data in sub_datas]),
+            np.vstack([sub_data["den"] for sub_data in sub_datas]),
+            date_range, date_range[5], sample_fips)
+        for i, (fips, sub_data) in enumerate(zip(sample_fips, sub_datas)):
+            res0 = ClaimsHospIndicator.fit(sub_data, date_range[5], fips)
+            assert np.allclose(res["rate"][i], res0["rate"])
+            assert np.allclose(res["se"][i], res0["se"], equal_nan=True)
+            assert np.array_equal(res["incl"][i], res0["incl"])
+
+    def test_fit_panel_history(self):
+        date_range = pd.date_range("2020-01-01", "2020-12-31")
+        den = nr.poisson(nr.uniform(100, 1000, (5, 1)), (5, len(date_range))).astype(float)
+        num = nr.binomial(den.astype(int), 0.1).astype(float)
+        geo_ids = np.arange(5)
+
+        # fitting only the dates that the later values depend on does not change them
+        first = len(date_range) - 10
+        assert first > ClaimsHospIndicator.history_length()
+        res_all = ClaimsHospIndicator.fit_panel(num, den, date_range, date_range[0], geo_ids)
+        res = ClaimsHospIndicator.fit_panel(num, den, date_range, date_range[first], geo_ids)
+        assert np.array_equal(res["rate"], res_all["rate"][:, first:])
+        assert np.array_equal(res["se"], res_all["se"][:, first:], equal_nan=True)
+        assert np.array_equal(res["incl"], res_all["incl"][:, first:])
+
     def test_fit_hrrs(self):
         date_range = pd.date_range("2020-05-01", "2020-05-20")
         all_hrrs = self.hrr_data.hrr.unique()
@@ -6,12 +6,10 @@ Created: 2020-06-01
 # standard packages
 import logging
 from datetime import timedelta
-from multiprocessing import Pool, cpu_count
 import covidcast
-from delphi_utils import GeoMapper, S3ArchiveDiffer, read_params
+from delphi_utils import GeoMapper, S3ArchiveDiffer, read_params, write_sensor_csvs
 
 # third party
-import numpy as np
 import pandas as pd
 # first party
 from .config import Config, Constants
@@ -19,7 +17,7 @@ from .geo_maps import GeoMaps
 from .load_data import load_combined_data
 from .sensor import EMRHospSensor
 from .weekday import Weekday
-from .constants import SIGNALS, SMOOTHED, SMOOTHED_ADJ, HRR, NA, FIPS
+from .constants import SIGNALS, SMOOTHED, SMOOTHED_ADJ, HRR, FIPS
 
 
 def write_to_csv(output_dict, write_se, out_name, output_path="."):
@@ -33,40 +31,18 @@ def write_to_csv(output_dict, write_se, out_name, output_path="."):
     if write_se:
         logging.info(f"========= WARNING: WRITING SEs TO {out_name} =========")
     geo_level = output_dict["geo_level"]
-    dates = output_dict["dates"]
     geo_ids = output_dict["geo_ids"]
-    all_rates = output_dict["rates"]
-    all_se = output_dict["se"]
-    all_include = output_dict["include"]
-    out_n = 0
-    for i, d in enumerate(dates):
-        filename = "%s/%s_%s_%s.csv" % (
-            output_path,
-            (d + Config.DAY_SHIFT).strftime("%Y%m%d"),
-            geo_level,
-            out_name,
-        )
-        with open(filename, "w") as outfile:
-            outfile.write("geo_id,val,se,direction,sample_size\n")
-            for geo_id in geo_ids:
-                sensor = all_rates[geo_id][i]
-                se = all_se[geo_id][i]
-                if all_include[geo_id][i]:
-                    assert not np.isnan(sensor), "value for included sensor is nan"
-                    assert not np.isnan(se), "se for included sensor is nan"
-                    if sensor > 90:
-                        logging.warning(f"value suspiciously high, {geo_id}: {sensor}")
-                    assert se < 5, f"se suspiciously high, {geo_id}: {se}"
-                    if write_se:
-                        assert sensor > 0 and se > 0, "p=0, std_err=0 invalid"
-                        outfile.write(
-                            "%s,%f,%s,%s,%s\n" % (geo_id, sensor, se, NA, NA))
-                    else:
-                        # for privacy reasons we will not report the standard error
-                        outfile.write(
-                            "%s,%f,%s,%s,%s\n" % (geo_id, sensor, NA, NA, NA)
-                        )
-                    out_n += 1
+    out_n = write_sensor_csvs(
+        output_path,
+        geo_level,
+        out_name,
+        [d + Config.DAY_SHIFT for d in output_dict["dates"]],
+        geo_ids,
+        [output_dict["rates"][geo_id] for geo_id in geo_ids],
+        [output_dict["se"][geo_id] for geo_id in geo_ids],
+        [output_dict["include"][geo_id] for geo_id in geo_ids],
+        write_se,
+    )
     logging.debug(f"wrote {out_n} rows for {len(geo_ids)} {geo_level}")
 
 
@@ -139,7 +115,7 @@ class EMRHospSensorUpdator:
             enddate: last sensor date (YYYY-mm-dd)
             dropdate: data drop date (YYYY-mm-dd)
             geo: geographic resolution, one of ["county", "state", "msa", "hrr"]
-            parallel: boolean to run the sensor update in parallel
+            parallel: unused, as all geo_ids are fit at once (kept for compatibility)
             weekday: boolean to adjust for weekday effects
             se: boolean to write out standard errors, if true, use an obfuscated name
         """
@@ -233,42 +209,17 @@ class EMRHospSensorUpdator:
         data_frame = self.geo_reindex(data)
         # handle if we need to adjust by weekday
         wd_params = Weekday.get_params(data_frame) if self.weekday else None
-        # run sensor fitting code (maybe in parallel)
-        sensor_rates = {}
-        sensor_se = {}
-        sensor_include = {}
-        if not self.parallel:
-            for geo_id, sub_data in data_frame.groupby(level=0):
-                sub_data.reset_index(level=0,inplace=True)
-                if self.weekday:
-                    sub_data = Weekday.calc_adjustment(wd_params, sub_data)
-                res = EMRHospSensor.fit(sub_data, self.burnindate, geo_id)
-                res = pd.DataFrame(res)
-                sensor_rates[geo_id] = np.array(res.loc[final_sensor_idxs,"rate"])
-                sensor_se[geo_id] = np.array(res.loc[final_sensor_idxs,"se"])
-                sensor_include[geo_id] = np.array(res.loc[final_sensor_idxs,"incl"])
-        else:
-            n_cpu = min(10, cpu_count())
-            logging.debug(f"starting pool with {n_cpu} workers")
-            with Pool(n_cpu) as pool:
-                pool_results = []
-                for geo_id, sub_data in data_frame.groupby(level=0,as_index=False):
-                    sub_data.reset_index(level=0, inplace=True)
-                    if self.weekday:
-                        sub_data = Weekday.calc_adjustment(wd_params, sub_data)
-                    pool_results.append(
-                        pool.apply_async(
-                            EMRHospSensor.fit, args=(sub_data, self.burnindate, geo_id,),
-                        )
-                    )
-                pool_results = [proc.get() for proc in pool_results]
-                for res in pool_results:
-                    geo_id = res["geo_id"]
-                    res = pd.DataFrame(res)
-                    sensor_rates[geo_id] = np.array(res.loc[final_sensor_idxs, "rate"])
-                    sensor_se[geo_id] = np.array(res.loc[final_sensor_idxs, "se"])
-                    sensor_include[geo_id] = np.array(res.loc[final_sensor_idxs, "incl"])
-        unique_geo_ids = list(sensor_rates.keys())
+        # run sensor fitting code on all geo_ids at once, one row per geo_id
+        nums = data_frame["num"].unstack()
+        dens = data_frame["den"].unstack()
+        if self.weekday:
+            nums = Weekday.calc_adjustment_panel(wd_params, nums, nums.columns)
+        unique_geo_ids = list(dens.index)
+        res = EMRHospSensor.fit_panel(
+            nums.values, dens.values, dens.columns, self.burnindate, unique_geo_ids)
+        sensor_rates = dict(zip(unique_geo_ids, res["rate"][:, final_sensor_idxs]))
+        sensor_se = dict(zip(unique_geo_ids, res["se"][:, final_sensor_idxs]))
+        sensor_include = dict(zip(unique_geo_ids, res["incl"][:, final_sensor_idxs]))
         output_dict = {
             "rates": sensor_rates,
             "se": sensor_se,
@@ -4,10 +4,14 @@ Weekday effects (code from Aaron Rumack).
 Created: 2020-05-06
 """
 
+# standard packages
+import logging
+
 # third party
 import cvxpy as cp
 import numpy as np
 from cvxpy.error import SolverError
+from delphi_utils.weekday import fit_weekday_params
 
 # first party
 from .config import Config
@@ -17,7 +21,7 @@ class Weekday:
     """Class to handle weekday effects."""
 
     @staticmethod
-    def get_params(data):
+    def get_params(data, solver="interior_point"):
         """Correct a signal estimated as numerator/denominator for weekday effects.
 
         The ordinary estimate would be numerator_t/denominator_t for each time point
@@ -54,6 +58,10 @@ class Weekday:
 
         Return a matrix of parameters: the entire vector of betas, for each time
         series column in the data.
+
+        By default the problem is solved by delphi_utils.weekday.fit_weekday_params, an
+        interior point method using its banded structure, falling back to cvxpy if it does
+        not converge. Set solver to "cvxpy" to solve it with cvxpy instead, as a reference.
         """
 
         tmp = data.reset_index()
@@ -61,6 +69,15 @@ class Weekday:
         nums = tmp.groupby(Config.DATE_COL).sum()["num"]
         n_nums = 1  # only one numerator column
 
+        if solver == "interior_point":
+            params, converged = fit_weekday_params(
+                np.array(nums), np.array(denoms), np.array(nums.index.dayofweek))
+            if converged:
+                return params
+            logging.warning("weekday effects did not converge, refitting with cvxpy")
+        elif solver != "cvxpy":
+            raise ValueError(f"{solver} is invalid, pick one of 'interior_point', 'cvxpy'")
+
         # Construct design matrix to have weekday indicator columns and then day
         # indicators.
         X = np.zeros((nums.shape[0], 6 + nums.shape[0]))
@@ -125,3 +142,14 @@ class Weekday:
         tmp.loc[:, "num"] = wd_correction
 
         return tmp.set_index(Config.DATE_COL)
+
+    @staticmethod
+    def calc_adjustment_panel(params, nums, dates):
+        """Apply the weekday adjustment to the numerators of all time series at once.
+
+        Same as calc_adjustment, on a matrix of numerators with one row per time
+        series and one column per date in dates.
+
+        """
+        wd_effects = np.append(params[:6], -np.sum(params[:6]))
+        return nums / np.exp(wd_effects)[np.asarray(dates.dayofweek)]
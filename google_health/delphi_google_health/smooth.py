@@ -4,6 +4,7 @@
 
 import numpy as np
 import pandas as pd
+from delphi_utils import smooth as utils_smooth
 
 
 def smoothed_values_by_geo_id(df: pd.DataFrame) -> np.ndarray:
@@ -35,7 +36,8 @@ def _left_gauss_linear(s: np.ndarray, h=10, impute=False, minval=None) -> np.nda
     """Local weighted least squares, where the weights are given by a Gaussian kernel.
 
     At each time t, we use the data from times 1, ..., t-dt, weighted
-    using the Gaussian kernel, to produce the estimate at time t.
+    using the Gaussian kernel, to produce the estimate at time t. Runs in linear time,
+    see delphi_utils.smooth.left_gauss_linear.
 
     Parameters
     ----------
@@ -58,19 +60,11 @@ def _left_gauss_linear(s: np.ndarray, h=10, impute=False, minval=None) -> np.nda
 
     assert h > 0, "Bandwidth must be positive"
 
-    n = len(s)
-    t = np.zeros_like(s, dtype=np.float64)
-    X = np.vstack([np.ones(n), np.arange(n)]).T
-    for idx in range(n):
-        wts = np.exp(-((np.arange(idx + 1) - idx) ** 2) / (h ** 2))
-        XwX = np.dot(X[: (idx + 1), :].T * wts, X[: (idx + 1), :])
-        Xwy = np.dot(X[: (idx + 1), :].T * wts, s[: (idx + 1)].reshape(-1, 1))
-        try:
-            beta = np.linalg.solve(XwX, Xwy)
-            t[idx] = np.dot(X[: (idx + 1), :], beta)[-1]
-        except np.linalg.LinAlgError:
-            # At idx 0, method will fail due to rank deficiency.
-            t[idx] = s[idx] if impute else np.nan
+    # The weights of the kernel are exp(-d^2 / h^2) at lag d
+    t = utils_smooth.left_gauss_linear(s, h ** 2)
+    if impute:
+        # At idx 0, the local linear estimate is ill-defined.
+        t[:1] = s[:1]
     if minval is not None:
         t[t <= minval] = minval
     return t
@@ -7,11 +7,10 @@ when the module is run with `python -m MODULE_NAME`.
 from datetime import datetime, date, timedelta
 from os.path import join
 from os import remove, listdir
-from shutil import copy
 
 import numpy as np
 import pandas as pd
-from delphi_utils import read_params, S3ArchiveDiffer
+from delphi_utils import link_or_copy, read_params, S3ArchiveDiffer
 
 from .pull import pull_nchs_mortality_data
 from .export import export_csv
@@ -94,7 +93,7 @@ def run_module():
     if datetime.today().weekday() == 0:
         # Copy todays raw output to receiving
         for output_file in listdir(daily_export_dir):
-            copy(
+            link_or_copy(
                 join(daily_export_dir, output_file),
                 join(export_dir, output_file))
 